@@ -11,6 +11,7 @@ import sqlite3
 import re
 import time
 import json
+import logging
 from datetime import datetime, timezone
 from typing import Optional, List, Dict, Any, Tuple
 
@@ -23,11 +24,17 @@ except Exception:  # pragma: no cover
 # ORM para auditoría y join con email/nombre
 from db_orm import SessionLocal, AuditLog, Usuario
 
+# Pool SQLite (1 escritor bajo lock + lectores query_only reutilizados).
+# DB_PATH/SQLITE_PRAGMAS/aplicar_pragmas se re-exportan para main.py.
+from db_pool import DB_PATH, SQLITE_PRAGMAS, aplicar_pragmas, get_conn  # noqa: F401
+
+# Hijo de "pliegos": sale por el QueueHandler de main.py (sin escribir stdout desde el request)
+_log = logging.getLogger("pliegos.db")
+
 # =============================================================================
 # Configuración
 # =============================================================================
 
-DB_PATH = os.getenv("SQLITE_PATH", "usuarios.db")  # <- permite override en Render
 APP_TIMEZONE = os.getenv("APP_TIMEZONE", "America/Argentina/Buenos_Aires")
 
 ACCION_ES = {
@@ -47,6 +54,26 @@ ACCION_ES = {
     "RATE_ANALYSIS": "Valorar análisis",
 }
 
+# =============================================================================
+# SQL de ruta caliente
+# (mismo objeto str en cada llamada: sqlite3 reutiliza el statement preparado
+#  de su cache por conexión en vez de volver a parsearlo)
+# =============================================================================
+
+SQL_GET_USER = "SELECT id, nombre, email, password, rol, activo FROM usuarios WHERE email = ?"
+SQL_GET_ROL = "SELECT rol FROM usuarios WHERE email = ?"
+SQL_CONTAR_NO_LEIDOS = "SELECT COUNT(*) FROM mensajes WHERE para_email = ? AND leido = 0"
+SQL_HILO_OCULTO = "SELECT hidden_at FROM hilos_ocultos WHERE owner_email = ? AND otro_email = ?"
+SQL_DESOCULTAR_HILO = "DELETE FROM hilos_ocultos WHERE owner_email = ? AND otro_email = ?"
+# INSERT ... RETURNING (SQLite >= 3.35): el id vuelve en la misma sentencia
+SQL_INSERT_MENSAJE = (
+    "INSERT INTO mensajes (de_email, para_email, texto, fecha) VALUES (?, ?, ?, ?) RETURNING id"
+)
+SQL_INSERT_ADJUNTO = (
+    "INSERT INTO mensajes_adjuntos (mensaje_id, filename, original, mime, size, created_at) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+
 # =============================================================================
 # Utilidades de fecha/hora y helpers
 # =============================================================================
@@ -77,26 +104,6 @@ def _norm_email(email: Optional[str]) -> str:
 # Conexión SQLite robusta
 # =============================================================================
 
-def _ensure_db_dir(path: str) -> None:
-    d = os.path.dirname(os.path.abspath(path))
-    if d and not os.path.isdir(d):
-        os.makedirs(d, exist_ok=True)
-
-def _get_conn() -> sqlite3.Connection:
-    """
-    Conexión SQLite con WAL, busy_timeout y foreign_keys.
-    NOTA: Cada llamada abre una conexión nueva (patrón recomendado con SQLite).
-    """
-    _ensure_db_dir(DB_PATH)
-    conn = sqlite3.connect(DB_PATH, timeout=10)
-    try:
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA busy_timeout=5000;")  # 5s de espera si está locked
-        conn.execute("PRAGMA foreign_keys=ON;")
-    except Exception:
-        pass
-    return conn
-
 def _with_retry(callable_fn, retries: int = 5, base_delay: float = 0.15):
     """Reintenta operaciones si SQLite está bloqueada."""
     for i in range(retries):
@@ -140,8 +147,8 @@ def registrar_auditoria(
             session.add(log)
             session.commit()
     except Exception as e:
-        # Evitar romper flujo por errores de auditoría (solo log a stdout)
-        print(f"⚠️ registrar_auditoria falló: {repr(e)}")
+        # Evitar romper flujo por errores de auditoría (solo log)
+        _log.warning("⚠️ registrar_auditoria falló: %r", e)
 
 # =============================================================================
 # Inicialización / Migraciones
@@ -172,7 +179,7 @@ def inicializar_bd() -> None:
 # ----- Usuarios --------------------------------------------------------------
 
 def crear_tabla_usuarios() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS usuarios (
@@ -188,7 +195,7 @@ def crear_tabla_usuarios() -> None:
 
 def _migrar_tabla_usuarios_si_falta_rol_y_activo() -> None:
     """Asegura que existan columnas 'rol' y 'activo' en DBs antiguas."""
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute("PRAGMA table_info(usuarios)")
         cols = {r["name"] for r in cur.fetchall()}
@@ -204,14 +211,14 @@ def _migrar_tabla_usuarios_si_falta_rol_y_activo() -> None:
                 pass
 
 def _crear_indices_usuarios() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_email ON usuarios (email)")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_usuarios_rol ON usuarios (rol)")
 
 # ----- Historial -------------------------------------------------------------
 
 def crear_tabla_historial() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS historial (
@@ -234,7 +241,7 @@ def _migrar_historial_add_rating_fields() -> None:
       - rating_at TEXT (YYYYMMDDHHMMSS)
       - rating_required INTEGER (0/1)
     """
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute("PRAGMA table_info(historial)")
         cols = {r["name"] for r in cur.fetchall()}
@@ -260,15 +267,20 @@ def _migrar_historial_add_rating_fields() -> None:
                 pass
 
 def _crear_indices_historial_rating() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_usuario ON historial (usuario)")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_usuario_pending ON historial (usuario, rating_required)")
         conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_analisis_id ON historial (analisis_id)")
+        # Búsqueda del análisis a valorar (obtener_historial_por_ts_o_nombre): cada paso es
+        # un SEARCH con LIMIT 1; (usuario, timestamp) también resuelve el
+        # "ORDER BY timestamp DESC, id DESC" del fallback sin ordenar en temporal.
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_usuario_ts ON historial (usuario, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_historial_usuario_nombre ON historial (usuario, nombre_archivo)")
 
 # ----- Tickets ---------------------------------------------------------------
 
 def crear_tabla_tickets() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS tickets (
@@ -288,7 +300,7 @@ def crear_tabla_tickets() -> None:
 # ----- Chat interno (mensajes, hilos ocultos, adjuntos) ----------------------
 
 def crear_tabla_mensajes() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS mensajes (
@@ -303,7 +315,7 @@ def crear_tabla_mensajes() -> None:
         )
 
 def _migrar_mensajes_add_leido_si_falta() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute("PRAGMA table_info(mensajes)")
         cols = {r["name"] for r in cur.fetchall()}
@@ -314,7 +326,7 @@ def _migrar_mensajes_add_leido_si_falta() -> None:
                 pass
 
 def _crear_indices_mensajes() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         # Para contar no leídos y bandeja de entrada
         conn.execute("CREATE INDEX IF NOT EXISTS idx_msj_para_leido ON mensajes (para_email, leido)")
         # Para hilos y listados
@@ -322,7 +334,7 @@ def _crear_indices_mensajes() -> None:
         conn.execute("CREATE INDEX IF NOT EXISTS idx_msj_fecha ON mensajes (fecha)")
 
 def crear_tabla_hilos_ocultos() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS hilos_ocultos (
@@ -335,7 +347,7 @@ def crear_tabla_hilos_ocultos() -> None:
         )
 
 def crear_tabla_adjuntos() -> None:
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS mensajes_adjuntos (
@@ -374,7 +386,7 @@ def agregar_usuario(
         rol = "usuario"
 
     try:
-        with _get_conn() as conn:
+        with get_conn() as conn:
             cur = conn.execute(
                 "INSERT INTO usuarios (nombre, email, password, rol) VALUES (?, ?, ?, ?)",
                 (nombre, email, password, rol),
@@ -390,24 +402,21 @@ def agregar_usuario(
         )
         return new_id
     except sqlite3.IntegrityError:
-        print(f"⚠️ El usuario con email {email} ya existe.")
+        _log.warning("⚠️ El usuario con email %s ya existe.", email)
         return None
 
 def obtener_usuario_por_email(email: str):
     """Devuelve la fila completa del usuario (tupla): (id, nombre, email, password, rol, activo)"""
     email = _norm_email(email)
-    with _get_conn() as conn:
-        cur = conn.execute(
-            "SELECT id, nombre, email, password, rol, activo FROM usuarios WHERE email = ?",
-            (email,),
-        )
+    with get_conn(readonly=True) as conn:
+        cur = conn.execute(SQL_GET_USER, (email,))
         return cur.fetchone()
 
 def obtener_rol_por_email(email: str) -> Optional[str]:
     """Devuelve 'admin' / 'usuario' / 'borrado' o None si no existe."""
     email = _norm_email(email)
-    with _get_conn() as conn:
-        cur = conn.execute("SELECT rol FROM usuarios WHERE email = ?", (email,))
+    with get_conn(readonly=True) as conn:
+        cur = conn.execute(SQL_GET_ROL, (email,))
         row = cur.fetchone()
         return row[0] if row else None
 
@@ -420,7 +429,7 @@ def listar_usuarios():
     Devuelve lista de dicts con campos básicos.
     (main.py tolera dicts o tuplas gracias a su _user_row_to_dict)
     """
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute("SELECT id, nombre, email, rol, activo FROM usuarios")
         return [
             {
@@ -436,7 +445,7 @@ def listar_usuarios():
 def buscar_usuarios(term: str, limit: int = 8):
     """Autocompletar por nombre o email (case-insensitive), solo activos."""
     like = f"%{(term or '').strip()}%"
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute(
             """
@@ -464,7 +473,7 @@ def actualizar_password(
     ip: Optional[str] = None,
 ) -> None:
     email = _norm_email(email)
-    with _get_conn() as conn:
+    with get_conn() as conn:
         before = obtener_usuario_por_email(email)
         conn.execute("UPDATE usuarios SET password = ? WHERE email = ?", (nueva_password, email))
         after = obtener_usuario_por_email(email)
@@ -487,7 +496,7 @@ def cambiar_estado_usuario(
     ip: Optional[str] = None,
 ) -> None:
     email = _norm_email(email)
-    with _get_conn() as conn:
+    with get_conn() as conn:
         before = obtener_usuario_por_email(email)
         conn.execute("UPDATE usuarios SET activo = ? WHERE email = ?", (1 if activo else 0, email))
         after = obtener_usuario_por_email(email)
@@ -518,7 +527,7 @@ def cambiar_rol(
     if nuevo_rol not in ("admin", "usuario", "borrado"):
         nuevo_rol = "usuario"
 
-    with _get_conn() as conn:
+    with get_conn() as conn:
         before = obtener_usuario_por_email(email)
         if not before:
             return False
@@ -556,7 +565,7 @@ def borrar_usuario(
         user_id = before[0]
 
         if soft:
-            with _get_conn() as conn:
+            with get_conn() as conn:
                 conn.execute(
                     "UPDATE usuarios SET activo = 0, rol = 'borrado' WHERE email = ?",
                     (email,),
@@ -572,7 +581,7 @@ def borrar_usuario(
                 ip=ip,
             )
         else:
-            with _get_conn() as conn:
+            with get_conn() as conn:
                 conn.execute("DELETE FROM usuarios WHERE email = ?", (email,))
             registrar_auditoria(
                 actor_user_id,
@@ -612,7 +621,7 @@ def guardar_en_historial(
     try:
         m = re.search(r"(\d{14})", str(timestamp or ""))
         ts = m.group(1) if m else _ahora_stamp()
-        with _get_conn() as conn:
+        with get_conn() as conn:
             conn.execute(
                 """
                 INSERT INTO historial (timestamp, usuario, nombre_archivo, ruta_pdf, resumen_texto)
@@ -620,8 +629,8 @@ def guardar_en_historial(
                 """,
                 (ts, usuario, nombre_archivo, ruta_pdf, resumen_texto),
             )
-    except Exception as e:
-        print(f"❌ Error al guardar en historial: {e}")
+    except Exception:
+        _log.exception("❌ Error al guardar en historial")
 
 def iniciar_analisis_historial(
     usuario: str,
@@ -636,7 +645,7 @@ def iniciar_analisis_historial(
     """
     def _op():
         ts = _ahora_stamp()
-        with _get_conn() as conn:
+        with get_conn() as conn:
             cur = conn.execute(
                 """
                 INSERT INTO historial
@@ -683,7 +692,7 @@ def marcar_valoracion_historial(
 
     def _op():
         ra = _ahora_stamp()
-        with _get_conn() as conn:
+        with get_conn() as conn:
             conn.execute(
                 """
                 UPDATE historial
@@ -706,7 +715,7 @@ def marcar_valoracion_historial(
 
 def tiene_valoracion_pendiente(usuario: str) -> bool:
     """True si el usuario tiene algún análisis sin valorar (rating_required=1)."""
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             """
             SELECT 1
@@ -723,7 +732,7 @@ def obtener_historial():
     Lista resumida del historial (sin texto completo del resumen).
     Devuelve: [{id, timestamp, usuario, nombre_archivo, ruta_pdf, fecha_legible}, ...]
     """
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             """
             SELECT id, timestamp, usuario, nombre_archivo, ruta_pdf
@@ -750,40 +759,91 @@ def obtener_historial():
             )
         return out
 
+_HISTORIAL_COLS = "id, timestamp, usuario, nombre_archivo, resumen_texto, rating, rating_at, rating_required"
+
+def _historial_row_to_dict(row) -> Dict[str, Any]:
+    ts = row[1]
+    try:
+        fecha_legible = datetime.strptime(ts, "%Y%m%d%H%M%S").strftime("%d/%m/%Y %H:%M")
+    except Exception:
+        fecha_legible = "Fecha inválida"
+    return {
+        "id": row[0],
+        "timestamp": ts,
+        "usuario": row[2],
+        "nombre_archivo": row[3],
+        "resumen": row[4],
+        "rating": row[5],
+        "rating_at": row[6],
+        "rating_required": bool(row[7]),
+        "fecha": fecha_legible,
+    }
+
 def obtener_historial_completo():
     """
     Lista detallada del historial (incluye resumen y estado de rating).
     Devuelve: [{id, timestamp, usuario, nombre_archivo, resumen, rating, rating_at, rating_required, fecha}, ...]
     """
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
+        cur = conn.execute(f"SELECT {_HISTORIAL_COLS} FROM historial ORDER BY id DESC")
+        return [_historial_row_to_dict(row) for row in cur.fetchall()]
+
+def obtener_ultimo_analisis(usuario: str) -> Optional[Dict[str, Any]]:
+    """Último análisis (con resumen) de 'usuario'; una fila vía idx_historial_usuario."""
+    with get_conn(readonly=True) as conn:
+        row = conn.execute(
+            f"SELECT {_HISTORIAL_COLS} FROM historial "
+            "WHERE usuario = ? AND resumen_texto IS NOT NULL AND resumen_texto != '' "
+            "ORDER BY id DESC LIMIT 1",
+            (usuario,),
+        ).fetchone()
+        return _historial_row_to_dict(row) if row else None
+
+def obtener_historial_recientes(limit: int = 20) -> List[Dict[str, Any]]:
+    """Los 'limit' análisis más recientes (de cualquier usuario) que tienen resumen."""
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
-            """
-            SELECT id, timestamp, usuario, nombre_archivo, resumen_texto, rating, rating_at, rating_required
-              FROM historial
-             ORDER BY id DESC
-            """
+            f"SELECT {_HISTORIAL_COLS} FROM historial "
+            "WHERE resumen_texto IS NOT NULL AND resumen_texto != '' "
+            "ORDER BY id DESC LIMIT ?",
+            (int(limit),),
         )
-        out = []
-        for row in cur.fetchall():
-            ts = row[1]
-            try:
-                fecha_legible = datetime.strptime(ts, "%Y%m%d%H%M%S").strftime("%d/%m/%Y %H:%M")
-            except Exception:
-                fecha_legible = "Fecha inválida"
-            out.append(
-                {
-                    "id": row[0],
-                    "timestamp": ts,
-                    "usuario": row[2],
-                    "nombre_archivo": row[3],
-                    "resumen": row[4],
-                    "rating": row[5],
-                    "rating_at": row[6],
-                    "rating_required": bool(row[7]),
-                    "fecha": fecha_legible,
-                }
-            )
-        return out
+        return [_historial_row_to_dict(row) for row in cur.fetchall()]
+
+def obtener_max_historial_id() -> int:
+    """Mayor id de historial (0 si está vacío). Crece con cada análisis nuevo: sirve de versión."""
+    with get_conn(readonly=True) as conn:
+        row = conn.execute("SELECT MAX(id) FROM historial").fetchone()
+        return int(row[0] or 0)
+
+def obtener_historial_por_ts_o_nombre(
+    usuario: str,
+    timestamp: Optional[str] = None,
+    nombre_pdf: Optional[str] = None,
+) -> Optional[Dict[str, Any]]:
+    """
+    Análisis de 'usuario' que coincide (en este orden de prioridad) con:
+      1) timestamp exacto, 2) nombre_archivo exacto, 3) timestamp contenido en nombre_archivo,
+      4) si nada coincide, el más reciente del usuario.
+    Cada paso es una consulta indexada con LIMIT 1 (mismo formato que obtener_historial_completo).
+    """
+    timestamp = (timestamp or "").strip()
+    nombre_pdf = (nombre_pdf or "").strip()
+    base = f"SELECT {_HISTORIAL_COLS} FROM historial WHERE usuario = ?"
+    pasos = []
+    if timestamp:
+        pasos.append((" AND timestamp = ? ORDER BY id DESC", timestamp))
+    if nombre_pdf:
+        pasos.append((" AND nombre_archivo = ? ORDER BY id DESC", nombre_pdf))
+    if timestamp:
+        pasos.append((" AND instr(nombre_archivo, ?) > 0 ORDER BY id DESC", timestamp))
+    with get_conn(readonly=True) as conn:
+        for cond, arg in pasos:
+            row = conn.execute(base + cond + " LIMIT 1", (usuario, arg)).fetchone()
+            if row:
+                return _historial_row_to_dict(row)
+        row = conn.execute(base + " ORDER BY timestamp DESC, id DESC LIMIT 1", (usuario,)).fetchone()
+        return _historial_row_to_dict(row) if row else None
 
 def eliminar_del_historial(timestamp: str) -> None:
     """Elimina por timestamp exacto (string de 14 dígitos). Silencioso si no existe."""
@@ -792,7 +852,7 @@ def eliminar_del_historial(timestamp: str) -> None:
         # Para compatibilidad, si viene otra cosa intentamos igual por igualdad
         ts = timestamp
     def _op():
-        with _get_conn() as conn:
+        with get_conn() as conn:
             cur = conn.execute("DELETE FROM historial WHERE timestamp = ?", (ts,))
             return cur.rowcount
     _with_retry(_op)
@@ -804,7 +864,7 @@ def limpiar_historial_invalido() -> int:
     """
     def _collect():
         bad_ids = []
-        with _get_conn() as conn:
+        with get_conn(readonly=True) as conn:
             cur = conn.execute("SELECT id, timestamp FROM historial")
             for _id, ts in cur.fetchall():
                 try:
@@ -818,7 +878,7 @@ def limpiar_historial_invalido() -> int:
         return 0
 
     def _op():
-        with _get_conn() as conn:
+        with get_conn() as conn:
             for _id in bad_ids:
                 conn.execute("DELETE FROM historial WHERE id = ?", (_id,))
         return len(bad_ids)
@@ -835,7 +895,7 @@ def limpiar_historial_invalido() -> int:
 
 def crear_ticket(usuario, titulo, descripcion, tipo, actor_user_id=None, ip=None):
     fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with _get_conn() as conn:
+    with get_conn() as conn:
         cur = conn.execute(
             "INSERT INTO tickets (usuario, titulo, descripcion, tipo, fecha) VALUES (?, ?, ?, ?, ?)",
             (usuario, titulo, descripcion, tipo, fecha),
@@ -851,7 +911,7 @@ def crear_ticket(usuario, titulo, descripcion, tipo, actor_user_id=None, ip=None
     )
 
 def obtener_tickets_por_usuario(usuario):
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             "SELECT id, usuario, titulo, descripcion, tipo, estado, fecha "
             "FROM tickets WHERE usuario = ? ORDER BY fecha DESC",
@@ -860,7 +920,7 @@ def obtener_tickets_por_usuario(usuario):
         return cur.fetchall()
 
 def obtener_todos_los_tickets():
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             "SELECT id, usuario, titulo, descripcion, tipo, estado, fecha "
             "FROM tickets ORDER BY fecha DESC"
@@ -868,7 +928,7 @@ def obtener_todos_los_tickets():
         return cur.fetchall()
 
 def actualizar_estado_ticket(ticket_id, nuevo_estado, actor_user_id=None, ip=None):
-    with _get_conn() as conn:
+    with get_conn() as conn:
         cur = conn.execute("SELECT usuario, titulo, estado FROM tickets WHERE id = ?", (ticket_id,))
         before = cur.fetchone()
         conn.execute("UPDATE tickets SET estado = ? WHERE id = ?", (nuevo_estado, ticket_id))
@@ -888,7 +948,7 @@ def agregar_ticket(timestamp, usuario, titulo, descripcion, actor_user_id=None,
     crear_ticket(usuario, titulo, descripcion, "General", actor_user_id=actor_user_id, ip=ip)
 
 def obtener_tickets():
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             "SELECT id, usuario, titulo, descripcion, tipo, estado, fecha "
             "FROM tickets ORDER BY fecha DESC"
@@ -912,7 +972,7 @@ def marcar_ticket_resuelto(ticket_id, actor_user_id=None, ip=None):
     actualizar_estado_ticket(ticket_id, "Resuelto", actor_user_id=actor_user_id, ip=ip)
 
 def eliminar_ticket(ticket_id, actor_user_id=None, ip=None):
-    with _get_conn() as conn:
+    with get_conn() as conn:
         cur = conn.execute("SELECT usuario, titulo FROM tickets WHERE id = ?", (ticket_id,))
         before = cur.fetchone()
         conn.execute("DELETE FROM tickets WHERE id = ?", (ticket_id,))
@@ -933,15 +993,10 @@ def eliminar_ticket(ticket_id, actor_user_id=None, ip=None):
 def enviar_mensaje(de_email: str, para_email: str, texto: str, actor_user_id=None, ip=None) -> int:
     """Guarda un mensaje 1:1 y registra auditoría; también ‘desoculta’ el hilo del emisor."""
     fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with _get_conn() as conn:
-        cur = conn.execute(
-            "INSERT INTO mensajes (de_email, para_email, texto, fecha) VALUES (?, ?, ?, ?)",
-            (de_email, para_email, texto, fecha),
-        )
-        msg_id = cur.lastrowid
-
-    # Al enviar, restauramos el hilo para el emisor (si estaba oculto).
-    restaurar_hilo(de_email, para_email, actor_user_id=actor_user_id, ip=ip, silent=True)
+    with get_conn() as conn:
+        msg_id = conn.execute(SQL_INSERT_MENSAJE, (de_email, para_email, texto, fecha)).fetchone()[0]
+        # Al enviar, restauramos el hilo para el emisor (si estaba oculto); misma transacción.
+        conn.execute(SQL_DESOCULTAR_HILO, (de_email, para_email))
 
     preview = (texto[:120] + "…") if len(texto) > 120 else texto
     registrar_auditoria(
@@ -954,12 +1009,45 @@ def enviar_mensaje(de_email: str, para_email: str, texto: str, actor_user_id=Non
     )
     return msg_id
 
+def guardar_mensaje_con_adjuntos(
+    de_email: str,
+    para_email: str,
+    texto: str,
+    adjuntos: List[Tuple[str, str, Optional[str], Optional[int]]],
+    actor_user_id=None,
+    ip=None,
+) -> int:
+    """
+    Como enviar_mensaje, pero el mensaje, sus adjuntos (filename, original, mime, size)
+    y la restauración del hilo van en una sola transacción (un único commit/fsync del WAL).
+    """
+    fecha = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with get_conn() as conn:
+        msg_id = conn.execute(SQL_INSERT_MENSAJE, (de_email, para_email, texto, fecha)).fetchone()[0]
+        if adjuntos:
+            conn.executemany(
+                SQL_INSERT_ADJUNTO,
+                [(msg_id, filename, original, mime, size, fecha) for filename, original, mime, size in adjuntos],
+            )
+        conn.execute(SQL_DESOCULTAR_HILO, (de_email, para_email))
+
+    preview = (texto[:120] + "…") if len(texto) > 120 else texto
+    registrar_auditoria(
+        actor_user_id,
+        "SEND_MESSAGE",
+        "mensajes",
+        msg_id,
+        after={"de": de_email, "para": para_email, "texto": preview, "adjuntos": len(adjuntos)},
+        ip=ip,
+    )
+    return msg_id
+
 def obtener_hilos_para(email: str):
     """
     Devuelve lista de hilos [{con, ultima_fecha}], sin los ocultos por 'email'
     salvo que haya mensajes posteriores al ocultamiento.
     """
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             """
             SELECT otro, MAX(fecha) AS ultima_fecha
@@ -1004,18 +1092,33 @@ def obtener_hilos_para(email: str):
 def guardar_adjunto(mensaje_id: int, filename: str, original: str, mime: str = None, size: int = None):
     """Registra metadatos del archivo subido para un mensaje."""
     created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with _get_conn() as conn:
+    with get_conn() as conn:
         cur = conn.execute(
-            """
-            INSERT INTO mensajes_adjuntos (mensaje_id, filename, original, mime, size, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-            """,
+            SQL_INSERT_ADJUNTO + " RETURNING id",
             (mensaje_id, filename, original, mime, size, created_at),
         )
-        return cur.lastrowid
+        return cur.fetchone()[0]
+
+def guardar_adjuntos_bulk(
+    mensaje_id: int,
+    adjuntos: List[Tuple[str, str, Optional[str], Optional[int]]],
+) -> int:
+    """
+    Registra varios adjuntos (filename, original, mime, size) de un mensaje ya existente
+    con un único executemany/commit. Devuelve la cantidad insertada.
+    """
+    if not adjuntos:
+        return 0
+    created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with get_conn() as conn:
+        conn.executemany(
+            SQL_INSERT_ADJUNTO,
+            [(mensaje_id, filename, original, mime, size, created_at) for filename, original, mime, size in adjuntos],
+        )
+    return len(adjuntos)
 
 def obtener_adjuntos_por_mensaje(mensaje_id: int):
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         conn.row_factory = sqlite3.Row
         cur = conn.execute(
             "SELECT id, filename, original, mime, size, created_at "
@@ -1028,7 +1131,7 @@ def obtener_adjuntos_por_mensaje(mensaje_id: int):
 
 def obtener_mensajes_entre(a: str, b: str, limit: int = 100):
     """Mensajes A↔B en orden cronológico (asc), incluyendo adjuntos."""
-    with _get_conn() as conn:
+    with get_conn(readonly=True) as conn:
         cur = conn.execute(
             """
             SELECT id, de_email, para_email, texto, leido, fecha
@@ -1060,7 +1163,7 @@ def obtener_mensajes_entre(a: str, b: str, limit: int = 100):
 
 def marcar_mensajes_leidos(de_email: str, para_email: str):
     """Marca como leídos todos los mensajes entrantes de 'de_email' hacia 'para_email'."""
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             UPDATE mensajes
@@ -1072,11 +1175,8 @@ def marcar_mensajes_leidos(de_email: str, para_email: str):
 
 def contar_no_leidos(email: str) -> int:
     """Total de mensajes no leídos para 'email'."""
-    with _get_conn() as conn:
-        cur = conn.execute(
-            "SELECT COUNT(*) FROM mensajes WHERE para_email = ? AND leido = 0",
-            (email,),
-        )
+    with get_conn(readonly=True) as conn:
+        cur = conn.execute(SQL_CONTAR_NO_LEIDOS, (email,))
         row = cur.fetchone()
         return row[0] if row else 0
 
@@ -1090,7 +1190,7 @@ def ocultar_hilo(owner_email: str, otro_email: str, actor_user_id=None, ip=None)
     Si luego llegan mensajes nuevos, reaparece automáticamente.
     """
     hidden_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    with _get_conn() as conn:
+    with get_conn() as conn:
         conn.execute(
             """
             INSERT INTO hilos_ocultos (owner_email, otro_email, hidden_at)
@@ -1111,11 +1211,8 @@ def ocultar_hilo(owner_email: str, otro_email: str, actor_user_id=None, ip=None)
 
 def restaurar_hilo(owner_email: str, otro_email: str, actor_user_id=None, ip=None, silent: bool = False):
     """Quita el ocultamiento del hilo para 'owner_email'."""
-    with _get_conn() as conn:
-        conn.execute(
-            "DELETE FROM hilos_ocultos WHERE owner_email = ? AND otro_email = ?",
-            (owner_email, otro_email),
-        )
+    with get_conn() as conn:
+        conn.execute(SQL_DESOCULTAR_HILO, (owner_email, otro_email))
     if not silent:
         registrar_auditoria(
             actor_user_id,
@@ -1128,11 +1225,8 @@ def restaurar_hilo(owner_email: str, otro_email: str, actor_user_id=None, ip=Non
 
 def es_hilo_oculto(owner_email: str, otro_email: str):
     """Devuelve fecha de ocultamiento (str) si está oculto; None si no lo está."""
-    with _get_conn() as conn:
-        cur = conn.execute(
-            "SELECT hidden_at FROM hilos_ocultos WHERE owner_email = ? AND otro_email = ?",
-            (owner_email, otro_email),
-        )
+    with get_conn(readonly=True) as conn:
+        cur = conn.execute(SQL_HILO_OCULTO, (owner_email, otro_email))
         row = cur.fetchone()
         return row[0] if row else None
 
@@ -0,0 +1,29 @@
+import os
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+from db_pool import DB_PATH, SQLITE_PRAGMAS
+
+# --- Engine async sobre usuarios.db (aiosqlite): las consultas ceden el event loop
+# en vez de ocupar un hilo del threadpool.
+ASYNC_DB_URL = os.getenv("ASYNC_DATABASE_URL", f"sqlite+aiosqlite:///{DB_PATH}")
+
+# Solo lo usan dos lookups de una columna (rol / id por email) que además van cacheados
+# con TTL: sin pool, cada miss abre y cierra su conexión en vez de retener hasta 30.
+async_engine = create_async_engine(ASYNC_DB_URL, echo=False, poolclass=NullPool)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _aplicar_pragmas(dbapi_conn, _record):
+    """Mismos PRAGMAs que el pool sync (db_pool.SQLITE_PRAGMAS), una vez por conexión."""
+    if not ASYNC_DB_URL.startswith("sqlite"):
+        return
+    cur = dbapi_conn.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cur.execute(pragma)
+    finally:
+        cur.close()
+
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False, autoflush=False)
@@ -1,3 +1,4 @@
+import logging
 import os
 from datetime import datetime
 from sqlalchemy import create_engine, String, Integer, DateTime
@@ -18,6 +19,8 @@ if DB_URL.startswith("sqlite"):
 engine = create_engine(DB_URL, echo=False, future=True, connect_args=connect_args)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+_log = logging.getLogger("pliegos.db")
+
 class Base(DeclarativeBase):
     pass
 
@@ -27,6 +30,7 @@ class Usuario(Base):
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     nombre: Mapped[str | None] = mapped_column(String(255), nullable=True)
     email: Mapped[str] = mapped_column(String(255), nullable=False)
+    rol: Mapped[str | None] = mapped_column(String(50), nullable=True)
 
 # --- Auditoría
 class AuditLog(Base):
@@ -70,7 +74,59 @@ def _ensure_sqlite_auditlog_columns():
     finally:
         conn.close()
 
+# --- Búsqueda full-text de auditoría (FTS5, solo SQLite)
+_AUDIT_FTS_OK = False
+
+def fts_auditoria_activo() -> bool:
+    """True si audit_logs_fts existe y se mantiene por triggers (si no, usar LIKE)."""
+    return _AUDIT_FTS_OK
+
+def _ensure_sqlite_auditlog_fts():
+    """
+    Índice invertido sobre audit_logs (external content) + triggers que lo mantienen.
+    La primera vez se puebla con 'rebuild'. Si el SQLite no trae FTS5, queda desactivado.
+    """
+    global _AUDIT_FTS_OK
+    import sqlite3
+    if not DB_URL.startswith("sqlite"):
+        return
+    db_path = DB_URL.replace("sqlite:///", "")
+    conn = sqlite3.connect(db_path)
+    try:
+        existia = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='audit_logs_fts'"
+        ).fetchone()
+        conn.executescript("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS audit_logs_fts USING fts5(
+                action, entity, entity_id, before_json, after_json, ip,
+                content='audit_logs', content_rowid='id'
+            );
+            CREATE TRIGGER IF NOT EXISTS audit_logs_fts_ai AFTER INSERT ON audit_logs BEGIN
+                INSERT INTO audit_logs_fts(rowid, action, entity, entity_id, before_json, after_json, ip)
+                VALUES (new.id, new.action, new.entity, new.entity_id, new.before_json, new.after_json, new.ip);
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_logs_fts_ad AFTER DELETE ON audit_logs BEGIN
+                INSERT INTO audit_logs_fts(audit_logs_fts, rowid, action, entity, entity_id, before_json, after_json, ip)
+                VALUES ('delete', old.id, old.action, old.entity, old.entity_id, old.before_json, old.after_json, old.ip);
+            END;
+            CREATE TRIGGER IF NOT EXISTS audit_logs_fts_au AFTER UPDATE ON audit_logs BEGIN
+                INSERT INTO audit_logs_fts(audit_logs_fts, rowid, action, entity, entity_id, before_json, after_json, ip)
+                VALUES ('delete', old.id, old.action, old.entity, old.entity_id, old.before_json, old.after_json, old.ip);
+                INSERT INTO audit_logs_fts(rowid, action, entity, entity_id, before_json, after_json, ip)
+                VALUES (new.id, new.action, new.entity, new.entity_id, new.before_json, new.after_json, new.ip);
+            END;
+        """)
+        if not existia:
+            conn.execute("INSERT INTO audit_logs_fts(audit_logs_fts) VALUES ('rebuild')")
+        conn.commit()
+        _AUDIT_FTS_OK = True
+    except sqlite3.OperationalError as e:
+        _log.warning("⚠️ FTS5 no disponible para audit_logs: %r", e)
+    finally:
+        conn.close()
+
 def inicializar_bd_orm():
     Base.metadata.create_all(bind=engine)
     _ensure_sqlite_auditlog_columns()  # mini-migración para SQLite
-    print(f"✅ Tablas ORM verificadas/creadas en {DB_URL}")
+    _ensure_sqlite_auditlog_fts()
+    _log.info("✅ Tablas ORM verificadas/creadas en %s", DB_URL)
@@ -0,0 +1,123 @@
+# =========================
+# db_pool.py
+# (pool de conexiones SQLite: 1 escritor + N lectores, PRAGMAs pre-aplicados)
+# =========================
+
+from __future__ import annotations
+
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+DB_PATH = os.getenv("SQLITE_PATH", "usuarios.db")  # <- permite override en Render
+
+# journal_mode=WAL persiste en el archivo; el resto de los PRAGMAs es por conexión.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",      # fsync solo en checkpoint (seguro con WAL)
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-65536;",       # 64 MB de page cache
+    "PRAGMA mmap_size=268435456;",     # 256 MB memory-mapped
+    "PRAGMA busy_timeout=5000;",       # 5s de espera si está locked
+    "PRAGMA foreign_keys=ON;",
+)
+
+# Statements preparados cacheados por conexión (default de sqlite3: 128)
+CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", "200"))
+
+# Lectores retenidos en el pool (si se agotan se abren extra y se cierran al devolver)
+POOL_READERS = max(4, os.cpu_count() or 1)
+
+
+def _ensure_db_dir(path: str) -> None:
+    d = os.path.dirname(os.path.abspath(path))
+    if d and not os.path.isdir(d):
+        os.makedirs(d, exist_ok=True)
+
+
+def aplicar_pragmas(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """Aplica SQLITE_PRAGMAS a una conexión recién abierta (tolerante a errores)."""
+    for pragma in SQLITE_PRAGMAS:
+        try:
+            conn.execute(pragma)
+        except Exception:
+            pass
+    return conn
+
+
+def _abrir(readonly: bool) -> sqlite3.Connection:
+    _ensure_db_dir(DB_PATH)
+    # check_same_thread=False: la conexión se reutiliza desde distintos hilos del threadpool
+    conn = aplicar_pragmas(sqlite3.connect(
+        DB_PATH, timeout=10, check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+    ))
+    if readonly:
+        conn.execute("PRAGMA query_only=ON;")
+    return conn
+
+
+# =============================================================================
+# Escritor único (WAL admite un solo writer a la vez)
+# =============================================================================
+
+_writer: Optional[sqlite3.Connection] = None
+_writer_lock = threading.RLock()  # reentrante: helpers de escritura pueden anidarse
+
+
+def _get_writer() -> sqlite3.Connection:
+    global _writer
+    if _writer is None:
+        _writer = _abrir(readonly=False)
+    return _writer
+
+
+# =============================================================================
+# Lectores (LIFO: la conexión más reciente tiene la cache caliente)
+# =============================================================================
+
+_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=POOL_READERS)
+
+
+def _tomar_lector() -> sqlite3.Connection:
+    try:
+        return _readers.get_nowait()
+    except queue.Empty:
+        return _abrir(readonly=True)
+
+
+def _devolver_lector(conn: sqlite3.Connection) -> None:
+    conn.row_factory = None  # los helpers lo cambian; no debe filtrarse al próximo uso
+    try:
+        _readers.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+@contextmanager
+def get_conn(readonly: bool = False) -> Iterator[sqlite3.Connection]:
+    """
+    Conexión del pool.
+    - readonly=False: escritor compartido bajo lock; commit al salir, rollback si hay excepción.
+    - readonly=True: lector con query_only=ON, devuelto al pool al salir.
+    """
+    if readonly:
+        conn = _tomar_lector()
+        try:
+            yield conn
+        finally:
+            _devolver_lector(conn)
+        return
+
+    with _writer_lock:
+        conn = _get_writer()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.row_factory = None
@@ -6,25 +6,43 @@
 import os
 import sqlite3
 import uuid
+import secrets
 import asyncio
 import re
+import csv
+import io
 import json
+import functools
+import hashlib
+import logging
+import logging.handlers
+import queue
+import stat
+import tempfile
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager, suppress
 from math import ceil
-from typing import List, Optional, Dict, Set
+from typing import List, NamedTuple, Optional, Dict, Set
+
+import anyio.to_thread
 
 from fastapi import FastAPI, Request, Form, UploadFile, File, HTTPException, Body, WebSocket, WebSocketDisconnect, Depends, status, Query
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, JSONResponse, Response
+from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse, Response, StreamingResponse
+from fastapi.responses import JSONResponse as _StdJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware import Middleware
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.middleware.gzip import GZipMiddleware
 from fastapi.concurrency import run_in_threadpool
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from sqlalchemy import or_
+from sqlalchemy import or_, select, text
+from cachetools import TTLCache
 from pydantic import BaseModel, EmailStr
-from jinja2 import ChoiceLoader, FileSystemLoader  # ⭐ nuevo
+from jinja2 import ChoiceLoader, FileSystemLoader, FileSystemBytecodeCache  # ⭐ nuevo
 
 from utils import (
     extraer_texto_de_pdf,
@@ -34,8 +52,9 @@ from utils import (
     analizar_anexos
 )
 
+from db_pool import CACHED_STATEMENTS
 from database import (
-    DB_PATH,
+    get_conn,
     inicializar_bd,
     obtener_usuario_por_email,
     agregar_usuario,
@@ -49,6 +68,10 @@ from database import (
     obtener_historial,
     eliminar_del_historial,
     obtener_historial_completo,
+    obtener_ultimo_analisis,
+    obtener_historial_recientes,
+    obtener_max_historial_id,
+    obtener_historial_por_ts_o_nombre,
     crear_ticket,
     obtener_todos_los_tickets,
     obtener_tickets_por_usuario,
@@ -62,15 +85,16 @@ from database import (
     contar_no_leidos,
     ocultar_hilo,
     restaurar_hilo,
-    guardar_adjunto,
-    es_admin,
+    guardar_mensaje_con_adjuntos,
+    obtener_rol_por_email,
     iniciar_analisis_historial,
     marcar_valoracion_historial,
     tiene_valoracion_pendiente
 )
 
 # ORM (audit_logs)
-from db_orm import inicializar_bd_orm, SessionLocal, AuditLog
+from db_orm import inicializar_bd_orm, fts_auditoria_activo, SessionLocal, AuditLog, Usuario
+from db_async import AsyncSessionLocal
 
 
 # ================== TZ & helpers ==================
@@ -120,10 +144,84 @@ def _parse_dt_utc(value) -> Optional[datetime]:
     return dt.astimezone(timezone.utc)
 
 
+# ================== Logging ==================
+# Los handlers encolan el registro y un hilo aparte hace la escritura (no bloquea el event loop).
+log = logging.getLogger("pliegos")
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+
+class _JsonFormatter(logging.Formatter):
+    """LOG_FORMAT=json: una línea JSON por registro (el QueueHandler ya dejó el traceback en msg)."""
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps({
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }, ensure_ascii=False)
+
+_log_sink = logging.StreamHandler()
+if os.getenv("LOG_FORMAT", "").lower() == "json":
+    _log_sink.setFormatter(_JsonFormatter())
+else:
+    _log_sink.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_sink, respect_handler_level=True)
+if not log.handlers:
+    log.addHandler(logging.handlers.QueueHandler(_log_queue))
+    log.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    log.propagate = False
+
+
 # ================== App & Middlewares ==================
 SESSION_SECRET = os.getenv("SESSION_SECRET", "change-this-in-prod")
 
-app = FastAPI(middleware=[
+# Compresión de respuestas: Brotli si está instalado (con fallback a gzip incluido), si no gzip.
+# Ambos agregan "Vary: Accept-Encoding" y no tocan los WebSockets.
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+try:
+    from brotli_asgi import BrotliMiddleware
+    _compress_mw = Middleware(BrotliMiddleware, quality=4, minimum_size=COMPRESS_MIN_SIZE, gzip_fallback=True)
+except ImportError:  # pragma: no cover
+    _compress_mw = Middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_SIZE, compresslevel=5)
+
+# JSONResponse con orjson si está instalado (serializa en C, 3-5x más rápido que json).
+# Mismo nombre que el de fastapi: todos los `JSONResponse({...})` y los dicts devueltos
+# por los endpoints (default_response_class) pasan por acá sin tocar cada handler.
+# orjson es opcional: lo usan estas respuestas y los payloads WS (_ws_dumps).
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+if orjson is not None:
+    class JSONResponse(_StdJSONResponse):
+        def render(self, content) -> bytes:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+else:  # pragma: no cover
+    JSONResponse = _StdJSONResponse
+
+# Threadpool de AnyIO (handlers `def` + run_in_threadpool). El default de 40 hilos se agota
+# con ~50 conexiones concurrentes que tocan SQLite.
+THREADPOOL_TOKENS = int(os.getenv("THREADPOOL_TOKENS", "200"))
+
+@asynccontextmanager
+async def _lifespan(app: FastAPI):
+    """Arranque de la app; al cerrar se deshace en orden inverso (el log se apaga al final)."""
+    _log_listener.start()
+    anyio.to_thread.current_default_thread_limiter().total_tokens = THREADPOOL_TOKENS
+    _bootstrap_cal_db()
+    flusher = asyncio.create_task(_session_flusher())
+    try:
+        yield
+    finally:
+        flusher.cancel()
+        with suppress(asyncio.CancelledError):
+            await flusher
+        await run_in_threadpool(_flush_sessions_sync)
+        _log_listener.stop()
+
+app = FastAPI(default_response_class=JSONResponse, lifespan=_lifespan, middleware=[
+    # El primero de la lista es el más externo: comprime la respuesta final
+    _compress_mw,
     # Cookie de sesión más robusta y persistente
     Middleware(SessionMiddleware, secret_key=SESSION_SECRET, same_site="lax", max_age=60*60*24*30)  # 30 días
 ])
@@ -132,10 +230,7 @@ app = FastAPI(middleware=[
 def ensure_chat_tables():
     """Crea tablas de chat si no existen en usuarios.db (robustez en Render)."""
     try:
-        conn = sqlite3.connect(DB_PATH, timeout=10)
-        with conn:
-            conn.execute("PRAGMA journal_mode=WAL;")
-            conn.execute("PRAGMA foreign_keys=ON;")
+        with get_conn() as conn:
             # mensajes
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS mensajes(
@@ -147,8 +242,12 @@ def ensure_chat_tables():
                     fecha TEXT NOT NULL
                 )
             """)
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_para_leido ON mensajes(para_email, leido)")
-            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_de_para ON mensajes(de_email, para_email)")
+            # Índices compuestos según los patrones del chat (hilo ordenado por fecha, no leídos)
+            conn.execute("DROP INDEX IF EXISTS idx_mensajes_para_leido")  # reemplazado por idx_mensajes_unread
+            conn.execute("DROP INDEX IF EXISTS idx_mensajes_de_para")     # prefijo de idx_mensajes_de_para_fecha
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_thread_fecha ON mensajes(para_email, de_email, fecha DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_de_para_fecha ON mensajes(de_email, para_email, fecha DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_unread ON mensajes(para_email, leido, id DESC) WHERE leido = 0")
             # hilos ocultos
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS hilos_ocultos(
@@ -170,13 +269,14 @@ def ensure_chat_tables():
                     created_at TEXT NOT NULL
                 )
             """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_adj_mensaje ON mensajes_adjuntos(mensaje_id)")
+            # hilos_ocultos no necesita índice extra: la PK (owner_email, otro_email) ya lo cubre
+            # Estadísticas para que el planner elija los índices nuevos
+            conn.execute("ANALYZE mensajes")
+            conn.execute("ANALYZE mensajes_adjuntos")
+            conn.execute("ANALYZE hilos_ocultos")
     except Exception as e:
-        print("⚠️ ensure_chat_tables() no pudo crear tablas:", repr(e))
-    finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        log.warning("⚠️ ensure_chat_tables() no pudo crear tablas: %r", e)
 
 # Inicializa BD SQLite (usuarios, historial, tickets, mensajes, hilos_ocultos, adjuntos)
 inicializar_bd()
@@ -215,9 +315,9 @@ def ensure_default_admin():
                 actor_user_id=None,
                 ip=None
             )
-            print(f"✅ Admin inicial creado: {default_email}")
+            log.info("✅ Admin inicial creado: %s", default_email)
     except Exception as e:
-        print("⚠️ ensure_default_admin() error:", repr(e))
+        log.exception("⚠️ ensure_default_admin() error")
 
 ensure_default_admin()
 # ---------- fin bootstrap ----------
@@ -231,11 +331,15 @@ app.mount("/generated_pdfs", StaticFiles(directory="generated_pdfs"), name="gene
 templates = Jinja2Templates(directory="templates")
 templates.env.globals['os'] = os
 
-# ⭐ desactivar cache de Jinja y forzar FileSystemLoader (evita plantillas viejas en Render/CDN)
+# ⭐ FileSystemLoader explícito. Fuera de prod se re-chequean las plantillas en cada render
+# (evita UI vieja al editar); con ENV=prod se compilan una vez. El bytecode cache en disco
+# se invalida por checksum del fuente, así que nunca sirve una plantilla vieja.
+JINJA_CACHE_DIR = os.path.join(tempfile.gettempdir(), "jinja_pliegos")
 try:
+    os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
     templates.env.loader = ChoiceLoader([FileSystemLoader("templates")])
-    templates.env.auto_reload = True
-    templates.env.cache = {}
+    templates.env.auto_reload = os.getenv("ENV", "").lower() != "prod"
+    templates.env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
 except Exception:
     pass
 
@@ -253,7 +357,8 @@ templates.env.filters["ar_time"] = ar_time
 async def _no_cache_html(request, call_next):
     resp = await call_next(request)
     ctype = (resp.headers.get("content-type") or "").lower()
-    if "text/html" in ctype:
+    # Las respuestas con ETag propio (p.ej. /chat_openai_embed) manejan su caché
+    if "text/html" in ctype and "etag" not in resp.headers:
         resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
         resp.headers["Pragma"] = "no-cache"
         resp.headers["Expires"] = "0"
@@ -261,11 +366,53 @@ async def _no_cache_html(request, call_next):
 
 
 # ================== Guardas/Dependencias de auth/roles ==================
+# Cache TTL email -> rol / id / fila de usuario: la ruta de auth no consulta la BD en cada request.
+# Los endpoints que mutan usuarios llaman a _invalidar_cache_usuario(email).
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))  # segundos
+_rol_cache: TTLCache = TTLCache(maxsize=1024, ttl=AUTH_CACHE_TTL)
+_uid_cache: TTLCache = TTLCache(maxsize=1024, ttl=AUTH_CACHE_TTL)
+_user_cache: TTLCache = TTLCache(maxsize=512, ttl=AUTH_CACHE_TTL)
+_auth_cache_lock = threading.Lock()  # TTLCache no es thread-safe y los handlers sync corren en el threadpool
+_MISS = object()
+
+def _cache_get(cache: TTLCache, key: str):
+    with _auth_cache_lock:
+        return cache.get(key, _MISS)
+
+def _cache_put(cache: TTLCache, key: str, value):
+    with _auth_cache_lock:
+        cache[key] = value
+
+def _invalidar_cache_usuario(email: str):
+    key = (email or "").strip().lower()
+    with _auth_cache_lock:
+        _rol_cache.pop(key, None)
+        _uid_cache.pop(key, None)
+        _user_cache.pop(key, None)
+
+def _es_admin_cached(email: str) -> bool:
+    """Como database.es_admin, pero cacheado (TTL) por email."""
+    key = (email or "").strip().lower()
+    rol = _cache_get(_rol_cache, key)
+    if rol is _MISS:
+        rol = obtener_rol_por_email(key)
+        _cache_put(_rol_cache, key, rol)
+    return rol == "admin"
+
+def _get_user_cached(email: str):
+    """Como database.obtener_usuario_por_email, pero cacheado (TTL) por email."""
+    key = (email or "").strip().lower()
+    row = _cache_get(_user_cache, key)
+    if row is _MISS:
+        row = obtener_usuario_por_email(key)
+        _cache_put(_user_cache, key, row)
+    return row
+
 def require_auth(request: Request):
     if not request.session.get("usuario"):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
 
-def require_admin(request: Request):
+async def require_admin(request: Request):
     email = request.session.get("usuario")
     if not email:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autenticado")
@@ -273,11 +420,20 @@ def require_admin(request: Request):
     if rol == "admin":
         return
     try:
-        if es_admin(email):
+        key = email.strip().lower()
+        rol_db = _cache_get(_rol_cache, key)
+        if rol_db is _MISS:
+            async with AsyncSessionLocal() as session:
+                rol_db = (await session.execute(
+                    select(Usuario.rol).where(Usuario.email == key)
+                )).scalar_one_or_none()
+            _cache_put(_rol_cache, key, rol_db)
+        if rol_db == "admin":
             request.session["rol"] = "admin"
             return
     except Exception:
-        pass
+        # Sin esto un admin real recibe 403 y el fallo de BD no queda en ningún lado
+        log.exception("❌ require_admin: no se pudo leer el rol de %s", email)
     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Solo admins")
 
 
@@ -297,40 +453,140 @@ def _wants_html(req: Request) -> bool:
 
 
 # ================== Alert/WS manager ==================
+# Sin orjson (ver JSONResponse) caemos a json de la stdlib.
+if orjson is not None:
+    def _ws_dumps(payload: dict) -> str:
+        return orjson.dumps(payload).decode()
+else:  # pragma: no cover
+    def _ws_dumps(payload: dict) -> str:
+        return json.dumps(payload, ensure_ascii=False)
+
+# Cola de salida por socket: el writer drena hasta WS_BATCH_MAX mensajes y los manda en un solo frame
+WS_QUEUE_MAX = int(os.getenv("WS_QUEUE_MAX", "1024"))
+WS_BATCH_MAX = int(os.getenv("WS_BATCH_MAX", "64"))
+WS_BATCH_LINGER = float(os.getenv("WS_BATCH_LINGER", "0.01"))  # segundos esperando más mensajes
+
 class ConnectionManager:
+    # Registro particionado: cada shard tiene su propio lock (menos contención en reconexiones masivas)
+    SHARDS = 16  # potencia de 2 (índice por máscara)
+
     def __init__(self):
-        self._by_user: Dict[str, Set[WebSocket]] = {}
+        self._shards: List[Dict[str, Set[WebSocket]]] = [{} for _ in range(self.SHARDS)]
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(self.SHARDS)]
+        # ws -> (cola de salida, tarea writer)
+        self._outbox: Dict[WebSocket, tuple] = {}
+
+    def _idx(self, email: str) -> int:
+        return hash(email) & (self.SHARDS - 1)
 
     async def connect(self, websocket: WebSocket, email: str):
         await websocket.accept()
         email = (email or "").strip() or "anon"
-        self._by_user.setdefault(email, set()).add(websocket)
-
-    def disconnect(self, websocket: WebSocket, email: str):
+        q: asyncio.Queue = asyncio.Queue(maxsize=WS_QUEUE_MAX)
+        task = asyncio.create_task(self._writer(websocket, email, q))
+        self._outbox[websocket] = (q, task)
+        i = self._idx(email)
+        async with self._locks[i]:
+            self._shards[i].setdefault(email, set()).add(websocket)
+
+    async def disconnect(self, websocket: WebSocket, email: str):
+        i = self._idx(email)
+        async with self._locks[i]:
+            conns = self._shards[i].get(email)
+            if conns is not None:
+                conns.discard(websocket)
+                if not conns:
+                    del self._shards[i][email]
+        entry = self._outbox.pop(websocket, None)
+        if entry is not None and entry[1] is not asyncio.current_task():
+            entry[1].cancel()
+
+    async def _writer(self, websocket: WebSocket, email: str, q: asyncio.Queue):
+        """
+        Una única tarea de envío por socket: espera el primer mensaje, deja un margen corto
+        para que lleguen más y manda todo lo acumulado en un solo frame.
+        - 1 mensaje  -> el objeto tal cual (compatible con clientes viejos)
+        - N mensajes -> array JSON con los N objetos
+        """
         try:
-            if email in self._by_user and websocket in self._by_user[email]:
-                self._by_user[email].remove(websocket)
-                if not self._by_user[email]:
-                    del self._by_user[email]
+            while True:
+                batch = [await q.get()]
+                if WS_BATCH_LINGER > 0 and q.empty():
+                    try:
+                        batch.append(await asyncio.wait_for(q.get(), timeout=WS_BATCH_LINGER))
+                    except asyncio.TimeoutError:
+                        pass
+                while len(batch) < WS_BATCH_MAX:
+                    try:
+                        batch.append(q.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                # Los items ya vienen serializados: se concatenan sin volver a serializar
+                frame = batch[0] if len(batch) == 1 else "[" + ",".join(batch) + "]"
+                await websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
         except Exception:
-            pass
+            await self.disconnect(websocket, email)
 
-    async def send_to_user(self, email: str, payload: dict):
-        if not email:
-            return
-        conns = list(self._by_user.get(email, []))
-        dead = []
-        for ws in conns:
+    def _enqueue(self, websocket: WebSocket, text: str) -> bool:
+        """Encola sin bloquear; False si el socket no tiene cola o está saturado."""
+        entry = self._outbox.get(websocket)
+        if entry is None:
+            return False
+        try:
+            entry[0].put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    async def _drop(self, dead: List[tuple]):
+        """Cliente lento (cola llena) o socket ya cerrado: se descarta la conexión."""
+        for email, ws in dead:
+            await self.disconnect(ws, email)
             try:
-                await ws.send_json(payload)
+                await ws.close(code=1013)
             except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self._by_user.get(email, set()).discard(ws)
+                pass
+
+    async def _fanout(self, targets: List[tuple], payload):
+        """Serializa el payload una sola vez y lo encola en cada socket destino."""
+        if not targets:
+            return
+        text = payload if isinstance(payload, str) else _ws_dumps(payload)
+        dead = [(email, ws) for email, ws in targets if not self._enqueue(ws, text)]
+        if dead:
+            await self._drop(dead)
 
-    async def broadcast(self, payload: dict):
-        for email in list(self._by_user.keys()):
-            await self.send_to_user(email, payload)
+    async def send_to_socket(self, websocket: WebSocket, payload) -> None:
+        """Respuesta directa a un socket (p.ej. pong) por la misma cola que el resto."""
+        self._enqueue(websocket, payload if isinstance(payload, str) else _ws_dumps(payload))
+
+    async def send_to_user(self, email: str, payload):
+        """payload: dict (se serializa una vez) o str ya serializado."""
+        if not email:
+            return
+        conns = self._shards[self._idx(email)].get(email)
+        if not conns:
+            return
+        text = payload if isinstance(payload, str) else _ws_dumps(payload)
+        # Sin await entre la lectura y el recorrido: ninguna otra corrutina puede mutar
+        # el set mientras tanto, así que se itera directo (sin copiarlo ni tomar el lock).
+        dead = None
+        for ws in conns:
+            if not self._enqueue(ws, text):
+                if dead is None:
+                    dead = []
+                dead.append((email, ws))
+        if dead:
+            await self._drop(dead)
+
+    async def broadcast(self, payload):
+        targets = []
+        for i, shard in enumerate(self._shards):
+            async with self._locks[i]:
+                targets.extend((email, ws) for email, conns in shard.items() for ws in conns)
+        await self._fanout(targets, payload)
 
 manager = ConnectionManager()
 
@@ -351,14 +607,11 @@ async def ws_endpoint(websocket: WebSocket):
     try:
         while True:
             _ = await websocket.receive_text()
-            try:
-                await websocket.send_json({"event": "ws:pong", "ts": now_iso_utc()})
-            except Exception:
-                pass
+            await manager.send_to_socket(websocket, {"event": "ws:pong", "ts": now_iso_utc()})
     except WebSocketDisconnect:
-        manager.disconnect(websocket, email)
+        await manager.disconnect(websocket, email)
     except Exception:
-        manager.disconnect(websocket, email)
+        await manager.disconnect(websocket, email)
 
 async def emit_alert(email: str, title: str, body: str = "", extra: dict = None):
     payload = {"event": "alert:new", "title": title, "body": body, "ts": now_iso_utc()}
@@ -381,10 +634,10 @@ async def emit_chat_new_message(para_email: str, de_email: str, msg_id: int, pre
 CHAT_ATTACH_DIR = os.path.join("static", "chat_adjuntos")
 os.makedirs(CHAT_ATTACH_DIR, exist_ok=True)
 
-CHAT_ALLOWED_EXT = {
+CHAT_ALLOWED_EXT = frozenset({
     ".pdf", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".txt", ".csv",
     ".xlsx", ".xls", ".docx", ".doc", ".pptx"
-}
+})
 CHAT_MAX_FILES = 10
 CHAT_MAX_TOTAL_MB = 50
 
@@ -403,44 +656,193 @@ INCID_MAX_TOTAL_MB = 25
 # ================== Avatares (perfil) ==================
 AVATAR_DIR = os.path.join("static", "avatars")
 os.makedirs(AVATAR_DIR, exist_ok=True)
-AVATAR_ALLOWED_EXT = {".png", ".jpg", ".jpeg", ".webp"}
+AVATAR_ALLOWED_EXT = frozenset({".png", ".jpg", ".jpeg", ".webp"})
 AVATAR_MAX_MB = 2  # MB
+AVATAR_EXT_ORDER = (".webp", ".png", ".jpg", ".jpeg")  # prioridad si hay varias variantes
 
 
 # ================== Helpers ==================
-def _actor_info(request: Request):
+async def _actor_info(request: Request):
+    """(actor_user_id, ip) del request. Async: se usa con await o como Depends en handlers sync."""
     email = request.session.get("usuario")
-    row = obtener_usuario_por_email(email) if email else None
-    actor_user_id = row[0] if row else None
+    actor_user_id = None
+    if email:
+        key = email.strip().lower()
+        actor_user_id = _cache_get(_uid_cache, key)
+        if actor_user_id is _MISS:
+            async with AsyncSessionLocal() as session:
+                actor_user_id = (await session.execute(
+                    select(Usuario.id).where(Usuario.email == key)
+                )).scalar_one_or_none()
+            _cache_put(_uid_cache, key, actor_user_id)
     ip = request.client.host if request.client else None
     return actor_user_id, ip
 
+# ---- Usuario autenticado como dependencia (una lectura de sesión + actor por request) ----
+class CurUser(NamedTuple):
+    email: str
+    actor_user_id: Optional[int]
+    ip: Optional[str]
+
+class _NoAutenticado(Exception):
+    pass
+
+@app.exception_handler(_NoAutenticado)
+async def _no_autenticado_handler(request: Request, exc: _NoAutenticado):
+    # Mismo cuerpo que devolvían los handlers a mano ({"error": ...}, no {"detail": ...})
+    return JSONResponse({"error": "No autenticado"}, status_code=401)
+
+def session_user(request: Request) -> str:
+    """Email del usuario logueado; 401 si no hay sesión. Para handlers que no auditan."""
+    email = request.session.get("usuario")
+    if not email:
+        raise _NoAutenticado()
+    return email
+
+async def current_user(request: Request) -> CurUser:
+    """Email + (actor_user_id, ip) para auditoría; 401 si no hay sesión."""
+    email = request.session.get("usuario")
+    if not email:
+        raise _NoAutenticado()
+    actor_user_id, ip = await _actor_info(request)
+    return CurUser(email, actor_user_id, ip)
+
+def _split_ext(name: str) -> tuple:
+    """os.path.splitext con la extensión en minúsculas."""
+    base, ext = os.path.splitext(name)
+    return base, ext.lower()
+
+def _ext_de(filename: str) -> str:
+    return _split_ext(filename or "")[1]
+
 def _safe_basename(name: str) -> str:
-    base = os.path.splitext(name or "archivo")[0]
+    base = _split_ext(name or "archivo")[0]
+    # isalnum() de str: conserva á/é/í/ó/ú/ñ
     base = "".join(c for c in base if c.isalnum() or c in ("-", "_", "."))
-    base = base[:50] or "file"
-    return base
+    return base[:50] or "file"
+
+# Tabla precalculada: una sola pasada en C (mismo resultado que los dos .replace encadenados)
+_EMAIL_SAFE_TABLE = str.maketrans({"@": "_at_", ".": "_dot_"})
 
 def _email_safe(s: str) -> str:
-    return (s or "anon").replace("@", "_at_").replace(".", "_dot_")
+    return (s or "anon").translate(_EMAIL_SAFE_TABLE)
+
+# Índice en memoria {prefijo_email: ext} de AVATAR_DIR: se arma con un solo scandir al
+# importar y lo mantiene subir_avatar (único writer del directorio) -> 0 stat() por request.
+AVATAR_INDEX: Dict[str, str] = {}
 
-async def _save_upload_stream(upload: UploadFile, dst_path: str) -> int:
-    size = 0
+def _indexar_avatares():
+    found: Dict[str, List[str]] = {}
+    with os.scandir(AVATAR_DIR) as it:
+        for entry in it:
+            base, ext = _split_ext(entry.name)
+            if ext in AVATAR_ALLOWED_EXT and entry.is_file():
+                found.setdefault(base, []).append(ext)
+    AVATAR_INDEX.clear()
+    for base, exts in found.items():
+        AVATAR_INDEX[base] = min(exts, key=AVATAR_EXT_ORDER.index)
+
+_indexar_avatares()
+
+UPLOAD_COPY_BUFSIZE = 8 * 1024 * 1024  # 8 MiB por lectura
+
+def _excede_tamano(uploads, max_bytes: int) -> bool:
+    """Corte temprano por el tamaño que ya conoce Starlette (UploadFile.size), sin tocar disco."""
+    return sum((u.size or 0) for u in uploads) > max_bytes
+
+def _save_upload_stream_sync(src_file, dst_path: str, limit: int) -> int:
+    """
+    Copia el upload a dst_path en bloques de hasta UPLOAD_COPY_BUFSIZE. Si el acumulado supera
+    `limit` borra el parcial y devuelve -1 (respaldo: los handlers ya cortan con _excede_tamano).
+    """
+    src_file.seek(0)
+    total = 0
     with open(dst_path, "wb") as f:
-        while True:
-            chunk = await upload.read(1024 * 1024)
-            if not chunk:
+        # Nunca se lee más que lo que falta + 1 byte: alcanza para saber si se pasó
+        while chunk := src_file.read(min(UPLOAD_COPY_BUFSIZE, limit - total + 1)):
+            total += len(chunk)
+            if total > limit:
                 break
-            size += len(chunk)
             f.write(chunk)
-    await upload.seek(0)
-    return size
+    if total > limit:
+        _borrar_archivos([dst_path])
+        return -1
+    return total
+
+def _borrar_archivos(paths: List[str]):
+    for p in paths:
+        try:
+            os.remove(p)
+        except Exception:
+            pass
+
+def _stat_archivo(path: str) -> Optional[os.stat_result]:
+    """Un único stat(): el resultado si es un archivo regular, None si no existe o no lo es.
+    Se pasa a FileResponse(stat_result=...) para que no vuelva a hacer stat."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st if stat.S_ISREG(st.st_mode) else None
+
+# Descargas (PDFs y adjuntos): el contenido no cambia sin cambiar mtime/tamaño
+FILE_CACHE_CONTROL = "private, max-age=3600"
+
+def _etag_coincide(request: Request, etag: str) -> bool:
+    """
+    True si el If-None-Match del cliente incluye `etag` (-> responder 304 sin cuerpo).
+    Comparación débil (RFC 9110): `W/"x"` cuenta como `"x"` (proxies/compresión debilitan el
+    ETag) y `*` coincide con cualquiera.
+    """
+    inm = request.headers.get("if-none-match")
+    if not inm:
+        return False
+    etiquetas = {t.strip().removeprefix("W/") for t in inm.split(",")}
+    return "*" in etiquetas or etag.removeprefix("W/") in etiquetas
+
+def _servir_archivo(request: Request, path: str, st: os.stat_result, **kwargs) -> Response:
+    """FileResponse con el stat ya hecho + ETag (mtime_ns-tamaño); 304 si el cliente ya lo tiene."""
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    headers = {"ETag": etag, "Cache-Control": FILE_CACHE_CONTROL}
+    if _etag_coincide(request, etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, stat_result=st, headers=headers, **kwargs)
+
+# JSON consultado por polling: el cliente revalida siempre y recibe 304 si no cambió
+REVALIDATE_CACHE_CONTROL = "private, max-age=0, must-revalidate"
+
+def _etag_de(*partes) -> str:
+    """ETag corto (blake2b de 8 bytes) a partir de un token de frescura barato."""
+    return '"' + hashlib.blake2b(repr(partes).encode(), digest_size=8).hexdigest() + '"'
+
+def _save_uploads_sync(pares: List[tuple], max_bytes: int) -> Optional[List[int]]:
+    """
+    Escribe todos los (src_file, dst_path) de un request en un único viaje al threadpool.
+    Devuelve los tamaños, o None si el total supera max_bytes (borra lo ya escrito).
+    """
+    sizes, total = [], 0
+    for src_file, dst_path in pares:
+        n = _save_upload_stream_sync(src_file, dst_path, max_bytes - total)
+        if n < 0:
+            _borrar_archivos([p for _, p in pares[:len(sizes)]])
+            return None
+        sizes.append(n)
+        total += n
+    return sizes
 
 def _validate_ext(filename: str):
-    ext = os.path.splitext(filename or "")[1].lower()
+    ext = _ext_de(filename)
     if ext not in CHAT_ALLOWED_EXT:
         raise HTTPException(status_code=400, detail=f"Tipo de archivo no permitido: {ext}")
 
+# SQLite < 3.32 corta en 999 variables por sentencia: los IN (...) grandes se parten en lotes
+SQLITE_IN_CHUNK = 900
+
+def _chunks(seq, n: int = SQLITE_IN_CHUNK):
+    seq = list(seq)
+    for i in range(0, len(seq), n):
+        yield seq[i:i + n]
+
 def _build_audit_filters(q, filtros):
     if not filtros:
         return q
@@ -454,7 +856,13 @@ def _build_audit_filters(q, filtros):
         q = q.filter(AuditLog.fecha >= f"{d} 00:00:00")
     if h and hasattr(AuditLog, "fecha"):
         q = q.filter(AuditLog.fecha <= f"{h} 23:59:59")
-    if term:
+    if term and fts_auditoria_activo():
+        # Índice FTS5 (frase con prefijo): evita el LIKE '%term%' sobre N columnas
+        fts_term = '"' + term.replace('"', '""') + '"*'
+        q = q.filter(AuditLog.id.in_(
+            text("SELECT rowid FROM audit_logs_fts WHERE audit_logs_fts MATCH :t").bindparams(t=fts_term)
+        ))
+    elif term:
         like = f"%{term}%"
         ors = []
         for col in ("usuario", "nombre", "accion", "entidad", "entidad_id", "ip", "before", "after"):
@@ -479,45 +887,21 @@ def _buscar_historial_usuario(
     nombre_pdf: Optional[str] = None
 ) -> Optional[dict]:
     try:
-        items = obtener_historial_completo()
+        return obtener_historial_por_ts_o_nombre(user, timestamp=timestamp, nombre_pdf=nombre_pdf)
     except Exception:
-        items = []
-
-    user_items = [h for h in items if (h.get("usuario") == user)]
-    nombre_pdf = (nombre_pdf or "").strip()
-    timestamp = (timestamp or "").strip()
-
-    if timestamp:
-        for h in user_items:
-            if str(h.get("timestamp") or "") == timestamp:
-                return h
-    if nombre_pdf:
-        for h in user_items:
-            if (h.get("nombre_archivo") or "") == nombre_pdf:
-                return h
-    if timestamp:
-        for h in user_items:
-            ts_h = _extraer_ts_de_nombre(h.get("nombre_archivo") or "")
-            if ts_h == timestamp:
-                return h
-
-    if user_items:
-        try:
-            user_items.sort(key=lambda x: x.get("fecha",""), reverse=True)
-        except Exception:
-            pass
-        return user_items[0]
-    return None
+        return None
 
 
 # --- Config pública para el front (límites de adjuntos) ---
+_CHAT_CONFIG = {
+    "allowed_ext": sorted({e.lstrip(".") for e in CHAT_ALLOWED_EXT}),  # ya están en minúsculas
+    "max_files": CHAT_MAX_FILES,
+    "max_total_mb": CHAT_MAX_TOTAL_MB
+}
+
 @app.get("/chat/config")
 async def chat_config():
-    return {
-        "allowed_ext": sorted(list({e.lstrip(".").lower() for e in CHAT_ALLOWED_EXT})),
-        "max_files": CHAT_MAX_FILES,
-        "max_total_mb": CHAT_MAX_TOTAL_MB
-    }
+    return _CHAT_CONFIG
 
 
 # ========= Helpers para HISTORIAL en home (paginado) =========
@@ -541,7 +925,7 @@ def _historial_para_home(email: str, rol: str, q: str = "") -> List[dict]:
         data = []
 
     # Filtrar por rol: admin ve todo, usuario solo lo suyo
-    if (rol or "").lower() != "admin" and not es_admin(email):
+    if (rol or "").lower() != "admin" and not _es_admin_cached(email):
         data = [h for h in data if (h.get("usuario") or "").lower() == (email or "").lower()]
 
     # Normalizar y ordenar
@@ -582,7 +966,7 @@ def _historial_para_home(email: str, rol: str, q: str = "") -> List[dict]:
 
 # ================== Rutas base ==================
 @app.get("/", response_class=HTMLResponse)
-async def home(
+def home(
     request: Request,
     page: int = Query(default=1, ge=1),
     per_page: int = Query(default=10, ge=1, le=100),
@@ -630,38 +1014,185 @@ async def login_form(request: Request):
 # =====================================================================
 CAL_DB = "calendar.sqlite3"
 
-def cal_conn():
-    conn = sqlite3.connect(CAL_DB)
+# PRAGMAs de calendar.sqlite3 (journal_mode=WAL persiste en el archivo; el resto es por conexión)
+CAL_PRAGMAS = """
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-64000;
+    PRAGMA mmap_size=268435456;
+    PRAGMA journal_size_limit=67108864;
+    PRAGMA busy_timeout=5000;
+"""
+
+def _cal_abrir(readonly: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        CAL_DB, timeout=10, check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+    )
+    conn.executescript(CAL_PRAGMAS)
+    if readonly:
+        conn.execute("PRAGMA query_only=ON;")
     conn.row_factory = sqlite3.Row
     return conn
 
-def init_calendar_db():
-    with cal_conn() as c:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS eventos(
-                id TEXT PRIMARY KEY,
-                title TEXT NOT NULL,
-                description TEXT,
-                start TEXT NOT NULL,
-                end TEXT,
-                all_day INTEGER NOT NULL DEFAULT 0,
-                color TEXT,
-                created_by TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            )
-        """)
+# Escritor: una sola conexión de larga vida (se abre al primer uso, PRAGMAs una vez)
+# compartida entre hilos del threadpool; el lock serializa su uso.
+_cal_db: Optional[sqlite3.Connection] = None
+_cal_lock = threading.RLock()
+
+def _cal_get() -> sqlite3.Connection:
+    global _cal_db
+    if _cal_db is None:
+        _cal_db = _cal_abrir()
+    return _cal_db
+
+# Lectores (como db_pool): LIFO de conexiones query_only con la page cache caliente.
+# Con WAL leen en paralelo entre sí y con el escritor, sin tomar _cal_lock.
+CAL_POOL_READERS = max(4, os.cpu_count() or 1)
+_cal_readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue(maxsize=CAL_POOL_READERS)
+
+def _cal_tomar_lector() -> sqlite3.Connection:
+    try:
+        return _cal_readers.get_nowait()
+    except queue.Empty:
+        return _cal_abrir(readonly=True)
+
+def _cal_devolver_lector(conn: sqlite3.Connection) -> None:
+    try:
+        _cal_readers.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@contextmanager
+def cal_conn(readonly: bool = False):
+    """
+    Conexión de calendar.sqlite3.
+    - readonly=False: escritor compartido bajo lock; commit al salir, rollback si hay excepción.
+    - readonly=True: lector del pool (query_only=ON), devuelto al salir.
+    """
+    if readonly:
+        conn = _cal_tomar_lector()
+        try:
+            yield conn
+        finally:
+            _cal_devolver_lector(conn)
+        return
+
+    with _cal_lock:
+        conn = _cal_get()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+# SQL de ruta caliente de calendar.sqlite3 (login/logout, notificaciones, rating pendiente).
+# Constantes de módulo: con la conexión compartida, sqlite3 reutiliza el statement
+# preparado de su cache en vez de volver a parsear el texto en cada llamada.
+SESSION_INSERT_SQL = """
+    INSERT INTO sessions(id, user, nombre, ip, ua, login_at, last_seen, logout_at, closed_reason)
+    VALUES(?,?,?,?,?,?,?,?,?)
+"""
+SESSION_UPDATE_SQL = "UPDATE sessions SET logout_at=?, closed_reason='logout' WHERE id=?"
+SESSION_LAST_SEEN_SQL = "UPDATE sessions SET last_seen=? WHERE id=?"
+PRESENCE_UPSERT_SQL = """
+    INSERT INTO presence(user, nombre, last_seen, ip, ua)
+    VALUES(?,?,?,?,?)
+    ON CONFLICT(user) DO UPDATE SET
+        nombre=excluded.nombre,
+        last_seen=excluded.last_seen,
+        ip=excluded.ip,
+        ua=excluded.ua
+"""
+NOTIF_INSERT_SQL = "INSERT INTO notificaciones(user, titulo, cuerpo, created_at, leida) VALUES(?,?,?,?,0)"
+PR_UPSERT_SQL = """
+    INSERT INTO pending_ratings(user, historial_id, timestamp, nombre_pdf, created_at) VALUES(?,?,?,?,?)
+    ON CONFLICT(user) DO UPDATE SET
+        historial_id=excluded.historial_id,
+        timestamp=excluded.timestamp,
+        nombre_pdf=excluded.nombre_pdf,
+        created_at=excluded.created_at
+"""
+PR_GET_SQL = "SELECT historial_id, timestamp, nombre_pdf FROM pending_ratings WHERE user=? ORDER BY id DESC LIMIT 1"
+PR_DEL_SQL = "DELETE FROM pending_ratings WHERE user=?"
+
+def init_calendar_db(c: sqlite3.Connection):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS eventos(
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            description TEXT,
+            start TEXT NOT NULL,
+            end TEXT,
+            all_day INTEGER NOT NULL DEFAULT 0,
+            color TEXT,
+            created_by TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS notificaciones(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            titulo TEXT NOT NULL,
+            cuerpo TEXT,
+            created_at TEXT NOT NULL,
+            leida INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    # Listado (WHERE user=? ORDER BY id DESC): id es el rowid, el índice ya lo trae ordenado.
+    # Contador/filtro de no leídas (user=? AND leida=0): búsqueda cubierta por el compuesto.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notif_user ON notificaciones(user)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notif_user_leida ON notificaciones(user, leida)")
+
+# Búsqueda de notificaciones (FTS5, external content + triggers). Si el SQLite no trae
+# FTS5 queda desactivado y la búsqueda sigue con LIKE.
+_NOTIF_FTS_OK = False
+
+def init_notif_fts(c: sqlite3.Connection):
+    global _NOTIF_FTS_OK
+    existia = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type='table' AND name='fts_notificaciones'"
+    ).fetchone()
+    try:
         c.execute("""
-            CREATE TABLE IF NOT EXISTS notificaciones(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user TEXT NOT NULL,
-                titulo TEXT NOT NULL,
-                cuerpo TEXT,
-                created_at TEXT NOT NULL,
-                leida INTEGER NOT NULL DEFAULT 0
+            CREATE VIRTUAL TABLE IF NOT EXISTS fts_notificaciones USING fts5(
+                titulo, cuerpo,
+                content='notificaciones', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
             )
         """)
-init_calendar_db()
+    except sqlite3.OperationalError as e:
+        log.warning("⚠️ FTS5 no disponible para notificaciones: %r", e)
+        return
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_notificaciones_ai AFTER INSERT ON notificaciones BEGIN
+            INSERT INTO fts_notificaciones(rowid, titulo, cuerpo) VALUES (new.id, new.titulo, new.cuerpo);
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_notificaciones_ad AFTER DELETE ON notificaciones BEGIN
+            INSERT INTO fts_notificaciones(fts_notificaciones, rowid, titulo, cuerpo)
+            VALUES ('delete', old.id, old.titulo, old.cuerpo);
+        END
+    """)
+    # Solo si cambia el texto: marcar leídas (UPDATE de leida) no toca el índice
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS fts_notificaciones_au AFTER UPDATE OF titulo, cuerpo ON notificaciones BEGIN
+            INSERT INTO fts_notificaciones(fts_notificaciones, rowid, titulo, cuerpo)
+            VALUES ('delete', old.id, old.titulo, old.cuerpo);
+            INSERT INTO fts_notificaciones(rowid, titulo, cuerpo) VALUES (new.id, new.titulo, new.cuerpo);
+        END
+    """)
+    if not existia:
+        c.execute("INSERT INTO fts_notificaciones(fts_notificaciones) VALUES ('rebuild')")
+    _NOTIF_FTS_OK = True
+
+def _fts_prefix_query(q: str) -> str:
+    """'foo bar' -> '"foo"* "bar"*' (AND de prefijos; entre comillas: sin sintaxis FTS del usuario)."""
+    return " ".join('"' + t.replace('"', '""') + '"*' for t in q.split())
 
 def _now_iso():
     return now_iso_utc()
@@ -679,58 +1210,53 @@ def _event_row_to_dict(r: sqlite3.Row):
 
 def _notify(user: str, titulo: str, cuerpo: str = ""):
     with cal_conn() as c:
-        c.execute(
-            "INSERT INTO notificaciones(user, titulo, cuerpo, created_at, leida) VALUES(?,?,?,?,0)",
-            (user or "Desconocido", titulo, cuerpo, _now_iso())
-        )
+        c.execute(NOTIF_INSERT_SQL, (user or "Desconocido", titulo, cuerpo, _now_iso()))
 
 async def notify_async(user: str, titulo: str, cuerpo: str = ""):
-    _notify(user, titulo, cuerpo)
+    await run_in_threadpool(_notify, user, titulo, cuerpo)
     await emit_alert(user, titulo, cuerpo)
 
 
 # ====== NUEVO: rating pendiente liviano (sidecar) ======
-def init_rating_pending_db():
-    with cal_conn() as c:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS pending_ratings(
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user TEXT NOT NULL,
-                historial_id TEXT,
-                timestamp TEXT,
-                nombre_pdf TEXT,
-                created_at TEXT NOT NULL
-            )
-        """)
-        c.execute("CREATE INDEX IF NOT EXISTS idx_pending_ratings_user ON pending_ratings(user)")
-init_rating_pending_db()
+def init_rating_pending_db(c: sqlite3.Connection):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS pending_ratings(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user TEXT NOT NULL,
+            historial_id TEXT,
+            timestamp TEXT,
+            nombre_pdf TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    # Un solo pendiente por usuario: UNIQUE(user) habilita el UPSERT de _pr_add.
+    # (bases viejas: se dejan solo las filas más recientes antes de crear el índice)
+    c.execute("DELETE FROM pending_ratings WHERE id NOT IN (SELECT MAX(id) FROM pending_ratings GROUP BY user)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_pending_ratings_user_uq ON pending_ratings(user)")
+    c.execute("DROP INDEX IF EXISTS idx_pending_ratings_user")
 
 def _pr_add(user: str, historial_id: Optional[str], timestamp: str, nombre_pdf: str):
     with cal_conn() as c:
-        c.execute("DELETE FROM pending_ratings WHERE user=?", (user,))
         c.execute(
-            "INSERT INTO pending_ratings(user, historial_id, timestamp, nombre_pdf, created_at) VALUES(?,?,?,?,?)",
+            PR_UPSERT_SQL,
             (user, str(historial_id) if historial_id is not None else None, timestamp, nombre_pdf, _now_iso())
         )
 
 def _pr_get(user: str):
-    with cal_conn() as c:
-        r = c.execute(
-            "SELECT historial_id, timestamp, nombre_pdf FROM pending_ratings WHERE user=? ORDER BY id DESC LIMIT 1",
-            (user,)
-        ).fetchone()
+    with cal_conn(readonly=True) as c:
+        r = c.execute(PR_GET_SQL, (user,)).fetchone()
         if r:
             return {"historial_id": r["historial_id"], "timestamp": r["timestamp"], "nombre_pdf": r["nombre_pdf"]}
         return None
 
 def _pr_clear(user: str):
     with cal_conn() as c:
-        c.execute("DELETE FROM pending_ratings WHERE user=?", (user,))
+        c.execute(PR_DEL_SQL, (user,))
 
 
 # ================== Login/Logout ==================
 @app.post("/login")
-async def login(
+def login(
     request: Request,
     email: str = Form(...),
     password: str = Form(...),
@@ -773,24 +1299,9 @@ async def login(
         ip_s = request.client.host if request.client else None
         ua_s = request.headers.get("user-agent", "")
         now_iso = now_iso_utc()
+        # La tabla `sessions` se crea una sola vez en el arranque (init_presence_db)
         with cal_conn() as c:
-            c.execute("""
-                CREATE TABLE IF NOT EXISTS sessions(
-                    id TEXT PRIMARY KEY,
-                    user TEXT NOT NULL,
-                    nombre TEXT,
-                    ip TEXT,
-                    ua TEXT,
-                    login_at TEXT NOT NULL,
-                    last_seen TEXT NOT NULL,
-                    logout_at TEXT,
-                    closed_reason TEXT
-                )
-            """)
-            c.execute("""
-                INSERT INTO sessions(id, user, nombre, ip, ua, login_at, last_seen, logout_at, closed_reason)
-                VALUES(?,?,?,?,?,?,?,?,?)
-            """, (sid, request.session["usuario"], nombre_s, ip_s, ua_s, now_iso, now_iso, None, None))
+            c.execute(SESSION_INSERT_SQL, (sid, request.session["usuario"], nombre_s, ip_s, ua_s, now_iso, now_iso, None, None))
         return RedirectResponse("/", status_code=303)
 
     # Mensajes de error más claros
@@ -807,22 +1318,13 @@ async def login(
     )
 
 @app.post("/logout")
-async def logout_post(request: Request):
-    sid = request.session.get("sid")
-    now_iso = now_iso_utc()
-    if sid:
-        with cal_conn() as c:
-            c.execute("UPDATE sessions SET logout_at=?, closed_reason=? WHERE id=?", (now_iso, "logout", sid))
-    request.session.clear()
-    return RedirectResponse("/login", status_code=303)
-
 @app.get("/logout")
-async def logout_get(request: Request):
+def logout(request: Request):
     sid = request.session.get("sid")
-    now_iso = now_iso_utc()
     if sid:
+        _flush_sessions_sync(sid)  # el último last_seen pendiente antes de cerrar
         with cal_conn() as c:
-            c.execute("UPDATE sessions SET logout_at=?, closed_reason=? WHERE id=?", (now_iso, "logout", sid))
+            c.execute(SESSION_UPDATE_SQL, (now_iso_utc(), sid))
     request.session.clear()
     return RedirectResponse("/login", status_code=303)
 
@@ -864,7 +1366,7 @@ async def cambiar_password_post(
             status_code=400
         )
 
-    row = obtener_usuario_por_email(email)
+    row = await run_in_threadpool(obtener_usuario_por_email, email)
     if not row:
         return templates.TemplateResponse(
             "cambiar_password.html",
@@ -880,11 +1382,12 @@ async def cambiar_password_post(
             status_code=400
         )
 
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = await _actor_info(request)
     try:
-        actualizar_password(email.lower(), nueva, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(actualizar_password, email.lower(), nueva, actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(email)
     except Exception as e:
-        print("❌ cambiar_password_post:", repr(e))
+        log.exception("❌ cambiar_password_post")
         return templates.TemplateResponse(
             "cambiar_password.html",
             {"request": request, "error": "No se pudo actualizar la contraseña."},
@@ -939,18 +1442,12 @@ class RatingIn(BaseModel):
     comentario: Optional[str] = None
 
 @app.get("/api/rating/pending")
-async def rating_pending(request: Request):
+def rating_pending(request: Request):
     user = request.session.get("usuario", "")
     if not user:
         return {"pending": False}
 
     pr = _pr_get(user)
-    pend_flag = False
-    try:
-        pend_flag = bool(tiene_valoracion_pendiente(user))
-    except Exception:
-        pass
-
     if pr:
         last = pr
         try:
@@ -959,6 +1456,13 @@ async def rating_pending(request: Request):
             last["historial_id"] = None
         return {"pending": True, "last": last}
 
+    # Solo si el sidecar no respondió se consulta el historial
+    pend_flag = False
+    try:
+        pend_flag = bool(tiene_valoracion_pendiente(user))
+    except Exception:
+        pass
+
     if pend_flag:
         h = _buscar_historial_usuario(user)
         last = None
@@ -976,8 +1480,8 @@ async def rating_pending(request: Request):
     return {"pending": False, "last": None}
 
 @app.get("/api/rating/pendiente")
-async def rating_pendiente_alias(request: Request):
-    data = await rating_pending(request)
+def rating_pendiente_alias(request: Request):
+    data = rating_pending(request)
     return {"pendiente": data.get("pending", False), "last": data.get("last")}
 
 @app.post("/api/rating")
@@ -997,7 +1501,7 @@ async def enviar_rating(request: Request, payload: RatingIn):
 
     historial_id = payload.historial_id
     if not historial_id:
-        h = _buscar_historial_usuario(user, timestamp=payload.timestamp, nombre_pdf=payload.nombre_pdf)
+        h = await run_in_threadpool(_buscar_historial_usuario, user, timestamp=payload.timestamp, nombre_pdf=payload.nombre_pdf)
         if h:
             hid = h.get("historial_id") or h.get("id")  # ⭐ fix: or (no bitwise)
             if isinstance(hid, int):
@@ -1006,17 +1510,17 @@ async def enviar_rating(request: Request, payload: RatingIn):
     if not historial_id:
         return JSONResponse({"error": "No pude identificar el análisis a valorar."}, status_code=400)
 
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = await _actor_info(request)
     try:
-        marcar_valoracion_historial(historial_id, rating, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(marcar_valoracion_historial, historial_id, rating, actor_user_id=actor_user_id, ip=ip)
     except ValueError as e:
         return JSONResponse({"error": str(e)}, status_code=400)
     except Exception as e:
-        print("❌ Error enviar_rating:", repr(e))
+        log.exception("❌ enviar_rating")
         return JSONResponse({"error": "No se pudo registrar la valoración"}, status_code=500)
 
     try:
-        _pr_clear(user)
+        await run_in_threadpool(_pr_clear, user)
     except Exception:
         pass
 
@@ -1036,8 +1540,8 @@ async def analizar_pliego(request: Request, archivos: List[UploadFile] = File(..
 
     # Si hay una valoración pendiente, bloquear nuevo análisis
     try:
-        pr = _pr_get(usuario)
-        if pr or tiene_valoracion_pendiente(usuario):
+        pr = await run_in_threadpool(_pr_get, usuario)
+        if pr or await run_in_threadpool(tiene_valoracion_pendiente, usuario):
             payload = {"error": "Tienes una valoración pendiente. Califica el análisis anterior para continuar."}
             if pr:
                 payload["pending"] = True
@@ -1046,7 +1550,7 @@ async def analizar_pliego(request: Request, archivos: List[UploadFile] = File(..
             resp.headers["X-Require-Rating"] = "1"
             return resp
     except Exception as e:
-        print("⚠️ Warning al chequear pendiente:", repr(e))
+        log.warning("⚠️ Warning al chequear pendiente: %r", e)
 
     if not archivos:
         return JSONResponse({"error": "Subí al menos un archivo"}, status_code=400)
@@ -1070,7 +1574,8 @@ async def analizar_pliego(request: Request, archivos: List[UploadFile] = File(..
 
     analisis_id = uuid.uuid4().hex
     try:
-        historial_id = iniciar_analisis_historial(
+        historial_id = await run_in_threadpool(
+            iniciar_analisis_historial,
             usuario=usuario,
             nombre_archivo=nombre_archivo_pdf,
             ruta_pdf=nombre_archivo_pdf,
@@ -1078,17 +1583,17 @@ async def analizar_pliego(request: Request, archivos: List[UploadFile] = File(..
             resumen_texto=resumen
         )
     except Exception as e:
-        print("❌ Error iniciar_analisis_historial:", repr(e))
+        log.exception("❌ iniciar_analisis_historial")
         try:
-            guardar_en_historial(timestamp, usuario, nombre_archivo_pdf, nombre_archivo_pdf, resumen)
+            await run_in_threadpool(guardar_en_historial, timestamp, usuario, nombre_archivo_pdf, nombre_archivo_pdf, resumen)
         except Exception:
             pass
         historial_id = None
 
     try:
-        _pr_add(usuario, historial_id, timestamp, nombre_archivo_pdf)
+        await run_in_threadpool(_pr_add, usuario, historial_id, timestamp, nombre_archivo_pdf)
     except Exception as e:
-        print("⚠️ No se pudo registrar pending_ratings:", repr(e))
+        log.warning("⚠️ No se pudo registrar pending_ratings: %r", e)
 
     return {
         "resumen": resumen,
@@ -1104,7 +1609,7 @@ async def analizar_pliego(request: Request, archivos: List[UploadFile] = File(..
 
 # ================== Historial ==================
 @app.get("/historial")
-async def ver_historial(
+def ver_historial(
     request: Request,
     page: int = Query(default=1, ge=1),
     per_page: int = Query(default=20, ge=1, le=100),
@@ -1143,42 +1648,41 @@ async def alias_analisis():
     return RedirectResponse("/?goto=analisis", status_code=307)
 
 @app.get("/descargar/{archivo}")
-async def descargar_pdf(archivo: str):
+async def descargar_pdf(request: Request, archivo: str):
     archivo = os.path.basename(archivo)
     ruta = os.path.join("generated_pdfs", archivo)
-    if os.path.exists(ruta) and os.path.isfile(ruta):
-        return FileResponse(ruta, media_type="application/pdf", filename=archivo)
+    st = _stat_archivo(ruta)
+    if st is not None:
+        return _servir_archivo(request, ruta, st, media_type="application/pdf", filename=archivo)
     return JSONResponse({"error": "Archivo no encontrado"}, status_code=404)
 
 @app.delete("/eliminar/{timestamp}")
-async def eliminar_archivo(timestamp: str):
+def eliminar_archivo(timestamp: str):
     eliminar_del_historial(timestamp)
+    _contexto_recientes.cache_clear()  # el borrado no mueve MAX(id)
     ruta = os.path.join("generated_pdfs", f"resumen_{os.path.basename(timestamp)}.pdf")
-    if os.path.exists(ruta):
-        try:
-            os.remove(ruta)
-        except Exception:
-            pass
+    try:
+        os.unlink(ruta)
+    except OSError:
+        pass
     return {"mensaje": "Eliminado correctamente"}
 
 
 # ================== Usuario actual ==================
 @app.get("/usuario-actual")
-async def usuario_actual(request: Request):
+def usuario_actual(request: Request):
     email = request.session.get("usuario", "")
     rol = request.session.get("rol", "usuario")
-    row = obtener_usuario_por_email(email) if email else None
+    row = _get_user_cached(email) if email else None
     nombre = (row[1] if row else None) or request.session.get("nombre") or (email or "Desconocido")
 
     # Buscar avatar si existe
     avatar_url = ""
     if email:
         prefix = _email_safe(email)
-        for ext in (".webp", ".png", ".jpg", ".jpeg"):
-            p = os.path.join(AVATAR_DIR, prefix + ext)
-            if os.path.isfile(p):
-                avatar_url = f"/{p.replace(os.sep, '/')}"
-                break
+        ext = AVATAR_INDEX.get(prefix)
+        if ext:
+            avatar_url = f"/{os.path.join(AVATAR_DIR, prefix + ext).replace(os.sep, '/')}"
 
     return {
         "usuario": email or "Desconocido",
@@ -1196,29 +1700,37 @@ async def subir_avatar(request: Request, avatar: UploadFile = File(...)):
         return JSONResponse({"error": "No autenticado"}, status_code=401)
 
     orig = avatar.filename or ""
-    ext = os.path.splitext(orig)[1].lower()
+    ext = _ext_de(orig)
     if ext not in AVATAR_ALLOWED_EXT:
         return JSONResponse({"error": f"Formato no permitido: {ext}"}, status_code=400)
 
-    data = await avatar.read()
-    size_mb = len(data) / (1024 * 1024)
-    if size_mb > AVATAR_MAX_MB:
+    max_bytes = AVATAR_MAX_MB * 1024 * 1024
+    if _excede_tamano([avatar], max_bytes):
         return JSONResponse({"error": f"Máximo {AVATAR_MAX_MB} MB"}, status_code=400)
 
     prefix = _email_safe(email)
     dst = os.path.join(AVATAR_DIR, prefix + ext)
 
-    # elimina variantes anteriores (si existían)
-    for e in (".webp", ".png", ".jpg", ".jpeg"):
-        p = os.path.join(AVATAR_DIR, prefix + e)
-        if os.path.isfile(p) and p != dst:
-            try:
-                os.remove(p)
-            except Exception:
-                pass
-
-    with open(dst, "wb") as f:
-        f.write(data)
+    def _write() -> bool:
+        # Se copia con tope a un temporal (nunca entero en RAM) y se reemplaza al final
+        tmp = dst + ".part"
+        if _save_upload_stream_sync(avatar.file, tmp, max_bytes) < 0:
+            return False
+        os.replace(tmp, dst)
+        # elimina variantes anteriores con otra extensión: un solo scandir, unlink solo de lo que existe
+        keep = prefix + ext
+        with os.scandir(AVATAR_DIR) as it:
+            for entry in it:
+                n = entry.name
+                if n.startswith(prefix + ".") and n != keep and not n.endswith(".part"):
+                    try:
+                        os.unlink(entry.path)
+                    except OSError:
+                        pass
+        AVATAR_INDEX[prefix] = ext
+        return True
+    if not await run_in_threadpool(_write):
+        return JSONResponse({"error": f"Máximo {AVATAR_MAX_MB} MB"}, status_code=400)
 
     url = f"/{dst.replace(os.sep, '/')}"
     try:
@@ -1288,21 +1800,30 @@ async def debug_whoami(request: Request):
 # =========================
 
 # ================== API puente (Chat OpenAI) ==================
-@app.post("/chat-openai")
-async def chat_openai(request: Request):
-    data = await request.json()
-    mensaje = data.get("mensaje", "")
-    usuario_actual = request.session.get("usuario", "Desconocido")
+# Cuántos análisis recientes entran al contexto (antes: todo el historial)
+CHAT_CONTEXTO_MAX = int(os.getenv("CHAT_CONTEXTO_MAX", "20"))
 
+@functools.lru_cache(maxsize=1)
+def _contexto_recientes(ultimo_id: int) -> str:
+    """Bloque "Historial reciente" del contexto. historial solo crece por INSERT, así que el
+    mayor id identifica la versión: mientras no cambie se reutiliza el string ya armado."""
     try:
-        historial = obtener_historial_completo()
+        recientes = obtener_historial_recientes(CHAT_CONTEXTO_MAX)
     except Exception:
-        historial = []
-
-    ultimo_analisis_usuario = next(
-        (h for h in historial if h.get("usuario") == usuario_actual and h.get("resumen")),
-        None
+        recientes = []
+    return "\n".join(
+        f"- [{h.get('fecha')}] {h.get('usuario')} analizó '{h.get('nombre_archivo')}' y obtuvo:\n{h.get('resumen')}\n"
+        for h in recientes
     )
+
+def _contexto_chat_openai(usuario_actual: str) -> str:
+    """Contexto para responder_chat_openai: último análisis del usuario + los N más recientes."""
+    try:
+        ultimo_analisis_usuario = obtener_ultimo_analisis(usuario_actual)
+        contexto_general = _contexto_recientes(obtener_max_historial_id())
+    except Exception:
+        ultimo_analisis_usuario, contexto_general = None, ""
+
     if ultimo_analisis_usuario:
         ultimo_resumen = f""" 📌 Último análisis del usuario actual:
 - Fecha: {ultimo_analisis_usuario.get('fecha')}
@@ -1312,11 +1833,15 @@ async def chat_openai(request: Request):
     else:
         ultimo_resumen = "(El usuario aún no tiene análisis registrados.)"
 
-    contexto_general = "\n".join([
-        f"- [{h.get('fecha')}] {h.get('usuario')} analizó '{h.get('nombre_archivo')}' y obtuvo:\n{h.get('resumen')}\n"
-        for h in historial if h.get("resumen")
-    ])
-    contexto = f"{ultimo_resumen}\n\n📚 Historial completo:\n{contexto_general}"
+    return f"{ultimo_resumen}\n\n📚 Historial reciente:\n{contexto_general}"
+
+@app.post("/chat-openai")
+async def chat_openai(request: Request):
+    data = await request.json()
+    mensaje = data.get("mensaje", "")
+    usuario_actual = request.session.get("usuario", "Desconocido")
+
+    contexto = await run_in_threadpool(_contexto_chat_openai, usuario_actual)
 
     respuesta = await run_in_threadpool(responder_chat_openai, mensaje, contexto, usuario_actual)
     return JSONResponse({"respuesta": respuesta})
@@ -1329,40 +1854,15 @@ async def api_chat_openai(request: Request, payload: dict = Body(...)):
     if not mensaje:
         return JSONResponse({"reply": "Decime qué necesitás revisar del pliego 👌"})
 
-    try:
-        historial = obtener_historial_completo()
-    except Exception:
-        historial = []
-
-    ultimo_analisis_usuario = next(
-        (h for h in historial if h.get("usuario") == usuario_actual and h.get("resumen")),
-        None
-    )
-    if ultimo_analisis_usuario:
-        ultimo_resumen = f""" 📌 Último análisis del usuario actual:
-- Fecha: {ultimo_analisis_usuario.get('fecha')}
-- Archivo: {ultimo_analisis_usuario.get('nombre_archivo')}
-- Resumen: {ultimo_analisis_usuario.get('resumen')}
-"""
-    else:
-        ultimo_resumen = "(El usuario aún no tiene análisis registrados.)"
-
-    contexto_general = "\n".join([
-        f"- [{h.get('fecha')}] {h.get('usuario')} analizó '{h.get('nombre_archivo')}' y obtuvo:\n{h.get('resumen')}\n"
-        for h in historial if h.get("resumen")
-    ])
-    contexto = f"{ultimo_resumen}\n\n📚 Historial completo:\n{contexto_general}"
+    contexto = await run_in_threadpool(_contexto_chat_openai, usuario_actual)
 
     respuesta = await run_in_threadpool(responder_chat_openai, mensaje, contexto, usuario_actual)
     return JSONResponse({"reply": respuesta})
 
 
 # ===== Mini vista embebida para el widget del topbar/FAB =====
-@app.get("/chat_openai_embed", response_class=HTMLResponse)
-async def chat_openai_embed(request: Request):
-    if not request.session.get("usuario"):
-        return HTMLResponse("<div style='padding:12px'>Iniciá sesión para usar el chat.</div>")
-    html = """<!doctype html><html><head>
+# HTML estático: se codifica una sola vez al importar y se sirve con ETag (304 si no cambió)
+_CHAT_EMBED_HTML = """<!doctype html><html><head>
 <meta charset='utf-8'><meta name='viewport' content='width=device-width,initial-scale=1'>
 <link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.3/dist/css/bootstrap.min.css">
 <style>#t{ resize:none; min-height:42px; max-height:150px; }</style>
@@ -1401,8 +1901,17 @@ async def chat_openai_embed(request: Request):
  ta.addEventListener('keydown', (e)=>{ if(e.key==='Enter' && !e.shiftKey){ e.preventDefault(); send(); } });
  btn.addEventListener('click', (e)=>{ e.preventDefault(); send(); });
 </script>
-</body></html>"""
-    return HTMLResponse(html)
+</body></html>""".encode("utf-8")
+_CHAT_EMBED_ETAG = '"' + hashlib.md5(_CHAT_EMBED_HTML).hexdigest() + '"'
+_CHAT_EMBED_HEADERS = {"ETag": _CHAT_EMBED_ETAG, "Cache-Control": "private, max-age=300"}
+
+@app.get("/chat_openai_embed", response_class=HTMLResponse)
+async def chat_openai_embed(request: Request):
+    if not request.session.get("usuario"):
+        return HTMLResponse("<div style='padding:12px'>Iniciá sesión para usar el chat.</div>")
+    if _etag_coincide(request, _CHAT_EMBED_ETAG):
+        return Response(status_code=304, headers=_CHAT_EMBED_HEADERS)
+    return HTMLResponse(_CHAT_EMBED_HTML, headers=_CHAT_EMBED_HEADERS)
 
 
 # ================== Chat interno (UI) ==================
@@ -1456,7 +1965,7 @@ def _user_row_to_dict(u):
     return {"id": None, "nombre": "", "email": "", "rol": "usuario", "activo": 0}
 
 @app.get("/api/usuarios")
-async def api_buscar_usuarios(request: Request, term: str = "", limit: int = 8):
+def api_buscar_usuarios(request: Request, term: str = "", limit: int = 8):
     if not request.session.get("usuario"):
         return JSONResponse({"error": "No autenticado"}, status_code=401)
     term = (term or "").strip()
@@ -1467,29 +1976,26 @@ async def api_buscar_usuarios(request: Request, term: str = "", limit: int = 8):
         norm = [_user_row_to_dict(u) for u in raw]
         return {"items": [{"id": u["id"], "nombre": u["nombre"], "email": u["email"]} for u in norm]}
     except Exception as e:
-        print("❌ Error api_buscar_usuarios:", repr(e))
+        log.exception("❌ api_buscar_usuarios")
         return JSONResponse({"error": "No se pudo completar la búsqueda"}, status_code=500)
 
 @app.post("/chat/enviar")
-async def chat_enviar(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
+async def chat_enviar(request: Request, cu: CurUser = Depends(current_user)):
     data = await request.json()
     para = data.get("para")
     texto = data.get("texto", "").strip()
     if not para or not texto:
         return JSONResponse({"error": "Faltan campos: para, texto"}, status_code=400)
-    de = request.session.get("usuario")
-    actor_user_id, ip = _actor_info(request)
+    de = cu.email
     try:
-        msg_id = enviar_mensaje(de_email=de, para_email=para, texto=texto, actor_user_id=actor_user_id, ip=ip)
+        msg_id = await run_in_threadpool(enviar_mensaje, de_email=de, para_email=para, texto=texto, actor_user_id=cu.actor_user_id, ip=cu.ip)
         await emit_chat_new_message(para_email=para, de_email=de, msg_id=msg_id, preview=texto)
         return JSONResponse({"ok": True, "id": msg_id})
     except Exception as e:
         if _is_no_table_error(e):
-            ensure_chat_tables()
+            await run_in_threadpool(ensure_chat_tables)
             return JSONResponse({"ok": False, "error": "Inicialicé las tablas de chat, intentá de nuevo."}, status_code=503)
-        print("❌ Error chat_enviar:", repr(e))
+        log.exception("❌ chat_enviar")
         return JSONResponse({"error": "No se pudo enviar el mensaje"}, status_code=500)
 
 @app.post("/chat/enviar-archivos")
@@ -1497,56 +2003,54 @@ async def chat_enviar_archivos(
     request: Request,
     para: str = Form(...),
     texto: str = Form(default=""),
-    archivos: List[UploadFile] = File(default=[])
+    archivos: List[UploadFile] = File(default=[]),
+    cu: CurUser = Depends(current_user),
 ):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
-
-    de = request.session.get("usuario")
+    de = cu.email
     files = [a for a in archivos if a and a.filename]
     if len(files) > CHAT_MAX_FILES:
         return JSONResponse({"error": f"Máximo {CHAT_MAX_FILES} archivos por mensaje"}, status_code=400)
 
-    actor_user_id, ip = _actor_info(request)
-    try:
-        msg_id = enviar_mensaje(de_email=de, para_email=para, texto=texto or "", actor_user_id=actor_user_id, ip=ip)
-    except Exception as e:
-        if _is_no_table_error(e):
-            ensure_chat_tables()
-            return JSONResponse({"ok": False, "error": "Inicialicé las tablas de chat, intentá de nuevo."}, status_code=503)
-        print("❌ Error creando mensaje:", repr(e))
-        return JSONResponse({"error": "No se pudo crear el mensaje"}, status_code=500)
+    for archivo in files:
+        _validate_ext(archivo.filename)
 
+    # 1) Archivos a disco (los nombres no dependen del id del mensaje)
     ts = now_stamp_ar()
-    total_bytes = 0
+    names = []
     for i, archivo in enumerate(files, start=1):
         orig = archivo.filename
-        _validate_ext(orig)
-        ext = os.path.splitext(orig)[1].lower()
+        ext = _ext_de(orig)
         base = _safe_basename(orig)
-        safe_name = f"{ts}_{de.replace('@','_at_')}_{i:02d}_{base}{ext}"
-        path = os.path.join(CHAT_ATTACH_DIR, safe_name)
-        written = await _save_upload_stream(archivo, path)
-        total_bytes += written
+        names.append(f"{ts}_{de.replace('@','_at_')}_{i:02d}_{base}{ext}")
+    paths = [os.path.join(CHAT_ATTACH_DIR, n) for n in names]
+
+    # ✅ Límite correcto del chat (todas las escrituras en un solo viaje al threadpool)
+    if _excede_tamano(files, CHAT_MAX_TOTAL_MB * 1024 * 1024):
+        return JSONResponse({"error": f"Tamaño total supera {CHAT_MAX_TOTAL_MB} MB"}, status_code=400)
+    sizes = await run_in_threadpool(
+        _save_uploads_sync, [(a.file, p) for a, p in zip(files, paths)], CHAT_MAX_TOTAL_MB * 1024 * 1024
+    )
+    if sizes is None:
+        return JSONResponse({"error": f"Tamaño total supera {CHAT_MAX_TOTAL_MB} MB"}, status_code=400)
 
-        # ✅ Límite correcto del chat
-        if (total_bytes / (1024 * 1024)) > CHAT_MAX_TOTAL_MB:
-            try:
-                os.remove(path)
-            except Exception:
-                pass
-            return JSONResponse({"error": f"Tamaño total supera {CHAT_MAX_TOTAL_MB} MB"}, status_code=400)
+    adjuntos = [
+        (name, archivo.filename, archivo.content_type or "", size)
+        for name, archivo, size in zip(names, files, sizes)
+    ]
 
-        try:
-            guardar_adjunto(
-                mensaje_id=msg_id,
-                filename=safe_name,
-                original=orig,
-                mime=archivo.content_type or "",
-                size=written
-            )
-        except Exception as e:
-            print("❌ Error guardar_adjunto:", repr(e))
+    # 2) Mensaje + adjuntos en una sola transacción
+    try:
+        msg_id = await run_in_threadpool(
+            guardar_mensaje_con_adjuntos, de, para, texto or "", adjuntos,
+            actor_user_id=cu.actor_user_id, ip=cu.ip
+        )
+    except Exception as e:
+        _borrar_archivos(paths)
+        if _is_no_table_error(e):
+            await run_in_threadpool(ensure_chat_tables)
+            return JSONResponse({"ok": False, "error": "Inicialicé las tablas de chat, intentá de nuevo."}, status_code=503)
+        log.exception("❌ Error creando mensaje")
+        return JSONResponse({"error": "No se pudo crear el mensaje"}, status_code=500)
 
     await emit_chat_new_message(para_email=para, de_email=de, msg_id=msg_id, preview=(texto or "[Adjuntos]"))
     return JSONResponse({"ok": True, "id": msg_id})
@@ -1556,26 +2060,23 @@ async def chat_enviar_archivo(
     request: Request,
     para: str = Form(...),
     texto: str = Form(default=""),
-    archivo: UploadFile = File(...)
+    archivo: UploadFile = File(...),
+    cu: CurUser = Depends(current_user),
 ):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
     archivos = [archivo] if (archivo and getattr(archivo, "filename", None)) else []
-    return await chat_enviar_archivos(request, para=para, texto=texto, archivos=archivos)
+    return await chat_enviar_archivos(request, para=para, texto=texto, archivos=archivos, cu=cu)
 
 @app.get("/chat/adjunto/{filename}")
-async def chat_adjunto(filename: str):
+async def chat_adjunto(request: Request, filename: str):
     filename = os.path.basename(filename)
     path = os.path.join(CHAT_ATTACH_DIR, filename)
-    if not os.path.isfile(path):
+    st = _stat_archivo(path)
+    if st is None:
         return JSONResponse({"error": "No encontrado"}, status_code=404)
-    return FileResponse(path)
+    return _servir_archivo(request, path, st)
 
 @app.get("/chat/hilos")
-async def chat_hilos(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
-    yo = request.session.get("usuario")
+def chat_hilos(yo: str = Depends(session_user)):
     try:
         hilos = obtener_hilos_para(yo)
         return JSONResponse({"hilos": hilos})
@@ -1583,14 +2084,11 @@ async def chat_hilos(request: Request):
         if _is_no_table_error(e):
             ensure_chat_tables()
             return JSONResponse({"hilos": []})
-        print("❌ Error chat_hilos:", repr(e))
+        log.exception("❌ chat_hilos")
         return JSONResponse({"error": "No se pudieron obtener los hilos"}, status_code=500)
 
 @app.get("/chat/mensajes")
-async def chat_mensajes(request: Request, con: str, limit: int = 100):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
-    yo = request.session.get("usuario")
+def chat_mensajes(con: str, limit: int = 100, yo: str = Depends(session_user)):
     if not con:
         return JSONResponse({"error": "Falta parámetro 'con' (email del contacto)"}, status_code=400)
     try:
@@ -1600,33 +2098,27 @@ async def chat_mensajes(request: Request, con: str, limit: int = 100):
         if _is_no_table_error(e):
             ensure_chat_tables()
             return JSONResponse({"entre": [yo, con], "mensajes": []})
-        print("❌ Error chat_mensajes:", repr(e))
+        log.exception("❌ chat_mensajes")
         return JSONResponse({"error": "No se pudieron obtener los mensajes"}, status_code=500)
 
 @app.post("/chat/marcar-leidos")
-async def chat_marcar_leidos(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
+async def chat_marcar_leidos(request: Request, yo: str = Depends(session_user)):
     data = await request.json()
     de = data.get("de")
-    yo = request.session.get("usuario")
     if not de:
         return JSONResponse({"error": "Falta 'de' (email del contacto)"}, status_code=400)
     try:
-        marcar_mensajes_leidos(de_email=de, para_email=yo)
+        await run_in_threadpool(marcar_mensajes_leidos, de_email=de, para_email=yo)
         return JSONResponse({"ok": True})
     except Exception as e:
         if _is_no_table_error(e):
-            ensure_chat_tables()
+            await run_in_threadpool(ensure_chat_tables)
             return JSONResponse({"ok": True})
-        print("❌ Error chat_marcar_leidos:", repr(e))
+        log.exception("❌ chat_marcar_leidos")
         return JSONResponse({"error": "No se pudo marcar como leídos"}, status_code=500)
 
 @app.get("/chat/no-leidos")
-async def chat_no_leidos(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
-    yo = request.session.get("usuario")
+def chat_no_leidos(yo: str = Depends(session_user)):
     try:
         total = contar_no_leidos(yo)
         return JSONResponse({"no_leidos": total})
@@ -1634,73 +2126,61 @@ async def chat_no_leidos(request: Request):
         if _is_no_table_error(e):
             ensure_chat_tables()
             return JSONResponse({"no_leidos": 0})
-        print("❌ Error chat_no_leidos:", repr(e))
+        log.exception("❌ chat_no_leidos")
         return JSONResponse({"error": "No se pudo obtener el conteo"}, status_code=500)
 
 @app.post("/chat/ocultar")
-async def chat_ocultar(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
+async def chat_ocultar(request: Request, cu: CurUser = Depends(current_user)):
     data = await request.json()
     con = (data or {}).get("con")
     if not con:
         return JSONResponse({"error": "Falta 'con' (email del contacto)"}, status_code=400)
-    yo = request.session.get("usuario")
-    actor_user_id, ip = _actor_info(request)
     try:
-        ocultar_hilo(owner_email=yo, otro_email=con, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(ocultar_hilo, owner_email=cu.email, otro_email=con, actor_user_id=cu.actor_user_id, ip=cu.ip)
         return JSONResponse({"ok": True})
     except Exception as e:
         if _is_no_table_error(e):
-            ensure_chat_tables()
+            await run_in_threadpool(ensure_chat_tables)
             return JSONResponse({"ok": True})
-        print("❌ Error chat_ocultar:", repr(e))
+        log.exception("❌ chat_ocultar")
         return JSONResponse({"error": "No se pudo ocultar el hilo"}, status_code=500)
 
 @app.post("/chat/restaurar")
-async def chat_restaurar(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
+async def chat_restaurar(request: Request, cu: CurUser = Depends(current_user)):
     data = await request.json()
     con = (data or {}).get("con")
     if not con:
         return JSONResponse({"error": "Falta 'con' (email del contacto)"}, status_code=400)
-    yo = request.session.get("usuario")
-    actor_user_id, ip = _actor_info(request)
     try:
-        restaurar_hilo(owner_email=yo, otro_email=con, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(restaurar_hilo, owner_email=cu.email, otro_email=con, actor_user_id=cu.actor_user_id, ip=cu.ip)
         return JSONResponse({"ok": True})
     except Exception as e:
         if _is_no_table_error(e):
-            ensure_chat_tables()
+            await run_in_threadpool(ensure_chat_tables)
             return JSONResponse({"ok": True})
-        print("❌ Error chat_restaurar:", repr(e))
+        log.exception("❌ chat_restaurar")
         return JSONResponse({"error": "No se pudo restaurar el hilo"}, status_code=500)
 
 @app.post("/chat/abrir")
-async def chat_abrir(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error": "No autenticado"}, status_code=401)
+async def chat_abrir(request: Request, cu: CurUser = Depends(current_user)):
     data = await request.json()
     con = (data or {}).get("con")
     if not con:
         return JSONResponse({"error": "Falta 'con' (email del contacto)"}, status_code=400)
-    yo = request.session.get("usuario")
-    actor_user_id, ip = _actor_info(request)
     try:
-        restaurar_hilo(owner_email=yo, otro_email=con, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(restaurar_hilo, owner_email=cu.email, otro_email=con, actor_user_id=cu.actor_user_id, ip=cu.ip)
         return JSONResponse({"ok": True})
     except Exception as e:
         if _is_no_table_error(e):
-            ensure_chat_tables()
+            await run_in_threadpool(ensure_chat_tables)
             return JSONResponse({"ok": True})
-        print("❌ Error chat_abrir:", repr(e))
+        log.exception("❌ chat_abrir")
         return JSONResponse({"error": "No se pudo abrir el hilo"}, status_code=500)
 
 
 # ================== Auditoría (vista audit_logs) ==================
 @app.get("/auditoria", response_class=HTMLResponse, dependencies=[Depends(require_admin)])
-async def ver_auditoria(request: Request):
+def ver_auditoria(request: Request):
     logs = obtener_auditoria()
     return templates.TemplateResponse("auditoria.html", {
         "request": request,
@@ -1747,13 +2227,12 @@ class AdminRoleIn(BaseModel):
     email: EmailStr
     rol: str  # "admin" | "usuario" | "Administrador" | "Usuario" | "borrado"
 
-@app.get("/api/admin/users")
-async def admin_users_list(request: Request, q: str = "", limit: int = 500):
-    require_admin(request)
+@app.get("/api/admin/users", dependencies=[Depends(require_admin)])
+def admin_users_list(request: Request, q: str = "", limit: int = 500):
     try:
         raw = listar_usuarios() or []
     except Exception as e:
-        print("❌ admin_users_list/listar_usuarios:", repr(e))
+        log.exception("❌ admin_users_list/listar_usuarios")
         return {"items": []}
 
     items = [_user_row_to_dict(u) for u in raw]
@@ -1763,14 +2242,13 @@ async def admin_users_list(request: Request, q: str = "", limit: int = 500):
     return {"items": items[:limit]}
 
 # alias de compatibilidad
-@app.get("/api/usuarios/list")
-async def admin_users_list_alias(request: Request, q: str = "", limit: int = 500):
-    return await admin_users_list(request, q=q, limit=limit)
-
-@app.post("/api/admin/users")
-async def admin_users_create(request: Request, payload: AdminUserCreate):
-    require_admin(request)
-    actor_user_id, ip = _actor_info(request)
+@app.get("/api/usuarios/list", dependencies=[Depends(require_admin)])
+def admin_users_list_alias(request: Request, q: str = "", limit: int = 500):
+    return admin_users_list(request, q=q, limit=limit)
+
+@app.post("/api/admin/users", dependencies=[Depends(require_admin)])
+def admin_users_create(request: Request, payload: AdminUserCreate, actor: tuple = Depends(_actor_info)):
+    actor_user_id, ip = actor
     email = payload.email.lower()
     if obtener_usuario_por_email(email):
         return JSONResponse({"error": "El email ya existe"}, status_code=409)
@@ -1783,60 +2261,61 @@ async def admin_users_create(request: Request, payload: AdminUserCreate):
             actor_user_id=actor_user_id,
             ip=ip
         )
+        _invalidar_cache_usuario(email)
         return {"ok": True}
     except Exception as e:
-        print("❌ admin_users_create:", repr(e))
+        log.exception("❌ admin_users_create")
         return JSONResponse({"error": "No se pudo crear el usuario"}, status_code=500)
 
 # alias de compatibilidad
-@app.post("/api/usuarios/crear")
-async def admin_users_create_alias(request: Request, payload: AdminUserCreate):
-    return await admin_users_create(request, payload)
-
-@app.post("/api/admin/users/password")
-async def admin_users_password(request: Request, payload: AdminPasswordIn):
-    require_admin(request)
-    actor_user_id, ip = _actor_info(request)
+@app.post("/api/usuarios/crear", dependencies=[Depends(require_admin)])
+def admin_users_create_alias(request: Request, payload: AdminUserCreate, actor: tuple = Depends(_actor_info)):
+    return admin_users_create(request, payload, actor)
+
+@app.post("/api/admin/users/password", dependencies=[Depends(require_admin)])
+def admin_users_password(request: Request, payload: AdminPasswordIn, actor: tuple = Depends(_actor_info)):
+    actor_user_id, ip = actor
     try:
         actualizar_password(payload.email.lower(), payload.password, actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(payload.email)
         return {"ok": True}
     except Exception as e:
-        print("❌ admin_users_password:", repr(e))
+        log.exception("❌ admin_users_password")
         return JSONResponse({"error": "No se pudo actualizar la contraseña"}, status_code=500)
 
-@app.post("/api/admin/users/toggle")
-async def admin_users_toggle(request: Request, payload: AdminToggleIn):
-    require_admin(request)
-    actor_user_id, ip = _actor_info(request)
+@app.post("/api/admin/users/toggle", dependencies=[Depends(require_admin)])
+def admin_users_toggle(request: Request, payload: AdminToggleIn, actor: tuple = Depends(_actor_info)):
+    actor_user_id, ip = actor
     try:
         cambiar_estado_usuario(payload.email.lower(), 1 if payload.activo else 0, actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(payload.email)
         return {"ok": True}
     except Exception as e:
-        print("❌ admin_users_toggle:", repr(e))
+        log.exception("❌ admin_users_toggle")
         return JSONResponse({"error": "No se pudo cambiar el estado"}, status_code=500)
 
-@app.post("/api/admin/users/role")
-async def admin_users_role(request: Request, payload: AdminRoleIn):
-    require_admin(request)
-    actor_user_id, ip = _actor_info(request)
+@app.post("/api/admin/users/role", dependencies=[Depends(require_admin)])
+def admin_users_role(request: Request, payload: AdminRoleIn, actor: tuple = Depends(_actor_info)):
+    actor_user_id, ip = actor
     try:
         ok = cambiar_rol(payload.email.lower(), _norm_rol(payload.rol), actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(payload.email)
         if not ok:
             return JSONResponse({"error": "Usuario no encontrado"}, status_code=404)
         return {"ok": True}
     except Exception as e:
-        print("❌ admin_users_role:", repr(e))
+        log.exception("❌ admin_users_role")
         return JSONResponse({"error": "No se pudo cambiar el rol"}, status_code=500)
 
-@app.delete("/api/admin/users/{email:path}")
-async def admin_users_delete(request: Request, email: str, hard: bool = Query(default=False)):
-    require_admin(request)
-    actor_user_id, ip = _actor_info(request)
+@app.delete("/api/admin/users/{email:path}", dependencies=[Depends(require_admin)])
+def admin_users_delete(request: Request, email: str, hard: bool = Query(default=False), actor: tuple = Depends(_actor_info)):
+    actor_user_id, ip = actor
     try:
         borrar_usuario(email.lower(), actor_user_id=actor_user_id, ip=ip, soft=(not hard))
+        _invalidar_cache_usuario(email)
         return {"ok": True}
     except Exception as e:
-        print("❌ admin_users_delete:", repr(e))
+        log.exception("❌ admin_users_delete")
         return JSONResponse({"error": "No se pudo eliminar el usuario"}, status_code=500)
 
 
@@ -1855,12 +2334,12 @@ async def _json_or_form(request: Request) -> dict:
     except Exception:
         return {}
 
-@app.get("/admin/usuarios")
-async def legacy_admin_users(request: Request, q: str = "", limit: int = 500):
+@app.get("/admin/usuarios", dependencies=[Depends(require_admin)])
+def legacy_admin_users(request: Request, q: str = "", limit: int = 500):
     # Alias de /api/admin/users
-    return await admin_users_list(request, q=q, limit=limit)
+    return admin_users_list(request, q=q, limit=limit)
 
-@app.post("/admin/crear-usuario")
+@app.post("/admin/crear-usuario", dependencies=[Depends(require_admin)])
 async def legacy_admin_create_user(request: Request):
     # Alias de /api/admin/users (POST)
     data = await _json_or_form(request)
@@ -1869,10 +2348,10 @@ async def legacy_admin_create_user(request: Request):
         email=(data.get("email") or "").strip(),
         rol=(data.get("rol") or "usuario").strip()
     )
-    return await admin_users_create(request, payload)
+    return await run_in_threadpool(admin_users_create, request, payload, await _actor_info(request))
 
-@app.post("/admin/usuarios/password")
-@app.post("/admin/blanquear-password")
+@app.post("/admin/usuarios/password", dependencies=[Depends(require_admin)])
+@app.post("/admin/blanquear-password", dependencies=[Depends(require_admin)])
 async def legacy_admin_password(request: Request):
     data = await _json_or_form(request)
     # Si no llega contraseña, usar DEFAULT_NEW_USER_PASSWORD
@@ -1881,9 +2360,9 @@ async def legacy_admin_password(request: Request):
         email=(data.get("email") or "").strip(),
         password=new_pwd
     )
-    return await admin_users_password(request, payload)
+    return await run_in_threadpool(admin_users_password, request, payload, await _actor_info(request))
 
-@app.post("/admin/usuarios/toggle")
+@app.post("/admin/usuarios/toggle", dependencies=[Depends(require_admin)])
 async def legacy_admin_toggle(request: Request):
     data = await _json_or_form(request)
     activo_raw = str(data.get("activo", "")).lower()
@@ -1892,54 +2371,56 @@ async def legacy_admin_toggle(request: Request):
         email=(data.get("email") or "").strip(),
         activo=activo
     )
-    return await admin_users_toggle(request, payload)
+    return await run_in_threadpool(admin_users_toggle, request, payload, await _actor_info(request))
 
-@app.post("/admin/usuarios/rol")
+@app.post("/admin/usuarios/rol", dependencies=[Depends(require_admin)])
 async def legacy_admin_role(request: Request):
     data = await _json_or_form(request)
     payload = AdminRoleIn(
         email=(data.get("email") or "").strip(),
         rol=(data.get("rol") or "").strip()
     )
-    return await admin_users_role(request, payload)
+    return await run_in_threadpool(admin_users_role, request, payload, await _actor_info(request))
 
-@app.delete("/admin/usuarios/{email:path}")
-async def legacy_admin_delete(request: Request, email: str, hard: bool = Query(default=False)):
+@app.delete("/admin/usuarios/{email:path}", dependencies=[Depends(require_admin)])
+def legacy_admin_delete(request: Request, email: str, hard: bool = Query(default=False), actor: tuple = Depends(_actor_info)):
     # Alias directo de /api/admin/users/{email}
-    return await admin_users_delete(request, email=email, hard=hard)
+    return admin_users_delete(request, email=email, hard=hard, actor=actor)
 
-@app.post("/admin/eliminar-usuario")
+@app.post("/admin/eliminar-usuario", dependencies=[Depends(require_admin)])
 async def legacy_admin_delete_post(request: Request):
     # Variante POST por si el front la usa con form-data
     data = await _json_or_form(request)
     email = (data.get("email") or "").strip()
     hard_raw = str(data.get("hard", "")).lower()
     hard = hard_raw in ("1", "true", "t", "yes", "on", "si", "sí")
-    return await admin_users_delete(request, email=email, hard=hard)
+    return await run_in_threadpool(admin_users_delete, request, email=email, hard=hard, actor=await _actor_info(request))
 
 # 👇 NUEVOS endpoints legacy que tu admin.html ya usa (activar/desactivar/reset sesión)
 @app.post("/admin/desactivar-usuario", dependencies=[Depends(require_admin)])
 async def legacy_admin_disable_user(request: Request):
     data = await _json_or_form(request)
     email = (data.get("email") or "").strip().lower()
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = await _actor_info(request)
     try:
-        cambiar_estado_usuario(email, 0, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(cambiar_estado_usuario, email, 0, actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(email)
         return {"ok": True}
     except Exception as e:
-        print("❌ legacy_admin_disable_user:", repr(e))
+        log.exception("❌ legacy_admin_disable_user")
         return JSONResponse({"error": "No se pudo desactivar"}, status_code=500)
 
 @app.post("/admin/activar-usuario", dependencies=[Depends(require_admin)])
 async def legacy_admin_enable_user(request: Request):
     data = await _json_or_form(request)
     email = (data.get("email") or "").strip().lower()
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = await _actor_info(request)
     try:
-        cambiar_estado_usuario(email, 1, actor_user_id=actor_user_id, ip=ip)
+        await run_in_threadpool(cambiar_estado_usuario, email, 1, actor_user_id=actor_user_id, ip=ip)
+        _invalidar_cache_usuario(email)
         return {"ok": True}
     except Exception as e:
-        print("❌ legacy_admin_enable_user:", repr(e))
+        log.exception("❌ legacy_admin_enable_user")
         return JSONResponse({"error": "No se pudo activar"}, status_code=500)
 
 @app.post("/admin/reset-sesion", dependencies=[Depends(require_admin)])
@@ -1947,15 +2428,17 @@ async def legacy_admin_reset_session(request: Request):
     data = await _json_or_form(request)
     email = (data.get("email") or "").strip().lower()
     now = now_iso_utc()
-    try:
+    def _reset():
         with cal_conn() as c:
             c.execute(
                 "UPDATE sessions SET logout_at=?, closed_reason=? WHERE user=? AND logout_at IS NULL",
                 (now, "admin-reset", email)
             )
+    try:
+        await run_in_threadpool(_reset)
         return {"ok": True}
     except Exception as e:
-        print("❌ legacy_admin_reset_session:", repr(e))
+        log.exception("❌ legacy_admin_reset_session")
         return JSONResponse({"error": "No se pudo reiniciar la sesión"}, status_code=500)
 
 
@@ -1963,32 +2446,35 @@ async def legacy_admin_reset_session(request: Request):
 # ⚠️ Importante: REUSAMOS INCID_ATTACH_DIR / INCID_ALLOWED_EXT / INCID_MAX_TOTAL_MB
 # definidos en la PARTE 1 (no los redefinimos acá para evitar inconsistencias).
 
-def _incid_list_attachments(ticket_id: int):
+def _incid_attachment_info(ticket_id: int, name: str, size: int) -> dict:
+    # Ruta estática real según INCID_ATTACH_DIR
+    static_url = "/" + INCID_ATTACH_DIR.replace(os.sep, "/") + "/" + name
+    # Compatibilidad histórica con /static/adjuntos_incidencias/
+    compat_url = f"/static/adjuntos_incidencias/{name}"
+    return {
+        "filename": name,
+        "size": size,
+        "url": static_url,
+        "compat_url": compat_url,
+        "download_url": f"/incidencias/adjunto/{ticket_id}/{name}",
+    }
+
+def _incid_index_attachments() -> Dict[int, List[dict]]:
     """
-    Devuelve los adjuntos del ticket como lista de dicts.
-    Incluye una URL estática directa y una protegida (download_url).
+    Un solo scandir de INCID_ATTACH_DIR agrupado por ticket ("{id}_..."):
+    los listados resuelven cada ticket con un lookup en vez de un listdir por ticket.
     """
-    prefix = f"{int(ticket_id)}_"
-    out = []
-    for name in sorted(os.listdir(INCID_ATTACH_DIR)):
-        if not name.startswith(prefix):
-            continue
-        path = os.path.join(INCID_ATTACH_DIR, name)
-        if not os.path.isfile(path):
-            continue
-        size = os.path.getsize(path)
-        # Ruta estática real según INCID_ATTACH_DIR
-        static_url = "/" + INCID_ATTACH_DIR.replace(os.sep, "/") + "/" + name
-        # Compatibilidad histórica con /static/adjuntos_incidencias/
-        compat_url = f"/static/adjuntos_incidencias/{name}"
-        out.append({
-            "filename": name,
-            "size": size,
-            "url": static_url,
-            "compat_url": compat_url,
-            "download_url": f"/incidencias/adjunto/{ticket_id}/{name}",
-        })
-    return out
+    por_ticket: Dict[int, List[tuple]] = {}
+    with os.scandir(INCID_ATTACH_DIR) as it:
+        for entry in it:
+            tid, sep, _ = entry.name.partition("_")
+            if not sep or not tid.isdigit() or not entry.is_file():
+                continue
+            por_ticket.setdefault(int(tid), []).append((entry.name, entry.stat().st_size))
+    return {
+        tid: [_incid_attachment_info(tid, name, size) for name, size in sorted(items)]
+        for tid, items in por_ticket.items()
+    }
 
 def _parse_iso_utc(s: str):
     if not s:
@@ -2041,13 +2527,13 @@ if 'INCID_MAX_TOTAL_MB' not in globals():
     INCID_MAX_TOTAL_MB = 25
 
 def _validate_incid_ext(filename: str):
-    ext = os.path.splitext(filename or "")[1].lower()
+    ext = _ext_de(filename)
     if ext not in INCID_ALLOWED_EXT:
         raise HTTPException(status_code=400, detail=f"Tipo de archivo no permitido en incidencias: {ext}")
 
 @app.get("/incidencias", response_class=HTMLResponse)
 @app.get("/incidencias/", response_class=HTMLResponse)  # alias con barra final
-async def incidencias_view(request: Request):
+def incidencias_view(request: Request):
     if not request.session.get("usuario"):
         return RedirectResponse("/login")
 
@@ -2055,7 +2541,12 @@ async def incidencias_view(request: Request):
     rol = request.session.get("rol", "usuario")
 
     # admin ve todo, usuario ve las suyas
-    rows = obtener_todos_los_tickets() if (rol == "admin" or es_admin(email)) else obtener_tickets_por_usuario(email)
+    rows = obtener_todos_los_tickets() if (rol == "admin" or _es_admin_cached(email)) else obtener_tickets_por_usuario(email)
+
+    try:
+        adjuntos_idx = _incid_index_attachments()
+    except Exception:
+        adjuntos_idx = {}
 
     tickets = []
     for r in rows:
@@ -2080,10 +2571,7 @@ async def incidencias_view(request: Request):
         }
 
         # Adjuntos
-        try:
-            t["adjuntos"] = _incid_list_attachments(int(r[0]))
-        except Exception:
-            t["adjuntos"] = []
+        t["adjuntos"] = adjuntos_idx.get(r[0], [])
 
         tickets.append(t)
 
@@ -2097,19 +2585,21 @@ async def incidencias_view(request: Request):
     )
 
 @app.get("/api/incidencias")
-async def incidencias_list_json(request: Request):
+def incidencias_list_json(request: Request):
     if not request.session.get("usuario"):
         return JSONResponse({"error": "No autenticado"}, status_code=401)
     email = request.session.get("usuario")
     rol = request.session.get("rol", "usuario")
-    rows = obtener_todos_los_tickets() if (rol == "admin" or es_admin(email)) else obtener_tickets_por_usuario(email)
+    rows = obtener_todos_los_tickets() if (rol == "admin" or _es_admin_cached(email)) else obtener_tickets_por_usuario(email)
+    adjuntos_idx = _incid_index_attachments()
     items = []
     for r in rows:
+        adjuntos = adjuntos_idx.get(r[0], [])
         items.append({
             "id": r[0], "usuario": r[1], "titulo": r[2], "descripcion": r[3],
             "tipo": r[4], "estado": r[5], "fecha": r[6],
-            "adjuntos_info": _incid_list_attachments(int(r[0])),
-            "adjuntos": [x["filename"] for x in _incid_list_attachments(int(r[0]))],
+            "adjuntos_info": adjuntos,
+            "adjuntos": [x["filename"] for x in adjuntos],
         })
     return {"items": items}
 
@@ -2125,34 +2615,31 @@ async def incidencias_crear(
         return JSONResponse({"error":"No autenticado"}, status_code=401)
 
     usuario = request.session.get("usuario")
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = await _actor_info(request)
 
     # 1) Crear ticket
     now_iso = now_iso_utc()
-    crear_ticket(usuario, titulo.strip(), (descripcion or "").strip(), (tipo or "General").strip(),
-                 actor_user_id=actor_user_id, ip=ip)
+    await run_in_threadpool(crear_ticket, usuario, titulo.strip(), (descripcion or "").strip(), (tipo or "General").strip(),
+                            actor_user_id=actor_user_id, ip=ip)
 
     # 2) Inferir ID del ticket recién creado
-    ticket_id = _infer_ticket_id(usuario, titulo, descripcion or "", tipo or "General", now_iso)
+    ticket_id = await run_in_threadpool(_infer_ticket_id, usuario, titulo, descripcion or "", tipo or "General", now_iso)
 
     # 3) Guardar adjuntos
     files = [a for a in (archivos or []) if (a and a.filename)]
     if ticket_id and files:
-        total_bytes = 0
+        pares = []
         for i, f in enumerate(files, start=1):
             _validate_incid_ext(f.filename)
-            ext = os.path.splitext(f.filename)[1].lower()
+            ext = _ext_de(f.filename)
             safe = _safe_basename(f.filename)
             name = f"{ticket_id}_{i:02d}_{safe}{ext}"
-            path = os.path.join(INCID_ATTACH_DIR, name)
-            written = await _save_upload_stream(f, path)
-            total_bytes += written
-            if (total_bytes / (1024 * 1024)) > INCID_MAX_TOTAL_MB:
-                try:
-                    os.remove(path)
-                except Exception:
-                    pass
-                return JSONResponse({"error": f"Tamaño total supera {INCID_MAX_TOTAL_MB} MB"}, status_code=400)
+            pares.append((f.file, os.path.join(INCID_ATTACH_DIR, name)))
+        if _excede_tamano(files, INCID_MAX_TOTAL_MB * 1024 * 1024):
+            return JSONResponse({"error": f"Tamaño total supera {INCID_MAX_TOTAL_MB} MB"}, status_code=400)
+        sizes = await run_in_threadpool(_save_uploads_sync, pares, INCID_MAX_TOTAL_MB * 1024 * 1024)
+        if sizes is None:
+            return JSONResponse({"error": f"Tamaño total supera {INCID_MAX_TOTAL_MB} MB"}, status_code=400)
 
     return ({"ok": True, "id": ticket_id}
             if wants_json(request)
@@ -2185,29 +2672,30 @@ async def incidencias_post_alias(
     )
 
 @app.get("/incidencias/adjunto/{ticket_id}/{filename}")
-async def incidencias_adjunto(ticket_id: int, filename: str):
+async def incidencias_adjunto(request: Request, ticket_id: int, filename: str):
     """Sirve un adjunto de incidencia, validando que el filename pertenezca al ticket."""
     filename = os.path.basename(filename)
     if not filename.startswith(f"{int(ticket_id)}_"):
         return JSONResponse({"error": "Adjunto inválido"}, status_code=400)
     path = os.path.join(INCID_ATTACH_DIR, filename)
-    if not os.path.isfile(path):
+    st = _stat_archivo(path)
+    if st is None:
         return JSONResponse({"error": "No encontrado"}, status_code=404)
-    return FileResponse(path)
+    return _servir_archivo(request, path, st)
 
 @app.post("/incidencias/cerrar")
-async def incidencias_cerrar(request: Request, id: int = Form(...)):
+def incidencias_cerrar(request: Request, id: int = Form(...), actor: tuple = Depends(_actor_info)):
     if not request.session.get("usuario"):
         return JSONResponse({"error":"No autenticado"}, status_code=401)
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = actor
     actualizar_estado_ticket(id, "Cerrado", actor_user_id=actor_user_id, ip=ip)
     return ({"ok": True} if wants_json(request) else RedirectResponse("/incidencias", status_code=303))
 
 @app.post("/incidencias/eliminar")
-async def incidencias_eliminar(request: Request, id: int = Form(...)):
+def incidencias_eliminar(request: Request, id: int = Form(...), actor: tuple = Depends(_actor_info)):
     if not request.session.get("usuario"):
         return JSONResponse({"error":"No autenticado"}, status_code=401)
-    actor_user_id, ip = _actor_info(request)
+    actor_user_id, ip = actor
     eliminar_ticket(id, actor_user_id=actor_user_id, ip=ip)
     # también podemos eliminar adjuntos del disco
     prefix = f"{int(id)}_"
@@ -2223,12 +2711,12 @@ async def incidencias_eliminar(request: Request, id: int = Form(...)):
     return ({"ok": True} if wants_json(request) else RedirectResponse("/incidencias", status_code=303))
 
 @app.post("/incidencias/cerrar/{id}")
-async def incidencias_cerrar_path(id: int, request: Request):
-    return await incidencias_cerrar(request, id=id)
+def incidencias_cerrar_path(id: int, request: Request, actor: tuple = Depends(_actor_info)):
+    return incidencias_cerrar(request, id=id, actor=actor)
 
 @app.post("/incidencias/eliminar/{id}")
-async def incidencias_eliminar_path(id: int, request: Request):
-    return await incidencias_eliminar(request, id=id)
+def incidencias_eliminar_path(id: int, request: Request, actor: tuple = Depends(_actor_info)):
+    return incidencias_eliminar(request, id=id, actor=actor)
 
 # (Opcional) diagnóstico de rutas
 @app.get("/__diag/routes")
@@ -2249,22 +2737,46 @@ async def calendario_view(request: Request):
         return RedirectResponse("/login")
     return templates.TemplateResponse("calendario.html", {"request": request})
 
-@app.get("/calendario/eventos")
-async def cal_list():
-    with cal_conn() as c:
+# Versión en memoria de eventos: se incrementa en cada alta/edición/baja de este proceso.
+# Junto con COUNT/MAX(updated_at) forma el ETag de cal_list (updated_at tiene resolución
+# de segundos: dos ediciones en el mismo segundo no mueven el agregado, el contador sí).
+_EVENTOS_REV = 0
+
+def _eventos_cambiaron():
+    global _EVENTOS_REV
+    _EVENTOS_REV += 1
+
+def _cal_eventos() -> list:
+    with cal_conn(readonly=True) as c:
         cur = c.execute("SELECT * FROM eventos ORDER BY start ASC")
-        rows = [_event_row_to_dict(r) for r in cur.fetchall()]
-        return rows
+        return [_event_row_to_dict(r) for r in cur.fetchall()]
+
+@app.get("/calendario/eventos")
+def cal_list(request: Request, response: Response):
+    rev = _EVENTOS_REV  # antes de leer: si cambia en el medio, el próximo request lo trae
+    with cal_conn(readonly=True) as c:
+        total, max_upd = c.execute("SELECT COUNT(*), MAX(updated_at) FROM eventos").fetchone()
+    etag = _etag_de(rev, total, max_upd)
+    headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+    if _etag_coincide(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return _cal_eventos()
 
 @app.get("/api/calendar/events")
-async def cal_list_alias():
-    items = await cal_list()
-    return {"events": items}
+def cal_list_alias():
+    return {"events": _cal_eventos()}
+
+def _nuevo_evt_id() -> str:
+    """
+    Id de evento estilo ULID: 12 hex de epoch en ms + 20 hex aleatorios (mismo largo y
+    alfabeto que el token_hex(16) anterior). Ordenable por tiempo: los INSERT caen al final
+    del índice de la PK en vez de partir páginas al azar.
+    """
+    return f"{time.time_ns() // 1_000_000:012x}{secrets.token_hex(10)}"
 
 @app.post("/calendario/eventos")
-async def cal_create(request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error":"No autenticado"}, status_code=401)
+async def cal_create(request: Request, yo: str = Depends(session_user)):
     data = await request.json()
     title = (data.get("title") or "").strip()
     start = data.get("start")
@@ -2275,15 +2787,18 @@ async def cal_create(request: Request):
     if not title or not start:
         return JSONResponse({"error":"Faltan campos: title, start"}, status_code=400)
 
-    evt_id = uuid.uuid4().hex
+    evt_id = _nuevo_evt_id()
     now = _now_iso()
-    created_by = request.session.get("usuario","Desconocido")
+    created_by = yo
 
-    with cal_conn() as c:
-        c.execute("""
-            INSERT INTO eventos(id,title,description,start,end,all_day,color,created_by,created_at,updated_at)
-            VALUES(?,?,?,?,?,?,?,?,?,?)
-        """, (evt_id,title,desc,start,end,all_day,color,created_by,now,now))
+    def _insert():
+        with cal_conn() as c:
+            c.execute("""
+                INSERT INTO eventos(id,title,description,start,end,all_day,color,created_by,created_at,updated_at)
+                VALUES(?,?,?,?,?,?,?,?,?,?)
+            """, (evt_id,title,desc,start,end,all_day,color,created_by,now,now))
+    await run_in_threadpool(_insert)
+    _eventos_cambiaron()
 
     await notify_async(created_by, "Evento creado", f"{title} • {start}{(' → '+end) if end else ''}")
     return {
@@ -2296,10 +2811,19 @@ async def cal_create(request: Request):
         "color": color
     }
 
+# Columnas editables de eventos en orden fijo: el bit i de la máscara = columna i presente.
+# 2^6 combinaciones posibles -> cada UPDATE se arma una vez y el mismo str reutiliza el
+# statement preparado de la conexión.
+_EVT_UPDATE_COLS = ("title", "description", "color", "start", "end", "all_day")
+
+@functools.lru_cache(maxsize=1 << len(_EVT_UPDATE_COLS))
+def _evt_update_sql(mask: int) -> str:
+    sets = [f"{col}=?" for i, col in enumerate(_EVT_UPDATE_COLS) if mask >> i & 1]
+    sets.append("updated_at=?")
+    return f"UPDATE eventos SET {', '.join(sets)} WHERE id=?"
+
 @app.patch("/calendario/eventos/{evt_id}")
-async def cal_update(evt_id: str, request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error":"No autenticado"}, status_code=401)
+async def cal_update(evt_id: str, request: Request, yo: str = Depends(session_user)):
     data = await request.json()
 
     def to_iso(v):
@@ -2314,38 +2838,39 @@ async def cal_update(evt_id: str, request: Request):
     end = to_iso(data.get("end"))
     all_day = data.get("AllDay") if "AllDay" in data else data.get("allDay")
 
-    sets, vals = [], []
-    if title is not None: sets.append("title=?"); vals.append(title)
-    if desc is not None:  sets.append("description=?"); vals.append(desc)
-    if color is not None: sets.append("color=?"); vals.append(color)
-    if start is not None: sets.append("start=?"); vals.append(start)
-    if end is not None:   sets.append("end=?"); vals.append(end)
-    if all_day is not None: sets.append("all_day=?"); vals.append(1 if all_day else 0)
-    sets.append("updated_at=?"); vals.append(_now_iso())
-    vals.append(evt_id)
-
-    if len(sets) == 1:
+    if all_day is not None:
+        all_day = 1 if all_day else 0
+
+    mask, vals = 0, []
+    for i, v in enumerate((title, desc, color, start, end, all_day)):
+        if v is not None:
+            mask |= 1 << i
+            vals.append(v)
+    if not mask:
         return JSONResponse({"error":"Nada para actualizar"}, status_code=400)
+    vals += [_now_iso(), evt_id]
+    sql = _evt_update_sql(mask)
 
-    with cal_conn() as c:
-        cur = c.execute(f"UPDATE eventos SET {', '.join(sets)} WHERE id=?", vals)
-        if cur.rowcount == 0:
-            return JSONResponse({"error":"Evento no encontrado"}, status_code=404)
+    def _update():
+        with cal_conn() as c:
+            return c.execute(sql, vals).rowcount
+    if await run_in_threadpool(_update) == 0:
+        return JSONResponse({"error":"Evento no encontrado"}, status_code=404)
+    _eventos_cambiaron()
 
-    await notify_async(request.session.get("usuario","Desconocido"), "Evento actualizado", f"ID: {evt_id}")
+    await notify_async(yo, "Evento actualizado", f"ID: {evt_id}")
     return {"ok": True}
 
 @app.delete("/calendario/eventos/{evt_id}")
-async def cal_delete(evt_id: str, request: Request):
-    if not request.session.get("usuario"):
-        return JSONResponse({"error":"No autenticado"}, status_code=401)
-
-    with cal_conn() as c:
-        cur = c.execute("DELETE FROM eventos WHERE id=?", (evt_id,))
-        if cur.rowcount == 0:
-            return JSONResponse({"error":"Evento no encontrado"}, status_code=404)
+async def cal_delete(evt_id: str, yo: str = Depends(session_user)):
+    def _delete():
+        with cal_conn() as c:
+            return c.execute("DELETE FROM eventos WHERE id=?", (evt_id,)).rowcount
+    if await run_in_threadpool(_delete) == 0:
+        return JSONResponse({"error":"Evento no encontrado"}, status_code=404)
+    _eventos_cambiaron()
 
-    await notify_async(request.session.get("usuario","Desconocido"), "Evento eliminado", f"ID: {evt_id}")
+    await notify_async(yo, "Evento eliminado", f"ID: {evt_id}")
     return {"ok": True}
 
 
@@ -2354,7 +2879,7 @@ async def cal_delete(evt_id: str, request: Request):
 # =====================================================================
 
 @app.get("/notificaciones")
-async def notificaciones(
+def notificaciones(
     request: Request,
     q: Optional[str] = Query(default=None),
     only_unread: Optional[bool] = Query(default=None),
@@ -2373,36 +2898,57 @@ async def notificaciones(
     where = ["user=?"]
     args: List[object] = [user]
 
-    if q and q.strip():
+    fts_q = _fts_prefix_query(q) if (q and _NOTIF_FTS_OK) else ""
+    if fts_q:
+        # Índice invertido: prefijos de palabra (sin acentos/mayúsculas) en vez de escanear con LIKE
+        where.append("id IN (SELECT rowid FROM fts_notificaciones WHERE fts_notificaciones MATCH ?)")
+        args.append(fts_q)
+    elif q and q.strip():
         where.append("(LOWER(titulo) LIKE LOWER(?) OR LOWER(cuerpo) LIKE LOWER(?))")
         args += [q_like, q_like]
     if only_unread:
         where.append("leida=0")
 
     where_sql = " AND ".join(where)
-    with cal_conn() as c:
-        total_unread = c.execute(
-            "SELECT COUNT(1) FROM notificaciones WHERE user=? AND leida=0", (user,)
-        ).fetchone()[0]
-
-        sql = f"""
-            SELECT id, titulo, cuerpo, created_at, leida
-            FROM notificaciones
-            WHERE {where_sql}
-            ORDER BY id DESC
-            LIMIT ? OFFSET ?
-        """
-        args_sql = args + [limit, offset]
-        cur = c.execute(sql, tuple(args_sql))
-        items = [{
-            "id": r["id"],
-            "titulo": r["titulo"],
-            "cuerpo": r["cuerpo"],
-            "fecha_legible": iso_utc_to_ar_str(r["created_at"]),
-            "leida": bool(r["leida"])
-        } for r in cur.fetchall()]
+    # Una sola consulta: el contador de no leídas viaja como subconsulta escalar (no
+    # correlacionada: SQLite la evalúa una vez). Solo si la página viene vacía se cuenta aparte.
+    sql = f"""
+        SELECT id, titulo, cuerpo, created_at, leida,
+               (SELECT COUNT(1) FROM notificaciones WHERE user=? AND leida=0) AS total_unread
+        FROM notificaciones
+        WHERE {where_sql}
+        ORDER BY id DESC
+        LIMIT ? OFFSET ?
+    """
+    with cal_conn(readonly=True) as c:
+        # Token de frescura (covering sobre idx_notif_user_leida): altas mueven MAX(id),
+        # bajas el COUNT, marcar leídas el total sin leer. Igual -> 304 sin armar la página.
+        token = c.execute(
+            "SELECT MAX(id), COUNT(1), TOTAL(leida=0) FROM notificaciones WHERE user=?", (user,)
+        ).fetchone()
+        etag = _etag_de(user, tuple(token), q, only_unread, limit, offset)
+        headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+        if _etag_coincide(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        rows = c.execute(sql, (user, *args, limit, offset)).fetchall()
+        if rows:
+            total_unread = rows[0]["total_unread"]
+        else:
+            total_unread = c.execute(
+                "SELECT COUNT(1) FROM notificaciones WHERE user=? AND leida=0", (user,)
+            ).fetchone()[0]
+
+    items = [{
+        "id": r["id"],
+        "titulo": r["titulo"],
+        "cuerpo": r["cuerpo"],
+        "fecha_legible": iso_utc_to_ar_str(r["created_at"]),
+        "leida": bool(r["leida"])
+    } for r in rows]
 
-    return {"total_unread": total_unread, "items": items}
+    # JSONResponse directo (sin jsonable_encoder): los valores ya son str/int/bool
+    return JSONResponse({"total_unread": total_unread, "items": items}, headers=headers)
 
 @app.get("/notificaciones/vista", response_class=HTMLResponse)
 async def notificaciones_vista(request: Request):
@@ -2434,16 +2980,25 @@ async def mark_read(request: Request):
         data = {}
     ids = data.get("ids")
 
-    with cal_conn() as c:
-        if isinstance(ids, list) and ids:
-            placeholders = ",".join("?" for _ in ids)
-            c.execute(
-                f"UPDATE notificaciones SET leida=1 WHERE user=? AND id IN ({placeholders})",
-                (user, *ids)
-            )
-        else:
-            c.execute("UPDATE notificaciones SET leida=1 WHERE user=?", (user,))
-    return {"ok": True}
+    # Solo se tocan las que siguen sin leer (un "marcar todas" sin pendientes no escribe
+    # páginas); RETURNING devuelve los ids afectados para que el front invalide esos toasts.
+    def _mark():
+        updated = []
+        with cal_conn() as c:
+            if isinstance(ids, list) and ids:
+                for batch in _chunks(ids):
+                    placeholders = ",".join("?" for _ in batch)
+                    updated += [r[0] for r in c.execute(
+                        f"UPDATE notificaciones SET leida=1 WHERE user=? AND leida=0 AND id IN ({placeholders}) RETURNING id",
+                        (user, *batch)
+                    ).fetchall()]
+            else:
+                updated = [r[0] for r in c.execute(
+                    "UPDATE notificaciones SET leida=1 WHERE user=? AND leida=0 RETURNING id", (user,)
+                ).fetchall()]
+        return updated
+    updated = await run_in_threadpool(_mark)
+    return {"ok": True, "updated": updated}
 
 @app.post("/notificaciones/eliminar")
 async def notif_delete(request: Request):
@@ -2452,8 +3007,10 @@ async def notif_delete(request: Request):
     notif_id = int(data.get("id", 0))
     if not notif_id:
         return JSONResponse({"error": "Falta id"}, status_code=400)
-    with cal_conn() as c:
-        c.execute("DELETE FROM notificaciones WHERE id=? AND user=?", (notif_id, user))
+    def _delete():
+        with cal_conn() as c:
+            c.execute("DELETE FROM notificaciones WHERE id=? AND user=?", (notif_id, user))
+    await run_in_threadpool(_delete)
     return {"ok": True}
 
 
@@ -2463,88 +3020,138 @@ async def notif_delete(request: Request):
 
 SESSION_TIMEOUT_MIN = 10
 
-def init_presence_db():
+def init_presence_db(c: sqlite3.Connection):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS presence(
+            user TEXT PRIMARY KEY,
+            nombre TEXT,
+            last_seen TEXT NOT NULL,
+            ip TEXT,
+            ua TEXT
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS sessions(
+            id TEXT PRIMARY KEY,
+            user TEXT NOT NULL,
+            nombre TEXT,
+            ip TEXT,
+            ua TEXT,
+            login_at TEXT NOT NULL,
+            last_seen TEXT NOT NULL,
+            logout_at TEXT,
+            closed_reason TEXT
+        )
+    """)
+    # presence_online: WHERE last_seen >= ? ORDER BY last_seen DESC
+    c.execute("CREATE INDEX IF NOT EXISTS idx_presence_last_seen ON presence(last_seen)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user)")
+    # Reset de sesión por admin: WHERE user=? AND logout_at IS NULL (solo sesiones abiertas)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user_open ON sessions(user) WHERE logout_at IS NULL")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_dates ON sessions(login_at, last_seen, logout_at)")
+
+def _bootstrap_cal_db():
+    """Abre la conexión compartida (PRAGMAs) y corre el DDL de calendar.sqlite3 en una única transacción."""
     with cal_conn() as c:
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS presence(
-                user TEXT PRIMARY KEY,
-                nombre TEXT,
-                last_seen TEXT NOT NULL,
-                ip TEXT,
-                ua TEXT
-            )
-        """)
-        c.execute("""
-            CREATE TABLE IF NOT EXISTS sessions(
-                id TEXT PRIMARY KEY,
-                user TEXT NOT NULL,
-                nombre TEXT,
-                ip TEXT,
-                ua TEXT,
-                login_at TEXT NOT NULL,
-                last_seen TEXT NOT NULL,
-                logout_at TEXT,
-                closed_reason TEXT
-            )
-        """)
-        c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_dates ON sessions(login_at, last_seen, logout_at)")
-init_presence_db()
+        # journal_mode=WAL puede no aplicarse (FS de red, sin shm): sin WAL lectores y escritor
+        # se bloquean entre sí y cada commit hace fsync completo; que quede a la vista.
+        modo = c.execute("PRAGMA journal_mode").fetchone()[0]
+        if str(modo).lower() != "wal":
+            log.warning("⚠️ calendar.sqlite3 sin WAL (journal_mode=%s)", modo)
+        c.execute("BEGIN")
+        init_calendar_db(c)
+        init_notif_fts(c)
+        init_rating_pending_db(c)
+        init_presence_db(c)
+
+# ---- presence + last_seen de sesiones: write-behind ----
+# presence_ping solo marca en memoria (el último ping por usuario / por sesión gana); una
+# tarea de fondo vuelca el lote cada SESSION_FLUSH_SECS con dos executemany en una sola
+# transacción (un commit por intervalo, no dos por ping).
+SESSION_FLUSH_SECS = float(os.getenv("SESSION_FLUSH_SECS", "2"))
+_SESSION_DIRTY: Dict[str, str] = {}  # sid -> last_seen (ISO UTC)
+_PRESENCE_DIRTY: Dict[str, tuple] = {}  # user -> (user, nombre, last_seen, ip, ua)
+_session_dirty_lock = threading.Lock()
+
+def touch_session(sid: str, now_iso: str):
+    with _session_dirty_lock:
+        _SESSION_DIRTY[sid] = now_iso
+
+def touch_presence(email: str, nombre: str, now_iso: str, ip: Optional[str], ua: str):
+    with _session_dirty_lock:
+        _PRESENCE_DIRTY[email] = (email, nombre, now_iso, ip, ua)
+
+def _flush_sessions_sync(sid: Optional[str] = None):
+    """Vuelca presence + last_seen pendientes (todo, o solo el last_seen de `sid`)."""
+    with _session_dirty_lock:
+        if sid is None:
+            pares = [(ts, s) for s, ts in _SESSION_DIRTY.items()]
+            _SESSION_DIRTY.clear()
+            presencias = list(_PRESENCE_DIRTY.values())
+            _PRESENCE_DIRTY.clear()
+        else:
+            ts = _SESSION_DIRTY.pop(sid, None)
+            pares = [(ts, sid)] if ts else []
+            presencias = []
+    if pares or presencias:
+        with cal_conn() as c:
+            if presencias:
+                c.executemany(PRESENCE_UPSERT_SQL, presencias)
+            if pares:
+                c.executemany(SESSION_LAST_SEEN_SQL, pares)
+
+async def _session_flusher():
+    while True:
+        await asyncio.sleep(SESSION_FLUSH_SECS)
+        try:
+            await run_in_threadpool(_flush_sessions_sync)
+        except Exception:
+            log.exception("❌ flush de sesiones (last_seen)")
 
 @app.post("/presence/ping")
-async def presence_ping(request: Request):
+def presence_ping(request: Request):
     email = request.session.get("usuario")
     if not email:
         return JSONResponse({"ok": False, "error": "No autenticado"}, status_code=401)
 
-    row = obtener_usuario_por_email(email)
-    nombre = row[1] if row else email
+    # El login deja el nombre visible en la sesión: el ping no consulta usuarios.db
+    nombre = request.session.get("nombre") or email
     ip = request.client.host if request.client else None
     ua = request.headers.get("user-agent", "")
     now = now_iso_utc()
     sid = request.session.get("sid")
 
-    with cal_conn() as c:
-        c.execute("""
-            INSERT INTO presence(user, nombre, last_seen, ip, ua)
-            VALUES(?,?,?,?,?)
-            ON CONFLICT(user) DO UPDATE SET
-                nombre=excluded.nombre,
-                last_seen=excluded.last_seen,
-                ip=excluded.ip,
-                ua=excluded.ua
-        """, (email, nombre, now, ip, ua))
-        if sid:
-            c.execute("UPDATE sessions SET last_seen=? WHERE id=?", (now, sid))
-    return {"ok": True}
+    touch_presence(email, nombre, now, ip, ua)
+    if sid:
+        touch_session(sid, now)
+    # Solo quedó encolado (lo escribe _session_flusher): 202 sin cuerpo. El front lo manda
+    # con navigator.sendBeacon, que no espera respuesta.
+    return Response(status_code=202)
 
 @app.get("/presence/online")
-async def presence_online(minutes: int = 5):
-    threshold_ts = datetime.now(timezone.utc).timestamp() - (minutes * 60)
-    items = []
-    with cal_conn() as c:
-        cur = c.execute("SELECT user, nombre, last_seen, ip, ua FROM presence ORDER BY last_seen DESC")
-        for r in cur.fetchall():
-            try:
-                dt = datetime.strptime(r["last_seen"], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-                ts = dt.timestamp()
-            except Exception:
-                ts = 0
-            if ts >= threshold_ts:
-                items.append({
-                    "email": r["user"],
-                    "nombre": r["nombre"] or r["user"],
-                    "last_seen": r["last_seen"],
-                    "ip": r["ip"] or "",
-                    "ua": r["ua"] or ""
-                })
+def presence_online(minutes: int = 5):
+    # last_seen es ISO UTC 'YYYY-MM-DDTHH:MM:SSZ': el orden lexicográfico es el cronológico,
+    # así que el umbral se compara en SQL (rango sobre idx_presence_last_seen)
+    threshold = (datetime.now(timezone.utc) - timedelta(minutes=minutes)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    with cal_conn(readonly=True) as c:
+        cur = c.execute(
+            "SELECT user, nombre, last_seen, ip, ua FROM presence WHERE last_seen >= ? ORDER BY last_seen DESC",
+            (threshold,),
+        )
+        items = [{
+            "email": r["user"],
+            "nombre": r["nombre"] or r["user"],
+            "last_seen": r["last_seen"],
+            "ip": r["ip"] or "",
+            "ua": r["ua"] or ""
+        } for r in cur.fetchall()]
     return {"items": items}
 
 @app.get("/usuarios-activos", response_class=HTMLResponse)
-async def usuarios_activos(request: Request):
+def usuarios_activos(request: Request):
     if not request.session.get("usuario"):
         return RedirectResponse("/login")
-    data = await presence_online(minutes=5)
+    data = presence_online(minutes=5)
     return templates.TemplateResponse("usuarios_activos.html", {
         "request": request,
         "items": data.get("items", [])
@@ -2567,16 +3174,6 @@ def _parse_iso(ts: Optional[str]):
     except Exception:
         return None
 
-def _to_dt(s: Optional[str]):
-    if not s:
-        return None
-    try:
-        if s.endswith("Z"):
-            return datetime.strptime(s, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-        return datetime.fromisoformat(s)
-    except Exception:
-        return None
-
 @app.get("/auditoria/actividad/vista", response_class=HTMLResponse, dependencies=[Depends(require_admin)])
 async def auditoria_actividad_view(request: Request):
     return templates.TemplateResponse("auditoria_actividad.html", {"request": request})
@@ -2585,19 +3182,32 @@ async def auditoria_actividad_view(request: Request):
 async def auditoria_actividad_legacy():
     return RedirectResponse("/auditoria/actividad/vista", status_code=307)
 
-@app.get("/auditoria/actividad", dependencies=[Depends(require_admin)])
-async def auditoria_actividad(
-    request: Request,
-    usuario: Optional[str] = Query(default=None, description="email exacto o parte"),
-    desde: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
-    hasta: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
-    limit: int = Query(default=500, ge=1, le=5000)
-):
-    now = datetime.now(timezone.utc)
-    rows_out = []
+# estado y duración se calculan en SQLite (strftime('%s') = epoch entero; NULL si el
+# timestamp falta o es inválido): la fila ya sale lista para serializar.
+#   cerrada  -> tiene logout_at
+#   activa   -> last_seen dentro de SESSION_TIMEOUT_MIN
+#   expirada -> el resto
+# duracion_seg = (logout_at | last_seen | ahora) - login_at
+# Las columnas salen con los nombres/defaults de la API: cada fila es dict(zip(cols, fila)).
+_ACTIVIDAD_SELECT = """
+    SELECT id, user AS usuario, COALESCE(NULLIF(nombre, ''), user) AS nombre,
+           COALESCE(ip, '') AS ip, COALESCE(ua, '') AS ua,
+           login_at, last_seen, logout_at, COALESCE(closed_reason, '') AS closed_reason,
+           CASE
+               WHEN strftime('%s', logout_at) IS NOT NULL THEN 'cerrada'
+               WHEN CAST(strftime('%s', last_seen) AS INTEGER) >= ? THEN 'activa'
+               ELSE 'expirada'
+           END AS estado,
+           MAX(0, CAST(COALESCE(strftime('%s', logout_at), strftime('%s', last_seen), ?) AS INTEGER)
+                  - CAST(strftime('%s', login_at) AS INTEGER)) AS duracion_seg
+      FROM sessions
+"""
 
-    q = "SELECT id, user, nombre, ip, ua, login_at, last_seen, logout_at, closed_reason FROM sessions"
-    conds, args = [], []
+def _actividad_query(usuario: Optional[str], desde: Optional[str], hasta: Optional[str], limit: int, now: datetime):
+    """SELECT de sesiones con los filtros de auditoría -> (sql, args)."""
+    ahora = int(now.timestamp())
+    q = _ACTIVIDAD_SELECT
+    conds, args = [], [ahora - SESSION_TIMEOUT_MIN * 60, ahora]
     if usuario:
         conds.append("user LIKE ?")
         args.append(f"%{usuario}%")
@@ -2611,75 +3221,77 @@ async def auditoria_actividad(
         q += " WHERE " + " AND ".join(conds)
     q += " ORDER BY login_at DESC LIMIT ?"
     args.append(limit)
+    return q, tuple(args)
 
-    with cal_conn() as c:
-        cur = c.execute(q, tuple(args))
-        for r in cur.fetchall():
-            login_dt  = _to_dt(r["login_at"])
-            last_dt   = _to_dt(r["last_seen"])
-            logout_dt = _to_dt(r["logout_at"])
-
-            if logout_dt:
-                estado = "cerrada"
-                ref_end = logout_dt
-            else:
-                if last_dt and (now - last_dt).total_seconds() <= SESSION_TIMEOUT_MIN * 60:
-                    estado = "activa"
-                else:
-                    estado = "expirada"
-                ref_end = last_dt or now
-
-            dur_sec = None
-            if login_dt and ref_end:
-                dur_sec = int(max(0, (ref_end - login_dt).total_seconds()))
-
-            rows_out.append({
-                "id": r["id"],
-                "usuario": r["user"],
-                "nombre": r["nombre"] or r["user"],
-                "ip": r["ip"] or "",
-                "ua": r["ua"] or "",
-                "login_at": r["login_at"],
-                "last_seen": r["last_seen"],
-                "logout_at": r["logout_at"],
-                "estado": estado,
-                "closed_reason": r["closed_reason"] or "",
-                "duracion_seg": dur_sec
-            })
-
-    return {"items": rows_out, "timeout_min": SESSION_TIMEOUT_MIN, "now_utc": now.strftime("%Y-%m-%dT%H:%M:%SZ")}
+def _actividad_rows(cur: sqlite3.Cursor, rows) -> List[dict]:
+    cols = [d[0] for d in cur.description]
+    return [dict(zip(cols, r)) for r in rows]
+
+@app.get("/auditoria/actividad", dependencies=[Depends(require_admin)])
+def auditoria_actividad(
+    request: Request,
+    usuario: Optional[str] = Query(default=None, description="email exacto o parte"),
+    desde: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    hasta: Optional[str] = Query(default=None, description="YYYY-MM-DD"),
+    limit: int = Query(default=500, ge=1, le=5000)
+):
+    now = datetime.now(timezone.utc)
+    q, args = _actividad_query(usuario, desde, hasta, limit, now)
+    with cal_conn(readonly=True) as c:
+        cur = c.execute(q, args)
+        rows_out = _actividad_rows(cur, cur.fetchall())
+
+    # JSONResponse directo: hasta 5000 filas de tipos planos, no hace falta el recorrido
+    # de jsonable_encoder que FastAPI aplica a los dicts devueltos
+    return JSONResponse({"items": rows_out, "timeout_min": SESSION_TIMEOUT_MIN, "now_utc": now.strftime("%Y-%m-%dT%H:%M:%SZ")})
+
+ACTIVIDAD_CSV_HEADERS = ["estado","usuario","nombre","login_at","last_seen","logout_at","duracion_seg","ip","ua","sid","closed_reason"]
+ACTIVIDAD_CSV_CHUNK = 200  # filas por bloque enviado
+
+def _actividad_csv_gen(q: str, args: tuple):
+    """Genera el CSV por bloques directo desde el cursor (memoria acotada, csv escapa comas/comillas)."""
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(ACTIVIDAD_CSV_HEADERS)
+    with cal_conn(readonly=True) as c:
+        cur = c.execute(q, args)
+        while True:
+            rows = cur.fetchmany(ACTIVIDAD_CSV_CHUNK)
+            if not rows:
+                break
+            for it in _actividad_rows(cur, rows):
+                writer.writerow([
+                    it["estado"],
+                    it["usuario"],
+                    it["nombre"],
+                    it["login_at"] or "",
+                    it["last_seen"] or "",
+                    it["logout_at"] or "",
+                    it["duracion_seg"] or 0,
+                    it["ip"],
+                    it["ua"],
+                    it["id"],
+                    it["closed_reason"],
+                ])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
 
 @app.get("/auditoria/actividad.csv", dependencies=[Depends(require_admin)])
-async def auditoria_actividad_csv(
+def auditoria_actividad_csv(
     request: Request,
     usuario: Optional[str] = Query(default=None),
     desde: Optional[str] = Query(default=None),
     hasta: Optional[str] = Query(default=None),
     limit: int = Query(default=500, ge=1, le=5000)
 ):
-    data = await auditoria_actividad(request, usuario=usuario, desde=desde, hasta=hasta, limit=limit)
-    items = data.get("items", [])
-    headers = ["estado","usuario","nombre","login_at","last_seen","logout_at","duracion_seg","ip","ua","sid","closed_reason"]
-    lines = [",".join(headers)]
-    for it in items:
-        row = [
-            it.get("estado",""),
-            it.get("usuario",""),
-            it.get("nombre",""),
-            it.get("login_at",""),
-            it.get("last_seen",""),
-            it.get("logout_at","") or "",
-            str(it.get("duracion_seg") or 0),
-            it.get("ip",""),
-            (it.get("ua","") or "").replace(",", " "),
-            it.get("id",""),
-            it.get("closed_reason","").replace(",", " ")
-        ]
-        lines.append(",".join(row))
-    csv_body = "\n".join(lines)
+    q, args = _actividad_query(usuario, desde, hasta, limit, datetime.now(timezone.utc))
     filename = "auditoria_actividad.csv"
-    return Response(
-        content=csv_body,
+    # Generador sync: Starlette lo itera en el threadpool, no bloquea el event loop
+    return StreamingResponse(
+        _actividad_csv_gen(q, args),
         media_type="text/csv",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'}
     )
@@ -1,40 +1,48 @@
 # models.py
+from datetime import datetime
+from typing import List, Optional
+
 from sqlalchemy import (
-    Column, Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Index
+    Integer, String, Boolean, DateTime, Text, ForeignKey, JSON, Index
 )
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
-from database import Base
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
+
+
+class Base(DeclarativeBase):
+    """Base propia de estos modelos (db_orm.Base ya mapea su propio `usuarios` liviano)."""
+    pass
 
 
 class Usuario(Base):
     __tablename__ = "usuarios"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, index=True)
 
     # Nombre visible (no necesariamente único; podés tener homónimos)
-    nombre = Column(String(120), nullable=False)
+    nombre: Mapped[str] = mapped_column(String(120), nullable=False)
 
     # Email para login: único y con índice
-    email = Column(String(255), unique=True, index=True, nullable=False)
+    email: Mapped[str] = mapped_column(String(255), unique=True, index=True, nullable=False)
 
     # Hash de contraseña (no guardes texto plano)
-    contrasena = Column(String(255), nullable=False)
+    contrasena: Mapped[str] = mapped_column(String(255), nullable=False)
 
     # 'usuario' | 'admin'
-    rol = Column(String(20), default="usuario", nullable=False)
+    rol: Mapped[str] = mapped_column(String(20), default="usuario", nullable=False)
 
     # Habilitado/deshabilitado
-    activo = Column(Boolean, default=True, nullable=False)
+    activo: Mapped[bool] = mapped_column(Boolean, default=True, nullable=False)
 
     # Trazas
-    creado_en = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    actualizado_en = Column(DateTime(timezone=True), onupdate=func.now())
-    ultimo_login = Column(DateTime(timezone=True))
+    creado_en: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    actualizado_en: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), onupdate=func.now())
+    ultimo_login: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
 
     # Relaciones
-    eventos = relationship("Evento", back_populates="usuario", cascade="all, delete-orphan")
-    notificaciones = relationship("Notificacion", back_populates="usuario", cascade="all, delete-orphan")
+    eventos: Mapped[List["Evento"]] = relationship(back_populates="usuario", cascade="all, delete-orphan")
+    notificaciones: Mapped[List["Notificacion"]] = relationship(back_populates="usuario", cascade="all, delete-orphan")
 
     def __repr__(self) -> str:
         return f"<Usuario id={self.id} email={self.email} rol={self.rol} activo={self.activo}>"
@@ -49,23 +57,23 @@ class Evento(Base):
     """
     __tablename__ = "eventos"
 
-    id = Column(Integer, primary_key=True)
-    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    usuario_id: Mapped[int] = mapped_column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
 
-    titulo = Column(String(200), nullable=False)
-    descripcion = Column(Text)
+    titulo: Mapped[str] = mapped_column(String(200), nullable=False)
+    descripcion: Mapped[Optional[str]] = mapped_column(Text)
 
-    inicio = Column(DateTime(timezone=True), nullable=False)
-    fin = Column(DateTime(timezone=True), nullable=True)  # puede ser None si all_day
-    all_day = Column(Boolean, default=False, nullable=False)
+    inicio: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    fin: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)  # puede ser None si all_day
+    all_day: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
 
-    color = Column(String(16))         # ej: "#2f6adf"
-    visibilidad = Column(String(20), default="privado", nullable=False)
+    color: Mapped[Optional[str]] = mapped_column(String(16))         # ej: "#2f6adf"
+    visibilidad: Mapped[str] = mapped_column(String(20), default="privado", nullable=False)
 
-    creado_en = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
-    actualizado_en = Column(DateTime(timezone=True), onupdate=func.now())
+    creado_en: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    actualizado_en: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), onupdate=func.now())
 
-    usuario = relationship("Usuario", back_populates="eventos")
+    usuario: Mapped["Usuario"] = relationship(back_populates="eventos")
 
     __table_args__ = (
         Index("ix_eventos_usuario", "usuario_id"),
@@ -81,30 +89,36 @@ class Notificacion(Base):
     Notificación mostrada en el toast-center y/o campana.
     - tipo: 'info' | 'success' | 'warning' | 'error'
     - link opcional para deep-link (p.ej. a una incidencia o historial)
-    - metadata JSON para payload libre (ids, etc.)
+    - payload JSON libre (ids, etc.): JSONB en Postgres (binario, indexable con GIN), JSON en SQLite
     """
     __tablename__ = "notificaciones"
 
-    id = Column(Integer, primary_key=True)
-    usuario_id = Column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    usuario_id: Mapped[int] = mapped_column(Integer, ForeignKey("usuarios.id", ondelete="CASCADE"), nullable=False)
 
-    titulo = Column(String(180), nullable=False)
-    cuerpo = Column(Text)
-    tipo = Column(String(20), default="info", nullable=False)
+    titulo: Mapped[str] = mapped_column(String(180), nullable=False)
+    cuerpo: Mapped[Optional[str]] = mapped_column(Text)
+    tipo: Mapped[str] = mapped_column(String(20), default="info", nullable=False)
 
-    link = Column(String(512))        # URL interna o relativa (ej: /incidencias/123)
-    leida = Column(Boolean, default=False, nullable=False)
-    leida_en = Column(DateTime(timezone=True))
+    link: Mapped[Optional[str]] = mapped_column(String(512))        # URL interna o relativa (ej: /incidencias/123)
+    leida: Mapped[bool] = mapped_column(Boolean, default=False, nullable=False)
+    leida_en: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True))
 
-    metadata = Column(JSON)           # datos extra opcionales
+    # `metadata` está reservado por Declarative: el atributo es `payload`, la columna conserva
+    # su nombre para no migrar datos
+    payload: Mapped[Optional[dict]] = mapped_column("metadata", JSONB().with_variant(JSON(), "sqlite"))
 
-    creado_en = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    creado_en: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), nullable=False)
 
-    usuario = relationship("Usuario", back_populates="notificaciones")
+    usuario: Mapped["Usuario"] = relationship(back_populates="notificaciones")
 
     __table_args__ = (
         Index("ix_notif_usuario_leida", "usuario_id", "leida"),
+        # Listado de la campana: WHERE usuario_id=? ORDER BY id DESC LIMIT n sin sort
+        Index("ix_notif_usuario_id", "usuario_id", "id"),
         Index("ix_notif_creado_en", "creado_en"),
+        # Consultas de contención (payload @> '{...}'); solo existe en Postgres
+        Index("ix_notif_payload_gin", payload, postgresql_using="gin").ddl_if(dialect="postgresql"),
     )
 
     def __repr__(self) -> str:
@@ -0,0 +1,30 @@
+import os
+import sys
+
+# utils.py / main.py viven en la raíz del repo (sin paquete)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils.py arma el cliente de OpenAI al importar; los tests nunca llegan a llamarlo
+os.environ.setdefault("OPENAI_API_KEY", "sk-test")
+
+# Los tests de utils.py necesitan poder importarlo: PyMuPDF, openai, reportlab, cachetools...
+# y Python 3.12+ (f-strings con backslash). Si no se puede, no se recolectan y el motivo
+# sale en el resumen en vez de un "skipped" mudo por archivo.
+_TESTS_DE_UTILS = ["test_ocr.py", "test_regex.py"]
+
+try:
+    import utils  # noqa: F401
+    _UTILS_NO_IMPORTA = None
+except (ImportError, SyntaxError) as e:
+    _UTILS_NO_IMPORTA = f"{type(e).__name__}: {e}"
+
+collect_ignore = _TESTS_DE_UTILS if _UTILS_NO_IMPORTA else []
+
+
+def pytest_terminal_summary(terminalreporter):
+    if _UTILS_NO_IMPORTA:
+        terminalreporter.write_line(
+            f"⚠️ utils.py no se pudo importar ({_UTILS_NO_IMPORTA}); "
+            f"no se corrieron: {', '.join(_TESTS_DE_UTILS)}",
+            yellow=True,
+        )
@@ -0,0 +1,117 @@
+from concurrent.futures import Future
+
+import pytest
+
+import utils
+
+
+class _Pagina:
+    def __init__(self, i):
+        self.i = i
+
+    def get_text(self):
+        return ""  # escaneada: sin texto nativo
+
+
+class _Doc:
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def load_page(self, i):
+        return _Pagina(i)
+
+
+@pytest.fixture
+def vision_falsa(monkeypatch):
+    """
+    _OCR_BATCHER real sobre un Vision falso: la "URL" de cada imagen es "<página>@<dpi>" y
+    `respuestas[url]` es lo que devuelve Vision (None = fallo con reintentos agotados).
+    """
+    monkeypatch.setattr(utils, "USE_LOCAL_OCR", False)
+    monkeypatch.setattr(utils, "VISION_DPI_BAJO", 100)
+    monkeypatch.setattr(utils, "VISION_DPI_ALTO", 200)
+    monkeypatch.setattr(utils, "_rasterizar_pagina_jpeg",
+                        lambda page, dpi=utils.VISION_DPI: f"{page.i}@{dpi}".encode())
+    monkeypatch.setattr(utils, "_data_url", lambda img, mime="image/jpeg": img.decode())
+    monkeypatch.setattr(utils, "_ocr_cache_get", lambda clave: None)
+    monkeypatch.setattr(utils, "_ocr_cache_put", lambda clave, txt: None)
+    monkeypatch.setattr(utils, "_OCR_BATCHER", utils._OcrBatcher(4, 0.01, 1))
+
+    enviadas = []
+
+    def instalar(respuestas):
+        def ocr(paginas):
+            enviadas.extend(url for _, url in paginas)
+            return {i: respuestas[url] for i, url in paginas}
+        monkeypatch.setattr(utils, "_ocr_openai_imagenes", ocr)
+        return enviadas
+    return instalar
+
+
+def test_pagina_fallida_no_se_reenvia_a_mas_dpi(vision_falsa):
+    largo = "x" * (utils.OCR_TEXT_MIN_CHARS + 10)
+    enviadas = vision_falsa({
+        "0@100": None,       # Vision falló
+        "1@100": "corto",    # poco texto: merece la segunda vuelta
+        "1@200": largo,
+    })
+    out = utils._ocr_selectivo_por_pagina(_Doc(2), 8)
+
+    assert sorted(enviadas) == ["0@100", "1@100", "1@200"]
+    assert "[PÁGINA 1] (sin texto OCR)" in out
+    assert f"[PÁGINA 2]\n{largo}" in out
+
+
+def test_procesar_resuelve_none_si_vision_falla(monkeypatch):
+    monkeypatch.setattr(utils, "_ocr_openai_imagenes", lambda paginas: {0: None, 1: "texto"})
+    monkeypatch.setattr(utils, "_ocr_cache_put", lambda clave, txt: None)
+    futs = [Future(), Future()]
+    utils._OcrBatcher._procesar([("url0", "c0", futs[0]), ("url1", "c1", futs[1])])
+
+    assert futs[0].result() is None
+    assert futs[1].result() == "texto"
+
+
+def _error_openai(cls, status):
+    import httpx
+    resp = httpx.Response(status, request=httpx.Request("POST", "https://api.openai.com/v1/chat/completions"))
+    return cls("falla", response=resp, body=None)
+
+
+def test_lote_con_reintentos_agotados_no_se_parte(monkeypatch):
+    import openai
+    llamadas = []
+    error = _error_openai(openai.RateLimitError, 429)
+
+    def vision(content, max_completion_tokens):
+        llamadas.append(content)
+        raise error
+    monkeypatch.setattr(utils, "_vision_texto", vision)
+
+    out = utils._ocr_openai_imagenes([(i, f"url{i}") for i in range(4)])
+
+    assert out == {0: None, 1: None, 2: None, 3: None}
+    assert len(llamadas) == 1
+
+
+def test_lote_rechazado_se_parte_para_aislar_la_imagen(monkeypatch):
+    import openai
+    error = _error_openai(openai.BadRequestError, 400)
+
+    def vision(content, max_completion_tokens):
+        urls = [c["image_url"]["url"] for c in content if c["type"] == "image_url"]
+        if "mala" in urls:
+            raise error
+        if len(urls) == 1:  # _ocr_openai_imagen: sin marcas de página
+            return f"texto {urls[0]}"
+        return "".join(f"===PAG {int(u[3:]) + 1}===\ntexto {u}\n" for u in urls)
+    monkeypatch.setattr(utils, "_vision_texto", vision)
+
+    out = utils._ocr_openai_imagenes([(0, "url0"), (1, "mala"), (2, "url2"), (3, "url3")])
+
+    assert out[1] is None
+    assert out[0] == "texto url0"
+    assert out[2] == "texto url2" and out[3] == "texto url3"
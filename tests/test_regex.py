@@ -0,0 +1,38 @@
+import utils
+
+# Texto como lo deja la extracción de PDF: NBSP (\xa0) entre palabras
+DOC = (
+    "=== ANEXO 01: pliego.pdf ===\n"
+    "[PÁGINA 1]\n"
+    "Objeto\xa0del gasto: partida\xa0presupuestaria 5.2.9\n"
+    "Se admite más\xa0de una oferta.\n"
+    "Página\xa03 de 10\n"
+    "Parte\xa01 de 3 del informe\n"
+    "----\n"
+    "texto   \n\n\n\n"
+    "=== ANEXO 02: anexo.docx ===\n"
+    "[PÁGINA 7]\n"
+    "Informe\xa0completo\n"
+)
+
+
+def test_pie_de_pagina_con_nbsp_se_limpia():
+    assert "Página" not in utils._limpieza_basica_preanalisis(DOC)
+
+
+def test_meta_lineas_con_nbsp_se_quitan():
+    limpio = utils._limpiar_meta(DOC)
+    assert "Parte\xa01 de 3" not in limpio
+    assert "Informe\xa0completo" not in limpio
+
+
+def test_hints_con_nbsp():
+    idx = utils._index_paginas(DOC)
+    pats = utils.DETECTABLE_FIELDS["obj_gasto"]["pats"]
+    assert utils._buscar_candidatos(DOC, pats, idx, 5)
+
+
+def test_indices_de_pagina_y_anexo():
+    pos = DOC.index("Informe\xa0completo")
+    assert utils._pagina_de_indice(utils._index_paginas(DOC), pos) == 7
+    assert utils._anexo_en_pos(utils._index_anexos(DOC), pos) == 2
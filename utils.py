@@ -1,24 +1,35 @@
 # -*- coding: utf-8 -*-
 # utils.py — Parte 1/5
 import io
+import logging
 import os
 import re
 import base64
+import hashlib
+import bisect
+import functools
 import mimetypes
+import multiprocessing
+import queue
+import random
+import threading
 import time
+import zipfile
+import xml.etree.ElementTree as ET
 from datetime import datetime
-from typing import List, Tuple, Dict, Optional
+from typing import Callable, List, Tuple, Dict, Optional
 from tempfile import NamedTemporaryFile
 
 import fitz  # PyMuPDF
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import OpenAI, APIConnectionError, APITimeoutError, BadRequestError, InternalServerError, RateLimitError
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.units import mm
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from reportlab.lib.colors import HexColor
 from zoneinfo import ZoneInfo  # fallback local AR
+from cachetools import LRUCache
 
 # ========================= Opcionales (DOCX) =========================
 try:
@@ -26,6 +37,13 @@ try:
 except Exception:
     docx = None
 
+# ========================= Opcionales (OCR local) =========================
+try:
+    import pytesseract
+    from PIL import Image
+except Exception:
+    pytesseract = None
+
 load_dotenv()
 
 # ========================= OpenAI client =========================
@@ -59,11 +77,34 @@ NOTAS_MAX_TOKENS = int(os.getenv("NOTAS_MAX_TOKENS", "1400"))
 # OCR
 VISION_MAX_PAGES = int(os.getenv("VISION_MAX_PAGES", "8"))
 VISION_DPI = int(os.getenv("VISION_DPI", "150"))
+# DPI adaptativo: Vision ve primero la página a VISION_DPI_BAJO y solo re-rasteriza a
+# VISION_DPI_ALTO las que vuelven con menos de OCR_TEXT_MIN_CHARS (escaneos ruidosos)
+VISION_DPI_BAJO = int(os.getenv("VISION_DPI_BAJO", "100"))
+VISION_DPI_ALTO = int(os.getenv("VISION_DPI_ALTO", "200"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "75"))
+VISION_MAX_LONG_PX = int(os.getenv("VISION_MAX_LONG_PX", "1600"))  # Vision reescala arriba de ~2048 igual
 OCR_TEXT_MIN_CHARS = int(os.getenv("OCR_TEXT_MIN_CHARS", "120"))
 OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "4"))
+# Reintentos propios de Vision (backoff exponencial + jitter) con timeout por intento más corto
+OCR_RETRIES = int(os.getenv("OCR_RETRIES", "2"))
+OCR_TIMEOUT = float(os.getenv("OCR_TIMEOUT", "45"))
+# Primera pasada con Tesseract local; solo va a Vision si devuelve menos de OCR_TEXT_MIN_CHARS
+USE_LOCAL_OCR = int(os.getenv("USE_LOCAL_OCR", "0"))
+OCR_LOCAL_LANG = os.getenv("OCR_LOCAL_LANG", "spa")
+
+# DOCX: python-docx solo si se pide; por defecto se lee word/document.xml en streaming
+USE_PY_DOCX = int(os.getenv("USE_PY_DOCX", "0"))
 
 # Control de paginado en texto nativo
 PAGINAR_TEXTO_NATIVO = int(os.getenv("PAGINAR_TEXTO_NATIVO", "1"))
+# Tope opcional de texto nativo por PDF (0 = sin tope). MAX_SINGLE_PASS_CHARS no sirve de tope:
+# solo elige single-pass vs. por partes, y recortar ahí perdería contenido del pliego.
+MAX_TEXTO_NATIVO_CHARS = int(os.getenv("MAX_TEXTO_NATIVO_CHARS", "0"))
+# PDFs grandes: get_text() repartido en procesos (MuPDF corre bajo el GIL en un solo hilo)
+PDF_PROCESOS = int(os.getenv("PDF_PROCESOS", str(min(4, os.cpu_count() or 1))))
+PDF_PROCESOS_MIN_PAGINAS = int(os.getenv("PDF_PROCESOS_MIN_PAGINAS", "200"))
+# ¿Escaneado? En PDFs de más de 2×N páginas se decide con N páginas equiespaciadas (0 = todas)
+PDF_MUESTRA_PAGINAS = int(os.getenv("PDF_MUESTRA_PAGINAS", "5"))
 
 # Calidad/recall
 MULTI_FORCE_TWO_STAGE_MIN_CHARS = int(os.getenv("MULTI_FORCE_TWO_STAGE_MIN_CHARS", "45000"))
@@ -81,52 +122,272 @@ MAX_ARTICULOS_OUT       = int(os.getenv("MAX_ARTICULOS_OUT", "12"))
 FORCE_DETERMINISTIC_213_216 = int(os.getenv("FORCE_DETERMINISTIC_213_216", "0"))
 
 # ========================= Timers PERF =========================
+_log = logging.getLogger("pliegos.utils")
+
 def _t(): return time.perf_counter()
 def _log_tiempo(etiqueta, t0):
     try:
-        dt = time.perf_counter() - t0
-        print(f"[PERF] {etiqueta}: {dt:0.2f}s")
+        _log.info("[PERF] %s: %0.2fs", etiqueta, time.perf_counter() - t0)
     except Exception:
         pass
 
 # ==================== OCR / Raster ====================
-def _rasterizar_pagina(page, dpi=VISION_DPI) -> bytes:
-    mat = fitz.Matrix(dpi/72, dpi/72)
+def _escala_vision(rect, escala: float) -> float:
+    """`escala` acotada para que el lado largo no pase de VISION_MAX_LONG_PX (A3/planillas)."""
+    lado = max(rect.width, rect.height)
+    return min(escala, VISION_MAX_LONG_PX / lado) if lado > 0 else escala
+
+def _rasterizar_pagina_jpeg(page, dpi=VISION_DPI) -> bytes:
+    # JPEG: en escaneos pesa varias veces menos que PNG con el mismo resultado de OCR
+    s = _escala_vision(page.rect, dpi/72)
+    mat = fitz.Matrix(s, s)
     pix = page.get_pixmap(matrix=mat, alpha=False)
-    return pix.tobytes("png")
+    return pix.tobytes("jpeg", jpg_quality=VISION_JPEG_QUALITY)
 
-def _ocr_openai_imagen_b64(b64_png: str) -> str:
+def _data_url(img: bytes, mime: str = "image/jpeg") -> str:
+    """data: URL armada una vez por imagen (base64 en bytes + prefijo, un solo decode a str)."""
+    return (b"data:" + mime.encode("ascii") + b";base64," + base64.b64encode(img)).decode("ascii")
+
+_OCR_REINTENTABLES = (RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)
+
+def _vision_texto(content: list, max_completion_tokens: int) -> str:
+    """
+    Una llamada a Vision con OCR_RETRIES reintentos ante 429/5xx/red/timeout (1s, 2s, 4s... + jitter).
+    Los reintentos internos del SDK quedan en 0 para no multiplicarse con estos. Si se agotan,
+    propaga la última excepción.
+    """
+    cli = client.with_options(timeout=OCR_TIMEOUT, max_retries=0)
+    for intento in range(OCR_RETRIES + 1):
+        try:
+            resp = cli.chat.completions.create(
+                model=VISION_MODEL,
+                messages=[{"role": "user", "content": content}],
+                max_completion_tokens=max_completion_tokens
+            )
+            return (resp.choices[0].message.content or "").strip()
+        except _OCR_REINTENTABLES:
+            if intento >= OCR_RETRIES:
+                raise
+            time.sleep((2 ** intento) + random.random() * 0.5)
+    raise RuntimeError("sin intentos")  # inalcanzable
+
+def _ocr_openai_imagen(url: str) -> Optional[str]:
+    """Texto de la imagen; None si Vision falló (no se cachea y la página queda 'sin texto OCR')."""
     prompt = (
         "Extraé el TEXTO literal de esta imagen escaneada de un pliego. "
         "Conservá títulos, tablas como líneas con separadores, listas y números. No resumas ni interpretes."
     )
     try:
-        resp = client.chat.completions.create(
-            model=VISION_MODEL,
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{b64_png}"}}
-                ]
-            }],
-            max_completion_tokens=2400
-        )
-        return (resp.choices[0].message.content or "").strip()
+        return _vision_texto([
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": url}}
+        ], 2400)
+    except Exception as e:
+        _log.warning("⚠️ OCR Vision falló: %s", e)
+        return None
+
+def _ocr_local(img_bytes: bytes) -> str:
+    """Tesseract sobre la imagen; "" si está desactivado, no instalado o falla."""
+    if not USE_LOCAL_OCR or pytesseract is None:
+        return ""
+    try:
+        with Image.open(io.BytesIO(img_bytes)) as img:
+            return (pytesseract.image_to_string(img, lang=OCR_LOCAL_LANG) or "").strip()
     except Exception as e:
-        return f"[OCR-ERROR] {e}"
+        _log.warning("⚠️ OCR local falló: %s", e)
+        return ""
+
+# ---- OCR por lotes: varias páginas por request de Vision ----
+# Cada request paga RTT/TLS + prompt fijo; con K imágenes por mensaje se paga una vez por lote.
+VISION_PAGINAS_POR_LLAMADA = max(1, int(os.getenv("VISION_PAGINAS_POR_LLAMADA", "4")))
+_PAG_MARCA_RE = re.compile(r"===PAG (\d+)===")
+
+def _ocr_openai_imagenes(paginas: List[Tuple[int, str]]) -> Dict[int, Optional[str]]:
+    """
+    OCR de varias páginas en un solo mensaje: [(idx, data_url), ...] -> {idx: texto | None}.
+    El modelo devuelve bloques '===PAG n===' (n = idx+1); las páginas que no vuelvan
+    delimitadas se reintentan sueltas. Si Vision rechaza el lote (400: una imagen problemática)
+    se parte en mitades para aislarla; ante 429/5xx/red/timeout ya reintentados, partir solo
+    multiplicaría requests y espera, así que el lote entero queda en None.
+    """
+    if len(paginas) == 1:
+        i, url = paginas[0]
+        return {i: _ocr_openai_imagen(url)}
+
+    prompt = (
+        "Extraé el TEXTO literal de cada una de estas imágenes escaneadas de un pliego. "
+        "Conservá títulos, tablas como líneas con separadores, listas y números. No resumas ni interpretes. "
+        "Devolvé un bloque por imagen, encabezado por su marca exacta (===PAG n===) y en el mismo orden."
+    )
+    content = [{"type": "text", "text": prompt}]
+    for i, url in paginas:
+        content.append({"type": "text", "text": f"===PAG {i+1}==="})
+        content.append({"type": "image_url", "image_url": {"url": url}})
+    try:
+        salida = _vision_texto(content, 2400 * len(paginas))
+    except BadRequestError as e:
+        _log.warning("⚠️ Vision rechazó un lote de %d páginas, se parte en dos: %s", len(paginas), e)
+        mitad = len(paginas) // 2
+        return {**_ocr_openai_imagenes(paginas[:mitad]), **_ocr_openai_imagenes(paginas[mitad:])}
+    except Exception as e:
+        _log.warning("⚠️ OCR Vision falló para un lote de %d páginas: %s", len(paginas), e)
+        return {i: None for i, _ in paginas}
+
+    # split con grupo: ["antes", "3", "texto pág 3", "4", "texto pág 4", ...]
+    partes = _PAG_MARCA_RE.split(salida)
+    pedidas = {i for i, _ in paginas}
+    out: Dict[int, Optional[str]] = {}
+    for k in range(1, len(partes) - 1, 2):
+        i = int(partes[k]) - 1
+        if i in pedidas:
+            out[i] = partes[k + 1].strip()
+    for i, url in paginas:
+        if i not in out:
+            out[i] = _ocr_openai_imagen(url)
+    return out
+
+# ---- Cache de OCR por hash de la imagen (portadas/anexos repetidos no vuelven a Vision) ----
+OCR_CACHE_MAX = int(os.getenv("OCR_CACHE_MAX", "512"))
+OCR_DISK_CACHE = int(os.getenv("OCR_DISK_CACHE", "0"))
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "pliegos_ocr"))
+
+_ocr_cache: LRUCache = LRUCache(maxsize=OCR_CACHE_MAX)
+_ocr_cache_lock = threading.Lock()  # LRUCache no es thread-safe (lo tocan el pool de OCR y los extractores)
+_ocr_cache_stats = {"hit": 0, "miss": 0}
+
+def _ocr_cache_clave(img: bytes) -> str:
+    # Sobre los bytes de la imagen (sin copiar); el modelo entra en la clave porque otro
+    # modelo puede leer distinto la misma imagen
+    h = hashlib.blake2b(VISION_MODEL.encode() + b"\0", digest_size=16)
+    h.update(img)
+    return h.hexdigest()
+
+def _ocr_cache_get(clave: str) -> Optional[str]:
+    with _ocr_cache_lock:
+        txt = _ocr_cache.get(clave)
+    if txt is None and OCR_DISK_CACHE:
+        try:
+            with open(os.path.join(OCR_CACHE_DIR, clave + ".txt"), encoding="utf-8") as f:
+                txt = f.read()
+            with _ocr_cache_lock:
+                _ocr_cache[clave] = txt
+        except OSError:
+            txt = None
+    with _ocr_cache_lock:
+        _ocr_cache_stats["hit" if txt is not None else "miss"] += 1
+    return txt
+
+def _ocr_cache_put(clave: str, txt: Optional[str]):
+    if txt is None:
+        return  # los fallos no se cachean: el próximo intento puede salir bien
+    with _ocr_cache_lock:
+        _ocr_cache[clave] = txt
+    if OCR_DISK_CACHE:
+        try:
+            os.makedirs(OCR_CACHE_DIR, exist_ok=True)
+            tmp = os.path.join(OCR_CACHE_DIR, f"{clave}.{threading.get_ident()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(txt)
+            os.replace(tmp, os.path.join(OCR_CACHE_DIR, clave + ".txt"))
+        except OSError as e:
+            _log.warning("⚠️ No se pudo escribir la cache de OCR: %s", e)
+
+# ---- Despachador de OCR compartido: junta páginas de todos los documentos en curso ----
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+def _en_paralelo(fn: Callable, items: list, workers: int,
+                 on_error: Optional[Callable[[int, Exception], object]] = None) -> list:
+    """
+    fn(item) para cada item en un pool de `workers` hilos, resultados en el orden de `items`.
+    Se encolan TODOS los submit antes de esperar el primero (un .result() dentro del loop de
+    submit serializa las llamadas). Si fn falla y hay `on_error`, el slot queda con
+    on_error(indice, excepción); si no, la excepción se propaga.
+    """
+    out: list = [None] * len(items)
+    if not items:
+        return out
+    with ThreadPoolExecutor(max_workers=max(1, min(len(items), workers))) as ex:
+        futs = {ex.submit(fn, x): i for i, x in enumerate(items)}
+        for fut in as_completed(futs):
+            i = futs[fut]
+            try:
+                out[i] = fut.result()
+            except Exception as e:
+                if on_error is None:
+                    raise
+                out[i] = on_error(i, e)
+    return out
 
-# ---- OCR selectivo en paralelo (muestreo uniforme en el doc) ----
-from concurrent.futures import ThreadPoolExecutor, as_completed
+OCR_BATCH_ESPERA_MS = int(os.getenv("OCR_BATCH_ESPERA_MS", "200"))
 
-def _ocr_pagina_png_bytes(png_bytes: bytes, idx: int) -> str:
-    b64 = base64.b64encode(png_bytes).decode("utf-8")
-    txt = _ocr_openai_imagen_b64(b64)
+class _OcrBatcher:
+    """
+    Cola única de páginas para Vision. Un hilo arma lotes de hasta `k` imágenes (o lo que
+    haya llegado `espera` segundos después de la primera) y los manda a un pool de
+    `workers` requests en paralelo. Así páginas de anexos distintos comparten llamada.
+    """
+    def __init__(self, k: int, espera: float, workers: int):
+        self._k = k
+        self._espera = espera
+        self._q: "queue.Queue[Tuple[str, str, Future]]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr")
+        self._hilo: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def enviar(self, img: bytes, mime: str = "image/jpeg") -> "Future[Optional[str]]":
+        """El future resuelve con el texto, o None si Vision falló (reintentos agotados)."""
+        fut: "Future[Optional[str]]" = Future()
+        clave = _ocr_cache_clave(img)
+        txt = _ocr_cache_get(clave)
+        if txt is not None:
+            fut.set_result(txt)
+            return fut
+        with self._lock:
+            if self._hilo is None:
+                self._hilo = threading.Thread(target=self._bucle, name="ocr-batcher", daemon=True)
+                self._hilo.start()
+        self._q.put((_data_url(img, mime), clave, fut))
+        return fut
+
+    def _bucle(self):
+        while True:
+            lote = [self._q.get()]
+            limite = time.monotonic() + self._espera
+            while len(lote) < self._k:
+                resto = limite - time.monotonic()
+                if resto <= 0:
+                    break
+                try:
+                    lote.append(self._q.get(timeout=resto))
+                except queue.Empty:
+                    break
+            self._pool.submit(self._procesar, lote)
+
+    @staticmethod
+    def _procesar(lote: List[Tuple[str, str, Future]]):
+        try:
+            textos = _ocr_openai_imagenes([(j, url) for j, (url, _, _) in enumerate(lote)])
+            for j, (_, clave, fut) in enumerate(lote):
+                txt = textos.get(j)
+                _ocr_cache_put(clave, txt)
+                fut.set_result(txt)  # None = fallo: el llamador no lo confunde con "sin texto"
+        except Exception as e:
+            for _, _, fut in lote:
+                if not fut.done():
+                    fut.set_exception(e)
+
+_OCR_BATCHER = _OcrBatcher(VISION_PAGINAS_POR_LLAMADA, OCR_BATCH_ESPERA_MS / 1000, OCR_CONCURRENCY)
+
+# ---- OCR selectivo (muestreo uniforme en el doc) ----
+
+def _ocr_pagina_jpeg_bytes(jpeg_bytes: bytes, idx: int) -> str:
+    txt = _ocr_openai_imagen(_data_url(jpeg_bytes))
     return f"[PÁGINA {idx+1}]\n{txt}" if txt else f"[PÁGINA {idx+1}] (sin texto OCR)"
 
 def _ocr_selectivo_por_pagina(doc: fitz.Document, max_pages: int) -> str:
     """
     Muestrea páginas a lo largo de todo el documento para no perder planillas al final.
+    Las que no tienen texto nativo suficiente van a Vision por el despachador compartido.
     """
     n = len(doc)
     if n == 0:
@@ -138,37 +399,93 @@ def _ocr_selectivo_por_pagina(doc: fitz.Document, max_pages: int) -> str:
     else:
         page_idxs = sorted({int(round(i * (n - 1) / max(1, to_process - 1))) for i in range(to_process)})
 
-    resultados_map: Dict[int, str] = {}
+    # Un casillero por página muestreada, en orden de documento (page_idxs ya viene ordenado)
+    res: List[Optional[str]] = [None] * len(page_idxs)
 
-    def _proc_page(i: int) -> Tuple[int, str]:
-        p = doc.load_page(i)
-        txt_nat = (p.get_text() or "").strip()
-        if len(txt_nat) >= OCR_TEXT_MIN_CHARS:
-            return i, f"[PÁGINA {i+1}]\n{txt_nat}"
-        png_bytes = _rasterizar_pagina(p)
-        b64 = base64.b64encode(png_bytes).decode("utf-8")
-        txt = _ocr_openai_imagen_b64(b64)
-        return i, (f"[PÁGINA {i+1}]\n{txt}" if txt else f"[PÁGINA {i+1}] (sin texto OCR)")
+    # Texto nativo + raster en este hilo (fitz.Document no es thread-safe); solo el OCR sale
+    pendientes: List[Tuple[int, int, Future]] = []  # (casillero, página, future)
+    for k, i in enumerate(page_idxs):
+        try:
+            p = doc.load_page(i)
+            txt_nat = (p.get_text() or "").strip()
+            if len(txt_nat) >= OCR_TEXT_MIN_CHARS:
+                res[k] = f"[PÁGINA {i+1}]\n{txt_nat}"
+                continue
+            if USE_LOCAL_OCR:
+                # Tesseract no paga ancho de banda: sigue a VISION_DPI
+                txt_local = _ocr_local(_rasterizar_pagina_jpeg(p))
+                if len(txt_local) >= OCR_TEXT_MIN_CHARS:
+                    res[k] = f"[PÁGINA {i+1}]\n{txt_local}"
+                    continue
+            pendientes.append((k, i, _OCR_BATCHER.enviar(_rasterizar_pagina_jpeg(p, VISION_DPI_BAJO))))
+        except Exception:
+            pass
 
-    with ThreadPoolExecutor(max_workers=OCR_CONCURRENCY) as ex:
-        futs = [ex.submit(_proc_page, i) for i in page_idxs]
-        for fut in as_completed(futs):
+    def _fmt(i: int, txt: Optional[str]) -> str:
+        return f"[PÁGINA {i+1}]\n{txt}" if txt else f"[PÁGINA {i+1}] (sin texto OCR)"
+
+    # Páginas con poco texto a baja resolución: segunda vuelta a VISION_DPI_ALTO. None es un
+    # fallo de la API (no de resolución) y no se reintenta. Cada raster tiene su propia clave de cache.
+    reintentos: List[Tuple[int, int, Future, str]] = []
+    for k, i, fut in pendientes:
+        try:
+            txt = fut.result()
+        except Exception:
+            continue
+        if txt is not None and len(txt.strip()) < OCR_TEXT_MIN_CHARS and VISION_DPI_ALTO > VISION_DPI_BAJO:
             try:
-                i, s = fut.result()
-                resultados_map[i] = s
+                jpg = _rasterizar_pagina_jpeg(doc.load_page(i), VISION_DPI_ALTO)
+                reintentos.append((k, i, _OCR_BATCHER.enviar(jpg), txt))
+                continue
             except Exception:
                 pass
+        res[k] = _fmt(i, txt)
+
+    for k, i, fut, txt_bajo in reintentos:
+        try:
+            txt = fut.result()
+        except Exception:
+            txt = None
+        res[k] = _fmt(i, txt if txt and len(txt.strip()) > len(txt_bajo.strip()) else txt_bajo)
+    if reintentos:
+        _log.info("[PERF] ocr_dpi_adaptativo: %d/%d páginas re-OCR a %d DPI",
+                  len(reintentos), len(pendientes), VISION_DPI_ALTO)
+
+    if pendientes:
+        _log.info("[PERF] ocr_cache: %d hits / %d misses (acumulado)",
+                  _ocr_cache_stats["hit"], _ocr_cache_stats["miss"])
 
-    orden = sorted(resultados_map.keys())
-    res = [resultados_map[i] for i in orden]
     if n > to_process:
         res.append(f"\n[AVISO] OCR muestreó {to_process}/{n} páginas distribuidas.")
     return "\n\n".join([r for r in res if r]).strip()
 # utils.py — Parte 2/5
 
 # ==================== Extracción por tipo de archivo ====================
+_LECTURA_CHUNK = 1 << 20  # 1 MB
+
+def _leer_en_bytearray(f) -> bytearray:
+    """Lee `f` completo en un bytearray del tamaño exacto (readinto por chunks, sin copias intermedias)."""
+    f.seek(0, os.SEEK_END)
+    total = f.tell()
+    f.seek(0)
+    buf = bytearray(total)
+    vista = memoryview(buf)
+    pos = 0
+    while pos < total:
+        n = f.readinto(vista[pos:pos + _LECTURA_CHUNK])
+        if not n:
+            break
+        pos += n
+    vista.release()
+    if pos < total:
+        del buf[pos:]
+    return buf
+
 def _leer_todo(file) -> bytes:
+    """Bytes del upload (puede ser un bytearray: fitz, base64 y decode lo aceptan igual)."""
     try:
+        if hasattr(file.file, "readinto"):
+            return _leer_en_bytearray(file.file)
         file.file.seek(0)
         raw = file.file.read()
     except Exception:
@@ -188,16 +505,71 @@ def _mime_guess(file) -> str:
     m, _ = mimetypes.guess_type(nombre)
     return m or ""
 
-def _texto_nativo_etiquetado(doc: fitz.Document) -> str:
+def _etiquetar_paginas(textos: List[str], cap: int = 0) -> str:
     partes = []
-    for i, p in enumerate(doc, 1):
-        t = (p.get_text() or "").strip()
+    total = 0
+    for i, t in enumerate(textos, 1):
+        t = t.strip()
         if t:
             partes.append(f"[PÁGINA {i}]\n{t}")
         else:
             partes.append(f"[PÁGINA {i}] (sin texto)")
+        total += len(partes[-1]) + 2
+        if cap and total > cap:
+            partes.append("[TRUNCADO]")
+            break
     return "\n\n".join(partes).strip()
 
+def _textos_rango(path: str, desde: int, hasta: int) -> List[str]:
+    """Worker de _textos_en_procesos (top-level: tiene que poder picklearse)."""
+    with fitz.open(path) as d:
+        return [d.load_page(i).get_text() or "" for i in range(desde, hasta)]
+
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+_pdf_pool_lock = threading.Lock()
+
+def _pool_pdf() -> ProcessPoolExecutor:
+    global _pdf_pool
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: hacer fork de un proceso con hilos (uvicorn, OCR, logging) puede heredar locks tomados
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_PROCESOS, mp_context=multiprocessing.get_context("spawn"))
+        return _pdf_pool
+
+def _textos_en_procesos(raw: bytes, n: int) -> List[str]:
+    """
+    Texto de las n páginas en paralelo. El PDF va a un archivo temporal que cada worker
+    abre por path (MuPDF lo mapea) en vez de picklear los bytes una vez por rango.
+    """
+    with NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(raw)
+        path = tmp.name
+    try:
+        paso = -(-n // PDF_PROCESOS)
+        futs = [_pool_pdf().submit(_textos_rango, path, a, min(n, a + paso)) for a in range(0, n, paso)]
+        textos: List[str] = []
+        for fut in futs:
+            textos.extend(fut.result())
+        return textos
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def _muestra_parece_escaneada(doc) -> bool:
+    """
+    True si PDF_MUESTRA_PAGINAS páginas equiespaciadas (primera y última incluidas) no llegan
+    al umbral de 500 caracteres escalado a la fracción muestreada. En PDFs chicos (o con la
+    muestra desactivada) devuelve False y decide la pasada completa.
+    """
+    n, k = len(doc), PDF_MUESTRA_PAGINAS
+    if k < 2 or n <= 2 * k:
+        return False
+    idxs = sorted({i * (n - 1) // (k - 1) for i in range(k)})
+    suma = sum(len((doc.load_page(i).get_text() or "").strip()) for i in idxs)
+    return suma < 500 * len(idxs) / n
+
 def extraer_texto_de_pdf(file) -> str:
     t0 = _t()
     raw = _leer_todo(file)
@@ -205,16 +577,41 @@ def extraer_texto_de_pdf(file) -> str:
         _log_tiempo("extraccion_pdf_sin_bytes", t0); return ""
     try:
         with fitz.open(stream=raw, filetype="pdf") as doc:
-            suma = 0
-            for p in doc:
-                suma += len((p.get_text() or "").strip())
-            if suma < 500:
+            # get_text() es lo caro (parsea el content stream): una sola pasada, reutilizada abajo.
+            # Con tope, las páginas que ya no entrarían ni se parsean (secuencial, para poder cortar).
+            # Un escaneo grande se detecta por muestra y va directo a OCR sin esa pasada.
+            textos: List[str] = []
+            escaneado = _muestra_parece_escaneada(doc)
+            if not escaneado:
+                if PDF_PROCESOS > 1 and not MAX_TEXTO_NATIVO_CHARS and len(doc) >= PDF_PROCESOS_MIN_PAGINAS:
+                    try:
+                        textos = _textos_en_procesos(raw, len(doc))
+                    except Exception as e:
+                        _log.warning("⚠️ Extracción en procesos falló, sigo en este hilo: %s", e)
+                        textos = []
+                if textos:
+                    suma = sum(len(t.strip()) for t in textos)
+                else:
+                    suma = 0
+                    for p in doc:
+                        t = p.get_text() or ""
+                        textos.append(t)
+                        suma += len(t.strip())
+                        if MAX_TEXTO_NATIVO_CHARS and suma > max(MAX_TEXTO_NATIVO_CHARS, 500):
+                            break
+                escaneado = suma < 500
+            if escaneado:
                 ocr_t0 = _t()
                 ocr_text = _ocr_selectivo_por_pagina(doc, VISION_MAX_PAGES)
                 _log_tiempo("ocr_selectivo", ocr_t0)
                 _log_tiempo("extraccion_pdf_total", t0)
                 return ocr_text
-            out = _texto_nativo_etiquetado(doc) if PAGINAR_TEXTO_NATIVO else "\n".join([p.get_text() or "" for p in doc])
+            if PAGINAR_TEXTO_NATIVO:
+                out = _etiquetar_paginas(textos, MAX_TEXTO_NATIVO_CHARS)
+            else:
+                out = "\n".join(textos)
+                if len(textos) < len(doc):
+                    out += "\n[TRUNCADO]"
             _log_tiempo("extraccion_pdf_total", t0)
             return out.strip()
     except Exception:
@@ -226,18 +623,83 @@ def extraer_texto_de_pdf(file) -> str:
             _log_tiempo("extraccion_pdf_error", t0)
             return ""
 
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def _docx_texto_xml(raw: bytes) -> str:
+    """
+    Mismo texto que el camino python-docx (párrafos del cuerpo y luego cada fila de tabla
+    como 'celda | celda'), recorriendo word/document.xml con iterparse en vez de armar el
+    árbol de objetos. Textboxes y tablas anidadas quedan afuera, igual que en python-docx.
+    """
+    partes: List[str] = []
+    filas: List[str] = []
+    pila_p: List[List[str]] = []  # párrafos abiertos (un textbox mete un w:p dentro de otro)
+    prof_tbl = 0
+    fila: Optional[List[str]] = None
+    celda: Optional[List[str]] = None
+    with zipfile.ZipFile(io.BytesIO(raw)) as z, z.open("word/document.xml") as f:
+        for ev, el in ET.iterparse(f, events=("start", "end")):
+            tag = el.tag
+            if ev == "start":
+                if tag == _W + "p":
+                    pila_p.append([])
+                elif tag == _W + "tbl":
+                    prof_tbl += 1
+                elif prof_tbl == 1 and tag == _W + "tr":
+                    fila = []
+                elif prof_tbl == 1 and tag == _W + "tc":
+                    celda = []
+                continue
+            if tag == _W + "t":
+                if pila_p and el.text:
+                    pila_p[-1].append(el.text)
+            elif tag == _W + "tab":
+                if pila_p:
+                    pila_p[-1].append("\t")
+            elif tag in (_W + "br", _W + "cr"):
+                if pila_p:
+                    pila_p[-1].append("\n")
+            elif tag == _W + "p":
+                txt = "".join(pila_p.pop())
+                if not pila_p:
+                    if prof_tbl == 0:
+                        txt = txt.strip()
+                        if txt:
+                            partes.append(txt)
+                    elif prof_tbl == 1 and celda is not None:
+                        celda.append(txt)
+                    el.clear()
+            elif tag == _W + "tc" and prof_tbl == 1:
+                if fila is not None and celda is not None:
+                    fila.append("\n".join(celda).strip())
+                celda = None
+            elif tag == _W + "tr" and prof_tbl == 1:
+                if fila is not None:
+                    filas.append(" | ".join(fila))
+                fila = None
+                el.clear()
+            elif tag == _W + "tbl":
+                prof_tbl -= 1
+    partes.extend(filas)
+    return "\n".join(partes).strip()
+
 def extraer_texto_de_docx(file) -> str:
     t0 = _t()
     raw = _leer_todo(file)
     if not raw:
         _log_tiempo("extraccion_docx_sin_bytes", t0); return ""
-    if docx is None:
+    if not (USE_PY_DOCX and docx is not None):
         try:
-            out = raw.decode("utf-8", errors="ignore")
-            _log_tiempo("extraccion_docx_decode", t0)
+            out = _docx_texto_xml(raw)
+            _log_tiempo("extraccion_docx_xml", t0)
             return out
         except Exception:
-            _log_tiempo("extraccion_docx_error", t0); return ""
+            try:
+                out = raw.decode("utf-8", errors="ignore")
+                _log_tiempo("extraccion_docx_decode", t0)
+                return out
+            except Exception:
+                _log_tiempo("extraccion_docx_error", t0); return ""
     try:
         document = docx.Document(io.BytesIO(raw))
         partes: List[str] = []
@@ -259,56 +721,122 @@ def extraer_texto_de_docx(file) -> str:
         except Exception:
             _log_tiempo("extraccion_docx_error", t0); return ""
 
+def _mime_imagen_por_firma(raw: bytes) -> str:
+    if raw[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if raw[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    return ""
+
 def extraer_texto_de_imagen(file) -> str:
     t0 = _t()
     raw = _leer_todo(file)
     if not raw:
         _log_tiempo("extraccion_imagen_sin_bytes", t0); return ""
-    try:
-        img_doc = fitz.open(stream=raw, filetype=_ext_de_archivo(file).lstrip(".") or None)
-        page = img_doc.load_page(0)
-        png = page.get_pixmap(alpha=False).tobytes("png")
-        b64 = base64.b64encode(png).decode("utf-8")
-    except Exception:
-        b64 = base64.b64encode(raw).decode("utf-8")
-    out = _ocr_openai_imagen_b64(b64)
+    txt_local = _ocr_local(raw)
+    if len(txt_local) >= OCR_TEXT_MIN_CHARS:
+        _log_tiempo("extraccion_imagen_ocr_local", t0)
+        return txt_local
+    # JPEG/PNG ya los acepta Vision tal cual: sin abrir con fitz ni re-rasterizar
+    mime = _mime_imagen_por_firma(raw)
+    img = raw
+    if not mime:
+        mime = "image/jpeg"
+        try:
+            img_doc = fitz.open(stream=raw, filetype=_ext_de_archivo(file).lstrip(".") or None)
+            page = img_doc.load_page(0)
+            s = _escala_vision(page.rect, 1.0)
+            img = page.get_pixmap(matrix=fitz.Matrix(s, s), alpha=False).tobytes("jpeg", jpg_quality=VISION_JPEG_QUALITY)
+        except Exception:
+            pass
+    del raw
+    clave = _ocr_cache_clave(img)
+    out = _ocr_cache_get(clave)
+    if out is None:
+        url = _data_url(img, mime)
+        del img  # durante el request a Vision solo hace falta la data URL
+        out = _ocr_openai_imagen(url)
+        _ocr_cache_put(clave, out)
+        out = out or ""
     _log_tiempo("extraccion_imagen_ocr", t0)
     return out
 
-def extraer_texto_universal(file) -> str:
-    t0 = _t()
-    ext = _ext_de_archivo(file)
-    mime = _mime_guess(file)
-
-    if ext == ".pdf" or (mime == "application/pdf"):
-        out = extraer_texto_de_pdf(file); _log_tiempo("extraer_texto_universal_pdf", t0); return out
-    if ext == ".docx" or (mime in ["application/vnd.openxmlformats-officedocument.wordprocessingml.document"]):
-        out = extraer_texto_de_docx(file); _log_tiempo("extraer_texto_universal_docx", t0); return out
-    if ext in [".png", ".jpg", ".jpeg", ".webp"] or (mime.startswith("image/") if mime else False):
-        out = extraer_texto_de_imagen(file); _log_tiempo("extraer_texto_universal_imagen", t0); return out
-
+def _extraer_texto_plano(file) -> str:
     raw = _leer_todo(file)
     if not raw:
-        _log_tiempo("extraer_texto_universal_sin_bytes", t0)
         return ""
     try:
         text = raw.decode("utf-8", errors="ignore")
     except Exception:
         text = ""
-    if ext == ".rtf":
+    if _ext_de_archivo(file) == ".rtf":
         text = re.sub(r"{\\rtf1.*?\\viewkind4\\uc1", "", text, flags=re.S)
         text = re.sub(r"\\[a-z]+-?\d* ?", "", text)
         text = text.replace("{", "").replace("}", "")
-    out = (text or "").strip()
-    _log_tiempo("extraer_texto_universal_texto_plano", t0)
+    return (text or "").strip()
+
+# Despacho por extensión y, si no matchea, por mime: (etiqueta para [PERF], extractor)
+_EXTRACTORES: Dict[str, Tuple[str, Callable]] = {
+    ".pdf": ("pdf", extraer_texto_de_pdf),
+    ".docx": ("docx", extraer_texto_de_docx),
+    ".png": ("imagen", extraer_texto_de_imagen),
+    ".jpg": ("imagen", extraer_texto_de_imagen),
+    ".jpeg": ("imagen", extraer_texto_de_imagen),
+    ".webp": ("imagen", extraer_texto_de_imagen),
+}
+_EXTRACTORES_MIME: Dict[str, Tuple[str, Callable]] = {
+    "application/pdf": _EXTRACTORES[".pdf"],
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": _EXTRACTORES[".docx"],
+}
+_EXTRACTOR_TEXTO_PLANO: Tuple[str, Callable] = ("texto_plano", _extraer_texto_plano)
+
+def extraer_texto_universal(file) -> str:
+    t0 = _t()
+    mime = _mime_guess(file)
+    etiqueta, extractor = (
+        _EXTRACTORES.get(_ext_de_archivo(file))
+        or _EXTRACTORES_MIME.get(mime)
+        or (_EXTRACTORES[".png"] if mime.startswith("image/") else _EXTRACTOR_TEXTO_PLANO)
+    )
+    out = extractor(file)
+    _log_tiempo(f"extraer_texto_universal_{etiqueta}", t0)
+    return out
+
+def _extraer_o_decodificar(file) -> str:
+    try:
+        return extraer_texto_universal(file)
+    except Exception:
+        try:
+            file.file.seek(0)
+            return file.file.read().decode("utf-8", errors="ignore")
+        except Exception:
+            return ""
+
+def extraer_texto_universal_batch(files: list) -> List[str]:
+    """
+    Extrae varios archivos en paralelo (mismo orden que `files`). El OCR de todos pasa por
+    _OCR_BATCHER, así que páginas escaneadas de anexos distintos se agrupan en la misma llamada.
+    """
+    if len(files) <= 1:
+        return [_extraer_o_decodificar(f) for f in files]
+    t0 = _t()
+    out = _en_paralelo(_extraer_o_decodificar, files, ANALISIS_CONCURRENCY)
+    _log_tiempo("extraer_texto_universal_batch", t0)
     return out
 
 # ==================== Pre-limpieza ====================
+# Compiladas una vez. Las pasadas quedan separadas a propósito: cada una puede dejar
+# saltos que recién colapsa la siguiente (una alternancia única no da el mismo texto).
+_PIE_PAGINA_RE = re.compile(r"(?i)\n?P[aá]gina\s+\d+\s+de\s+\d+\s*\n")
+_LINEA_SEP_RE = re.compile(r"\n[-_]{3,}\n")
+_ESPACIO_FINAL_RE = re.compile(r"[ \t]+\n")
+_SALTOS_RE = re.compile(r"\n{3,}")
+
 def _limpieza_basica_preanalisis(s: str) -> str:
-    s = re.sub(r"\n?P[aá]gina\s+\d+\s+de\s+\d+\s*\n", "\n", s, flags=re.I)
-    s = re.sub(r"\n[-_]{3,}\n", "\n", s)
-    s = re.sub(r"[ \t]+\n", "\n", s)
-    s = re.sub(r"\n{3,}", "\n\n", s)
+    s = _PIE_PAGINA_RE.sub("\n", s)
+    s = _LINEA_SEP_RE.sub("\n", s)
+    s = _ESPACIO_FINAL_RE.sub("\n", s)
+    s = _SALTOS_RE.sub("\n\n", s)
     return s.strip()
 
 # ==================== Prompts y limpieza ====================
@@ -517,22 +1045,22 @@ Ejemplos:
 # utils.py — Parte 3/5
 
 # ==================== Filtrado de meta-frases y utilidades ====================
-_META_PATTERNS = [
-    re.compile(r"(?i)\bparte\s+\d+\s+de\s+\d+"),
-    re.compile(r"(?i)informe\s+basado\s+en\s+la\s+parte"),
-    re.compile(r"(?i)revise\s+las\s+partes\s+restantes"),
-    re.compile(r"(?i)informaci[oó]n\s+puede\s+estar\s+incompleta"),
-    re.compile(r"(?i)^\s*informe\s+completo\s*$"),
-    re.compile(r"(?i)^\s*informe\s+original\s*$"),
-]
+# Líneas meta completas (incluido su \n) en una sola pasada sobre el texto, sin splitlines/join.
+# `[^\S\n]` en vez de `\s` para que ningún patrón cruce de una línea a la siguiente.
+_META_LINEA_RE = re.compile(
+    r"(?im)^(?:[^\n]*?(?:\bparte[^\S\n]+\d+[^\S\n]+de[^\S\n]+\d+"
+    r"|informe[^\S\n]+basado[^\S\n]+en[^\S\n]+la[^\S\n]+parte"
+    r"|revise[^\S\n]+las[^\S\n]+partes[^\S\n]+restantes"
+    r"|informaci[oó]n[^\S\n]+puede[^\S\n]+estar[^\S\n]+incompleta)[^\n]*"
+    r"|[^\S\n]*informe[^\S\n]+(?:completo|original)[^\S\n]*)(?:\n|$)"
+)
 
 def _limpiar_meta(texto: str) -> str:
-    lineas = []
-    for ln in (texto or "").splitlines():
-        if any(p.search(ln) for p in _META_PATTERNS):
-            continue
-        lineas.append(ln)
-    return re.sub(r"\n{3,}", "\n\n", "\n".join(lineas)).strip()
+    return _SALTOS_RE.sub("\n\n", _META_LINEA_RE.sub("", texto or "")).strip()
+
+def _num_partes(total_chars: int, max_chars: int) -> int:
+    """Cuántas partes daría _particionar, sin cortar (ni copiar) el texto."""
+    return -(-total_chars // max_chars)
 
 def _particionar(texto: str, max_chars: int) -> list[str]:
     return [texto[i:i + max_chars] for i in range(0, len(texto or ""), max_chars)]
@@ -544,29 +1072,37 @@ def _contar_anexos(s: str) -> int:
 
 _PAG_TAG_RE = re.compile(r"\[PÁGINA\s+(\d+)\]")
 
-def _index_paginas(s: str) -> List[Tuple[int, int]]:
-    return [(m.start(), int(m.group(1))) for m in _PAG_TAG_RE.finditer(s or "")]
-
-def _pagina_de_indice(indices: List[Tuple[int, int]], pos: int) -> int:
-    last = 1
-    for i, p in indices:
-        if i <= pos:
-            last = p
-        else:
-            break
-    return last
-
-def _index_anexos(s: str) -> List[Tuple[int, int]]:
-    return [(m.start(), int(m.group(1))) for m in _ANEXO_RE.finditer(s or "")]
-
-def _anexo_en_pos(indices: List[Tuple[int, int]], pos: int) -> Optional[int]:
-    last = None
-    for i, a in indices:
-        if i <= pos:
-            last = a
-        else:
-            break
-    return last
+# Índice = (posiciones ascendentes, valor en cada posición): búsqueda con bisect, O(log n) por hit
+_Indice = Tuple[List[int], List[int]]
+
+def _indexar(rx: "re.Pattern", s: str) -> _Indice:
+    posiciones: List[int] = []
+    valores: List[int] = []
+    for m in rx.finditer(s or ""):
+        posiciones.append(m.start())
+        valores.append(int(m.group(1)))
+    return posiciones, valores
+
+# Los ~5 extractores de un informe indexan el mismo texto: se memoiza por texto (el hash de un
+# str queda cacheado en el objeto, así que un hit no lo vuelve a recorrer). El índice es
+# compartido entre llamadas: solo lectura.
+@functools.lru_cache(maxsize=4)
+def _index_paginas(s: str) -> _Indice:
+    return _indexar(_PAG_TAG_RE, s)
+
+def _pagina_de_indice(indices: _Indice, pos: int) -> int:
+    posiciones, paginas = indices
+    k = bisect.bisect_right(posiciones, pos) - 1
+    return paginas[k] if k >= 0 else 1
+
+@functools.lru_cache(maxsize=4)
+def _index_anexos(s: str) -> _Indice:
+    return _indexar(_ANEXO_RE, s)
+
+def _anexo_en_pos(indices: _Indice, pos: int) -> Optional[int]:
+    posiciones, anexos = indices
+    k = bisect.bisect_right(posiciones, pos) - 1
+    return anexos[k] if k >= 0 else None
 
 # =============== Normalizacion de citas segun modo (multi vs unico) ===============
 _CITA_ANEXO_RE = re.compile(r"\(Anexo\s+([IVXLCDM\d]+)(?:,\s*p\.\s*(\d+))?\)", re.I)
@@ -589,9 +1125,11 @@ _TABLE_SEP_RE = re.compile(r"^\s*\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)+\|?\s*$")
 _CODE_FENCE_RE = re.compile(r"^\s*```.*$")
 _LINK_RE = re.compile(r"\[([^\]]+)\]\(([^)]+)\)")
 _BOLD_ITALIC_RE = re.compile(r"(\*\*|\*|__|_)(.*?)\1")
+_TITULO_DESCARTADO_RE = re.compile(r"^\s*informe\s+(completo|original)\s*$", re.I)
+_ESPACIOS_RE = re.compile(r"(\s+)")
 
 def _title_case(s: str) -> str:
-    return " ".join(w.capitalize() if w else w for w in re.split(r"(\s+)", s or ""))
+    return " ".join(w.capitalize() if w else w for w in _ESPACIOS_RE.split(s or ""))
 
 def preparar_texto_para_pdf(markdown_text: str) -> str:
     out_lines: List[str] = []
@@ -601,9 +1139,7 @@ def preparar_texto_para_pdf(markdown_text: str) -> str:
         if _CODE_FENCE_RE.match(ln):
             continue
         # filtra titulos indeseados
-        if re.match(r"(?i)^\s*informe\s+completo\s*$", ln):
-            continue
-        if re.match(r"(?i)^\s*informe\s+original\s*$", ln):
+        if _TITULO_DESCARTADO_RE.match(ln):
             continue
 
         m = _HDR_RE.match(ln)
@@ -619,23 +1155,40 @@ def preparar_texto_para_pdf(markdown_text: str) -> str:
         if _BULLET_RE.match(ln):
             ln = _BULLET_RE.sub("• ", ln)
 
-        ln = _LINK_RE.sub(lambda mm: f"{mm.group(1)} ({mm.group(2)})", ln)
-        ln = _BOLD_ITALIC_RE.sub(lambda mm: mm.group(2), ln)
+        # la mayoría de las líneas no tiene markdown inline: evitar los sub() en ese caso
+        if "](" in ln:
+            ln = _LINK_RE.sub(lambda mm: f"{mm.group(1)} ({mm.group(2)})", ln)
+        if "*" in ln or "_" in ln:
+            ln = _BOLD_ITALIC_RE.sub(lambda mm: mm.group(2), ln)
         out_lines.append(ln)
 
         if ln.strip().endswith(":"):
             out_lines.append("")  # espacio extra tras linea-titulo
 
     texto = "\n".join(out_lines)
-    texto = re.sub(r"\n{3,}", "\n\n", texto).strip()
+    texto = _SALTOS_RE.sub("\n\n", texto).strip()
     return texto
 
 # ==================== Hints regex (recall) ====================
-def _buscar_candidatos(texto: str, pats: List[str], idx_pag: List[Tuple[int, int]], limit: int) -> List[str]:
+@functools.lru_cache(maxsize=128)
+def _patron_campo(pats: Tuple[str, ...]) -> "re.Pattern":
+    """Los patrones de un campo en una sola alternancia (?P<p0>..)|(?P<p1>..): una pasada por campo."""
+    return re.compile("(?i)" + "|".join(f"(?P<p{k}>{pat})" for k, pat in enumerate(pats)))
+
+def _buscar_candidatos(texto: str, pats: List[str], idx_pag: _Indice, limit: int) -> List[str]:
+    if not texto or not pats:
+        return []
+    # Se escanea una vez; los hits se agrupan por patrón para conservar la prioridad de la lista
+    # (primero todos los del patrón 0, luego los del 1...). Cortar apenas el 0 llena el cupo.
+    por_patron: List[List[int]] = [[] for _ in pats]
+    for m in _patron_campo(tuple(pats)).finditer(texto):
+        k = int(m.lastgroup[1:])
+        por_patron[k].append(m.start())
+        if len(por_patron[0]) >= limit:
+            break
     hits = []
-    for pat in pats:
-        for m in re.finditer(pat, texto or "", flags=re.I):
-            pos = m.start()
+    for posiciones in por_patron:
+        for pos in posiciones:
             p = _pagina_de_indice(idx_pag, pos)
             start = max(0, pos - 160)
             end = min(len(texto), pos + 240)
@@ -643,7 +1196,7 @@ def _buscar_candidatos(texto: str, pats: List[str], idx_pag: List[Tuple[int, int
             hits.append(f"- p. {p}: {snippet}")
             if len(hits) >= limit:
                 return hits
-    return hits[:limit]
+    return hits
 
 def _build_regex_hints(texto: str, limit_per_field: int = None, max_chars: int = None) -> str:
     if not texto:
@@ -695,11 +1248,27 @@ DETECTABLE_FIELDS: Dict[str, Dict] = {
     "obj_gasto":   {"label": "Objeto del gasto", "pats": [r"objeto\s+del\s+gasto", r"partida\s+presupuestaria", r"clasificador"]},
     "ofertas_perm":{"label": "Ofertas permitidas", "pats": [r"m[aá]s\s+de\s+una\s+oferta", r"ofertas?\s+alternativas", r"una\s+sola\s+oferta"]},
 }
+
+# Alternancia de cada campo compilada al importar (no en el primer request)
+for _meta in DETECTABLE_FIELDS.values():
+    _patron_campo(tuple(_meta["pats"]))
+del _meta
+
+# "<Label> ... NO ESPECIFICADO" en la misma línea, o "<Label>:" con el valor en la siguiente
+_NOESP_CAMPO_RE: Dict[str, "re.Pattern"] = {
+    clave: re.compile(rf"(?i){re.escape(meta['label'])}(?:.*|\s*:\s*)NO ESPECIFICADO")
+    for clave, meta in DETECTABLE_FIELDS.items()
+}
 # utils.py — Parte 4/5
 
 # ==================== Utilidades de conteo y evidencia ====================
-def _count(pattern: str, text: str) -> int:
-    return len(re.findall(pattern, text or "", flags=re.I))
+def _count(cre: "re.Pattern", text: str) -> int:
+    return len(cre.findall(text or ""))
+
+_RENGLON_CITA_RE = re.compile(r"(?im)\brengl[oó]n\s*\d+")
+_ART_CITA_RE = re.compile(r"(?im)\bart(?:[íi]culo|\.?)\s*\d+")
+_RENGLON_LINEA_RE = re.compile(r"(?im)^\s*(?:reng(?:l[oó]n)?\.?\s*)?\d{1,4}\b")
+_ART_LINEA_RE = re.compile(r"(?im)^\s*art(?:[íi]culo|\.?)\s*\d+")
 
 _ART_HEAD_RE = re.compile(r"(?im)^\s*(art(?:[íi]culo|\.?)\s*\d+[a-zº°]?)\s*[-–—:]?\s*(.*)$")
 _ART_BLOCK_RE = re.compile(
@@ -847,13 +1416,13 @@ def _construir_evidencia_ampliacion(texto: str) -> Tuple[str, int, int]:
 
 def _conteo_en_informe(informe: str) -> Tuple[int, int]:
     informe = informe or ""
-    return _count(r"(?im)\brengl[oó]n\s*\d+", informe), _count(r"(?im)\bart(?:[íi]culo|\.?)\s*\d+", informe)
+    return _count(_RENGLON_CITA_RE, informe), _count(_ART_CITA_RE, informe)
 
 def _max_out_for_text(texto: str) -> int:
     texto = texto or ""
     base_chars = len(texto)
-    r_count = _count(r"(?im)^\s*(?:reng(?:l[oó]n)?\.?\s*)?\d{1,4}\b", texto)
-    a_count = _count(r"(?im)^\s*art(?:[íi]culo|\.?)\s*\d+", texto)
+    r_count = _count(_RENGLON_LINEA_RE, texto)
+    a_count = _count(_ART_LINEA_RE, texto)
     base = MAX_COMPLETION_TOKENS_SALIDA
     if r_count >= 20 or a_count >= 20:
         base = max(base, 6500)
@@ -968,13 +1537,16 @@ def _build_section_23(texto: str, varios_anexos: bool) -> str:
     return "\n".join(out)
 
 # ====== Normativa aplicable ======
+# El número va en un grupo con el nombre del tipo: en la alternancia fusionada `m.lastgroup`
+# dice qué tipo matcheó
 NORM_TIPOS = [
-    ("Ley",        r"\bLey(?:\s*N[°º])?\s*([\d\.]{1,7}(?:/\d{2,4})?)\b"),
-    ("Decreto",    r"\bDecreto(?:\s*N[°º])?\s*([\d\.]{1,7}(?:/\d{2,4})?)\b"),
-    ("Resolucion", r"\bResoluci[oó]n(?:\s*(?:Ministerial|Conjunta))?\s*(?:N[°º]\s*)?(\d{1,7}(?:/\d{2,4})?)\b"),
-    ("Disposicion",r"\bDisposici[oó]n\s*(?:N[°º]\s*)?(\d{1,7}(?:/\d{2,4})?)\b"),
+    ("Ley",        r"\bLey(?:\s*N[°º])?\s*(?P<Ley>[\d\.]{1,7}(?:/\d{2,4})?)\b"),
+    ("Decreto",    r"\bDecreto(?:\s*N[°º])?\s*(?P<Decreto>[\d\.]{1,7}(?:/\d{2,4})?)\b"),
+    ("Resolucion", r"\bResoluci[oó]n(?:\s*(?:Ministerial|Conjunta))?\s*(?:N[°º]\s*)?(?P<Resolucion>\d{1,7}(?:/\d{2,4})?)\b"),
+    ("Disposicion",r"\bDisposici[oó]n\s*(?:N[°º]\s*)?(?P<Disposicion>\d{1,7}(?:/\d{2,4})?)\b"),
 ]
-NORM_PATTS = [(tipo, re.compile(patt, re.I)) for (tipo, patt) in NORM_TIPOS]
+# Una sola pasada por el texto para los cuatro tipos (antes: un finditer por tipo)
+NORM_RE = re.compile("(?i)" + "|".join(patt for _, patt in NORM_TIPOS))
 
 def _extraer_normativa(texto: str) -> List[Tuple[str, str, int, Optional[int]]]:
     """
@@ -983,26 +1555,20 @@ def _extraer_normativa(texto: str) -> List[Tuple[str, str, int, Optional[int]]]:
     texto = texto or ""
     idx_pag = _index_paginas(texto)
     idx_ax  = _index_anexos(texto)
-    res: List[Tuple[str, str, int, Optional[int]]] = []
-
-    for (tipo, cre) in NORM_PATTS:
-        for m in cre.finditer(texto):
-            pos = m.start()
-            p = _pagina_de_indice(idx_pag, pos)
-            ax = _anexo_en_pos(idx_ax, pos)
-            numero = (m.group(1) or "").strip()
-            res.append((tipo, numero, p, ax))
 
-    # dedupe preservando orden
+    # Mismo orden que con un finditer por tipo: agrupado por tipo y, dentro, por posición.
+    # Dedupe en el scan: página/anexo solo se buscan para la primera aparición de cada norma.
+    por_tipo: Dict[str, List[Tuple[str, str, int, Optional[int]]]] = {tipo: [] for tipo, _ in NORM_TIPOS}
     seen = set()
-    dedup: List[Tuple[str, str, int, Optional[int]]] = []
-    for t, n, p, ax in res:
-        key = (t.lower(), n)
-        if key in seen:
+    for m in NORM_RE.finditer(texto):
+        tipo = m.lastgroup
+        numero = (m.group(tipo) or "").strip()
+        if (tipo, numero) in seen:
             continue
-        seen.add(key)
-        dedup.append((t, n, p, ax))
-    return dedup
+        seen.add((tipo, numero))
+        pos = m.start()
+        por_tipo[tipo].append((tipo, numero, _pagina_de_indice(idx_pag, pos), _anexo_en_pos(idx_ax, pos)))
+    return [norma for normas in por_tipo.values() for norma in normas]
 
 def _build_section_215(texto: str, varios_anexos: bool) -> str:
     normas = _extraer_normativa(texto or "")
@@ -1174,10 +1740,10 @@ def _compute_chunk_size(total_chars: int) -> int:
     return max(CHUNK_SIZE_BASE, ideal)
 
 def _generar_notas_concurrente(partes: List[str]) -> List[str]:
-    resultados: List[Optional[str]] = [None] * len(partes)
     t0 = _t()
 
-    def worker(idx: int, parte: str):
+    def worker(item: Tuple[int, str]) -> str:
+        idx, parte = item
         msg = [
             {"role": "system",
              "content": "Eres un analista juridico que extrae bullets tecnicos con citas; cero invenciones; maxima concision."},
@@ -1185,17 +1751,13 @@ def _generar_notas_concurrente(partes: List[str]) -> List[str]:
              "content": f"{CRAFT_PROMPT_NOTAS}\n\n## Guia de sinonimos/normalizacion\n{SINONIMOS_CANONICOS}\n\n=== FRAGMENTO {idx+1}/{len(partes)} ===\n{parte}"}
         ]
         r = _llamada_openai(msg, max_completion_tokens=NOTAS_MAX_TOKENS, model=_pick_model("notas"))
-        return idx, (r.choices[0].message.content or "").strip()
-
-    with ThreadPoolExecutor(max_workers=max(1, ANALISIS_CONCURRENCY)) as ex:
-        futs = [ex.submit(worker, i, p) for i, p in enumerate(partes)]
-        for fut in as_completed(futs):
-            try:
-                i, content = fut.result()
-                resultados[i] = content
-            except Exception as e:
-                resultados[i] = f"[ERROR] No se pudieron generar notas de la parte {i+1}: {e}"
+        return (r.choices[0].message.content or "").strip()
 
+    # El índice de la parte que falló lo da _en_paralelo (antes salía del resultado, que no existe si falla)
+    resultados = _en_paralelo(
+        worker, list(enumerate(partes)), ANALISIS_CONCURRENCY,
+        on_error=lambda i, e: f"[ERROR] No se pudieron generar notas de la parte {i+1}: {e}",
+    )
     _log_tiempo(f"notas_intermedias_{len(partes)}_partes_concurrente", t0)
     return [r or "" for r in resultados]
 
@@ -1209,11 +1771,11 @@ def _segundo_pase_si_falta(original_report: str, texto_fuente: str, varios_anexo
         return original_report
 
     evidencia: List[str] = []
+    idx_pag = _index_paginas(texto_fuente or "")
     for clave, meta in DETECTABLE_FIELDS.items():
         label = meta["label"]
-        if re.search(rf"{re.escape(label)}.*NO ESPECIFICADO", original_report or "", flags=re.I) or \
-           re.search(rf"{re.escape(label)}\s*:\s*NO ESPECIFICADO", original_report or "", flags=re.I):
-            hits = _buscar_candidatos(texto_fuente or "", meta["pats"], _index_paginas(texto_fuente or ""), 10)
+        if _NOESP_CAMPO_RE[clave].search(original_report or ""):
+            hits = _buscar_candidatos(texto_fuente or "", meta["pats"], idx_pag, 10)
             if hits:
                 evidencia.append(f"### {label}\n" + "\n".join(hits))
 
@@ -1290,10 +1852,9 @@ def analizar_con_openai(texto: str) -> str:
 
     # Dos etapas (chunking + concurrencia)
     chunk_size = _compute_chunk_size(texto_len)
-    partes = _particionar(texto, chunk_size)
 
-    # Seguridad: si por tamano quedo 1 parte, reintenta single-pass
-    if len(partes) == 1:
+    # Seguridad: si por tamano quedo 1 parte, reintenta single-pass (sin copiar el texto en partes)
+    if _num_partes(texto_len, chunk_size) == 1:
         t0 = _t()
         max_out = _max_out_for_text(texto)
         messages = [
@@ -1315,7 +1876,9 @@ def analizar_con_openai(texto: str) -> str:
         except Exception as e:
             return f"Error al generar el analisis: {e}"
 
-    # A) Notas intermedias (concurrente)
+    # A) Notas intermedias (concurrente). Lista y no generador: los workers usan todas las
+    # partes a la vez y el prompt necesita el total
+    partes = _particionar(texto, chunk_size)
     notas_list = _generar_notas_concurrente(partes)
     notas_integradas = "\n".join(notas_list)
 
@@ -1364,16 +1927,8 @@ def analizar_anexos(files: list) -> str:
     bloques: List[str] = []
     multi = len(files) >= 2
 
-    for idx, f in enumerate(files, 1):
-        try:
-            texto = extraer_texto_universal(f)
-        except Exception:
-            try:
-                f.file.seek(0)
-                texto = f.file.read().decode("utf-8", errors="ignore")
-            except Exception:
-                texto = ""
-
+    textos = extraer_texto_universal_batch(files)
+    for idx, (f, texto) in enumerate(zip(files, textos), 1):
         nombre = getattr(f, "filename", f"anexo_{idx}") or f"anexo_{idx}"
         if multi:
             bloques.append(f"=== ANEXO {idx:02d}: {nombre} ===\n{texto}\n")